@@ -0,0 +1,156 @@
+"""
+Per-request overhead of the /graphql/ view with and without the document
+cache in mysite/backend.py.
+
+Migrates a throwaway SQLite database, loads the test fixtures, and then
+POSTs a few typical operations straight at GraphQLView, once with the cache
+turned off (maxsize=0, i.e. parse and validate every time) and once with it
+on. It also times parse + validate on their own, which is the part the cache
+takes away.
+
+This does not touch db.sqlite3.
+
+$ python3 benchmarks/bench_documents.py
+$ python3 benchmarks/bench_documents.py --repeat 5000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+OPERATIONS = {
+    "snippetById": '''
+query snippetById($id: String!) {
+  snippetById(id: $id) {
+    id
+    title
+    bodyPreview
+    private
+    owner
+    created
+  }
+}''',
+    "qryLimitedSnippets": '''
+query qryLimitedSnippets($first: Int) {
+  limitedSnippets(first: $first) {
+    edges {
+      cursor
+      node {
+        id
+        title
+        bodyPreview
+        owner
+        created
+      }
+    }
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+  }
+}''',
+    "qryMe": '''
+query qryMe {
+  me {
+    id
+    username
+    isSuperuser
+  }
+}''',
+}
+
+VARIABLES = {
+    "snippetById": {"id": "3"},
+    "qryLimitedSnippets": {"first": 5},
+    "qryMe": {},
+}
+
+
+def setup_django(path):
+    """Points the default database at path before Django starts up."""
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = path
+    settings.DEBUG = False
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+    call_command('loaddata', 'fixtures.json', verbosity=0)
+
+
+def timed(func, repeat):
+    """Returns (median, p95) in microseconds."""
+    samples = []
+    # The resolvers print as they go; keep that out of the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'))
+
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from graphene_django.views import GraphQLView
+        from graphql.language.base import parse
+        from graphql.validation import validate
+        from mysite.backend import GraphQLCustomCoreBackend
+        from mysite.schema import schema
+
+        factory = RequestFactory()
+
+        def view_for(backend):
+            return GraphQLView.as_view(schema=schema, backend=backend)
+
+        def request(name):
+            body = json.dumps({"query": OPERATIONS[name], "operationName": name, "variables": VARIABLES[name]})
+            req = factory.post('/graphql/', body, content_type='application/json')
+            req.user = AnonymousUser()
+            return req
+
+        uncached = view_for(GraphQLCustomCoreBackend(maxsize=0))
+        cached_backend = GraphQLCustomCoreBackend()
+        cached = view_for(cached_backend)
+
+        print()
+        print("{:<20} {:<26} {:>10} {:>10}".format("operation", "", "median us", "p95 us"))
+        for name in OPERATIONS:
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = cached(request(name))
+            assert response.status_code == 200, response.content
+
+            results = [
+                ("parse + validate", lambda: validate(schema, parse(OPERATIONS[name]))),
+                ("request, no cache", lambda: uncached(request(name))),
+                ("request, cached", lambda: cached(request(name))),
+            ]
+            for label, func in results:
+                median, p95 = timed(func, args.repeat)
+                print("{:<20} {:<26} {:>10.1f} {:>10.1f}".format(name, label, median, p95))
+
+        print()
+        print("cache:", cached_backend.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Latency benchmark for searchSnippets (snippets/search.py).
+
+Builds a throwaway SQLite database holding --rows snippets of made-up text,
+migrates it (so the FTS5 table and its triggers are the real ones), and then
+times the search path against the LIKE '%word%' scan a client-side filter
+would otherwise need.
+
+This does not touch db.sqlite3.
+
+$ python3 benchmarks/bench_search.py                 # 1,000,000 rows
+$ python3 benchmarks/bench_search.py --rows 100000
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+OWNERS = ['admin', 'john.smith', 'tony.williams', 'Rudi the Rottweiler']
+
+
+def setup_django(path):
+    """Points the default database at path before Django starts up."""
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = path
+    settings.DEBUG = False
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def make_vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def populate(rows, rng, batch=10000):
+    """Bulk loads rows snippets. Words follow a Zipf-ish curve like real text."""
+    from django.db import connection, transaction
+
+    vocabulary = make_vocabulary(20000, rng)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def sentence(words):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=words))
+
+    sql = ('INSERT INTO snippets_snippet (title, body, owner, private, created) '
+           'VALUES (%s, %s, %s, %s, %s)')
+    start = time.perf_counter()
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(0, rows, batch):
+            cursor.executemany(sql, [
+                (sentence(4), sentence(60), rng.choice(OWNERS), rng.random() < 0.5,
+                 '2021-01-01 00:00:{:02d}.{:06d}'.format(i % 60, i))
+                for i in range(offset, min(offset + batch, rows))
+            ])
+    print("Loaded {:,} rows (including FTS index) in {:.1f}s".format(rows, time.perf_counter() - start))
+
+    return vocabulary
+
+
+def timed(func, repeat):
+    """Returns (median, p95, max) in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1], samples[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'))
+
+        from django.db.models import Q
+        from snippets.models import Snippet, IS_PUBLIC
+        from snippets.search import search_connection
+        from snippets.types import SnippetConnection
+
+        rng = random.Random(args.seed)
+        vocabulary = populate(args.rows, rng)
+
+        # vocabulary[0] is in most snippets; the tail of the list is in a handful.
+        cases = [
+            ("common word", vocabulary[0]),
+            ("mid-frequency word", vocabulary[500]),
+            ("rare word", vocabulary[-1]),
+            ("two words", "{} {}".format(vocabulary[3], vocabulary[200])),
+        ]
+
+        # What AnonymousUser and john.smith can see; see queries.visible_snippets().
+        audiences = [
+            ("anonymous", Snippet.objects.filter(IS_PUBLIC)),
+            ("owner", Snippet.objects.filter(IS_PUBLIC | Q(owner='john.smith'))),
+        ]
+
+        print()
+        print("{:<20} {:<10} {:>10} {:>10} {:>10}".format("search", "audience", "median ms", "p95 ms", "max ms"))
+        for label, text in cases:
+            for audience, queryset in audiences:
+                first_page = search_connection(queryset, text, SnippetConnection, first=args.page_size)
+                after = first_page.page_info.end_cursor
+
+                results = [
+                    ("fts5 page 1", lambda: search_connection(
+                        queryset, text, SnippetConnection, first=args.page_size)),
+                    ("fts5 page 2", lambda: search_connection(
+                        queryset, text, SnippetConnection, first=args.page_size, after=after)),
+                ]
+                if audience == 'anonymous':
+                    # The scan a client-side or LIKE filter amounts to, for comparison.
+                    like = Q()
+                    for word in text.split():
+                        like &= Q(title__icontains=word) | Q(body__icontains=word)
+                    results.append(("LIKE scan", lambda: list(
+                        queryset.filter(like).order_by('id')[:args.page_size])))
+
+                print("{} [{}]".format(label, text))
+                for name, func in results:
+                    repeat = args.repeat if name != "LIKE scan" else max(3, args.repeat // 5)
+                    median, p95, worst = timed(func, repeat)
+                    print("  {:<18} {:<10} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                        name, audience, median, p95, worst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Size and cost of a subscription notification in each websocket encoding of
+snippets/wire.py.
+
+Builds the "data" frames for one notification to --subscribers subscribers
+that share its rendering (see snippets/fanout.py), once per encoding, two
+ways: around the payload encoded once (what the consumer does), and by
+encoding each subscriber's whole message on its own (what compressing every
+frame separately, e.g. permessage-deflate, amounts to). Does it for a
+single-snippet notification and for a bulk one (createSnippets).
+
+Nothing is sent; this is the CPU and bytes per notification only.
+
+$ python3 benchmarks/bench_wire.py
+$ python3 benchmarks/bench_wire.py --subscribers 5000 --bulk 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+
+BODY = (
+    "def fib(n):\n"
+    "    a, b = 0, 1\n"
+    "    for _ in range(n):\n"
+    "        a, b = b, a + b\n"
+    "    return a\n"
+)
+
+
+def snippet(n):
+    return {
+        "id": str(n),
+        "title": "Snippet number {}".format(n),
+        "bodyPreview": BODY[:80],
+        "owner": "admin",
+        "private": False,
+        "created": "2021-06-01T12:00:{:02d}+00:00".format(n % 60),
+    }
+
+
+def payloads(bulk):
+    single = {"onSnippetTransaction": {"ok": True, "transType": "UPDATE", "snippet": snippet(1), "seq": 41}}
+    many = {"onSnippetTransaction": {"ok": True, "transType": "CREATE", "seq": 42,
+                                     "snippets": [snippet(n) for n in range(bulk)]}}
+    return {"single": single, "bulk x{}".format(bulk): many}
+
+
+def timed(func, repeat):
+    """Median in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--bulk', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+
+    from snippets.fanout import data_payload
+    from snippets.wire import WIRE_FORMATS
+
+    op_ids = [str(n) for n in range(args.subscribers)]
+
+    print()
+    print("{:<10} {:<28} {:>8} {:>14} {:>14}".format(
+        "payload", "subprotocol", "bytes", "shared ms", "per frame ms"))
+    for label, data in payloads(args.bulk).items():
+        payload_json = data_payload(data, [])
+        for wire in WIRE_FORMATS.values():
+            text_data, bytes_data = wire.data_frame(op_ids[0], payload_json)
+            size = len(bytes_data if bytes_data is not None else text_data.encode('utf-8'))
+
+            def shared():
+                # Encoded afresh each round, as for a new notification.
+                wire._payloads.clear()
+                for op_id in op_ids:
+                    wire.data_frame(op_id, payload_json)
+
+            message = json.loads(payload_json)
+
+            def per_frame():
+                for op_id in op_ids:
+                    wire.encode({"type": "data", "id": op_id, "payload": message})
+
+            print("{:<10} {:<28} {:>8} {:>14.2f} {:>14.2f}".format(
+                label, wire.subprotocol, size, timed(shared, args.repeat), timed(per_frame, args.repeat)))
+        print()
+
+
+if __name__ == '__main__':
+    main()
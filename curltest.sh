@@ -9,7 +9,7 @@ PORT=4000
 curl \
 	-X POST \
 	-H "Content-Type: application/json" \
-	--data '{ "query": "{ allSnippets { id } }" }' \
+	--data '{ "query": "{ allSnippets(first: 10) { edges { node { id } } pageInfo { endCursor hasNextPage } } }" }' \
 	http://$BIND:$PORT/graphql/
 
 
@@ -10,12 +10,14 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 django_asgi_app = get_asgi_application()
 
 # Now import channels related packages
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from snippets.usercache import CachedAuthMiddlewareStack
 
 # NOTE: Please note the `channels.auth.AuthMiddlewareStack` wrapper to
 # [ AuthMiddleWare, SessionMiddleware, CookieMiddleware ].
 # https://channels.readthedocs.io/en/latest/topics/authentication.html
+# CachedAuthMiddlewareStack is that, with the user cached by session; see
+# snippets/usercache.py.
 application = channels.routing.ProtocolTypeRouter({
 
     # Normally, Django uses HTTP to communicate between the client and server
@@ -25,7 +27,7 @@ application = channels.routing.ProtocolTypeRouter({
     # Wrapping in AllowedHostsOriginValidator uses the ALLOWED_HOSTS from settings.
     # Auth is for authenticated user handling.
     # URLRouter sends the request along to the particular consumer.
-    "websocket": AuthMiddlewareStack(
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             # Put in the websocket_urlpatterns
             websocket_urlpatterns
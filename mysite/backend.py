@@ -0,0 +1,119 @@
+"""
+The GraphQL backend behind the /graphql/ view.
+
+Clients send the same few operations over and over, and parsing and
+validating the query text is a fixed cost paid on every one of them. So the
+backend keeps the last DOCUMENT_CACHE_MAXSIZE documents, parsed and already
+validated, keyed by the schema they were validated against and the sha256
+of the query text. A cached document is executed without validating again.
+
+Syntax errors are raised by parse() and never reach the cache. Documents
+that fail validation are cached along with their errors.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from graphql.backend import GraphQLCoreBackend
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import execute, ExecutionResult
+from graphql.language import ast
+from graphql.language.base import parse
+from graphql.validation import validate
+
+from snippets import metrics
+
+DOCUMENT_CACHE_MAXSIZE = getattr(settings, 'GRAPHQL_DOCUMENT_CACHE_MAXSIZE', 512)
+
+
+def document_key(schema, document_string):
+    """
+Cache key for a query. The schema object itself is part of the key, so a
+document validated against one schema is never run against another.
+    """
+    return schema, hashlib.sha256(document_string.encode('utf-8')).hexdigest()
+
+
+def _invalid(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+# Define a CustomCoreBackend to get around the following message:
+# "Subscriptions are not allowed. You will need to either use the subscribe
+# function or pass allow_subscriptions=True"
+# https://github.com/eamigo86/graphene-django-subscriptions/issues/7
+class GraphQLCustomCoreBackend(GraphQLCoreBackend):
+    def __init__(self, executor=None, maxsize=DOCUMENT_CACHE_MAXSIZE):
+        # type: (Optional[Any]) -> None
+        super().__init__(executor)
+        self.execute_params['allow_subscriptions'] = True
+
+        self.maxsize = maxsize
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def document_from_string(self, schema, document_string):
+        if isinstance(document_string, ast.Document) or not self.maxsize:
+            return super().document_from_string(schema, document_string)
+
+        key = document_key(schema, document_string)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        document = self._parse_and_validate(schema, document_string)
+
+        with self._lock:
+            self._documents[key] = document
+            while len(self._documents) > self.maxsize:
+                self._documents.popitem(last=False)
+                self.evictions += 1
+
+        return document
+
+    def _parse_and_validate(self, schema, document_string):
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            execute_document = partial(_invalid, errors)
+        else:
+            execute_document = partial(execute, schema, document_ast, **self.execute_params)
+
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=execute_document,
+        )
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._documents),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+# The one backend, and so the one document cache, shared by the /graphql/
+# view (urls.py) and the websocket consumer (snippets/consumer.py).
+graphql_backend = GraphQLCustomCoreBackend()
+metrics.register('document_cache', graphql_backend.stats)
@@ -0,0 +1,538 @@
+"""
+A channel layer shared by the worker processes on one host, with no broker.
+
+InMemoryChannelLayer keeps channels and groups in one process's memory, so a
+mutation handled by one ASGI worker never reaches subscribers connected to
+another. This layer runs over Unix domain sockets and a shared directory
+instead:
+
+    <path>/<process>.sock           one datagram socket per process
+    <path>/groups/<group>/<channel> one empty file per group member
+    <path>/messages/<id>            a message too big for a datagram
+
+Every process binds its own socket, and the channels it hands out from
+new_channel() carry its name ("specific.ipc-<pid>-<random>!<random>"), so
+anyone can tell where a channel's messages go. Group membership is the
+directory listing, which every process can read; the file's mtime is when
+the channel joined, for group_expiry.
+
+group_send() sends one datagram per process with members in the group,
+naming those members, and the receiving process copies it into each one's
+queue. Messages to channels of this process never touch a socket.
+
+Like InMemoryChannelLayer, a channel holds at most `capacity` messages
+(channel_capacity can set it per channel pattern), and messages older than
+`expiry` seconds are dropped unreceived. send() raises ChannelFull for a
+full channel of this process, or when a remote process's socket buffer is
+full; a full queue on the remote end can't be reported back and is
+counted instead. group_send() never raises ChannelFull. A process that has
+gone away without cleaning up is noticed when its socket refuses a
+datagram, and its channels are dropped from the groups they were in.
+
+Channels without a "!" (e.g. for runworker) are local to the process that
+receives on them; nothing here uses them.
+
+Messages are packed with msgpack, so they may hold the same types as with
+channels_redis. One that packs to more than a quarter of the sending socket's
+buffer (SO_SNDBUF, about 208 KB by default on Linux, past which the kernel
+refuses the datagram outright) is written to a file under messages/ instead,
+once per group_send(), and the datagrams carry its name. Receivers read it
+from there; it is removed once it has expired.
+"""
+import asyncio
+import atexit
+import errno
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from copy import deepcopy
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from snippets import metrics
+
+# Messages that pack to more than this share of SO_SNDBUF go through a file.
+# A datagram also has to fit alongside the others not yet read.
+INLINE_SHARE = 4
+
+# Listings of group directories changed less than this long ago aren't
+# cached; see _group_members().
+MTIME_GRANULARITY = 1.0  # seconds
+
+# How often, at most, queues are swept for expired messages.
+CLEAN_INTERVAL = 1.0  # seconds
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer for the worker processes of one host; see the module
+    docstring. All processes sharing a layer must be given the same path.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs
+        )
+        self.path = os.fspath(path)
+        self.group_expiry = group_expiry
+        self._reset()
+        metrics.register('channel_layer', self.stats)
+
+    def _reset(self):
+        """Starts over as a new process, as after a fork."""
+        self.pid = os.getpid()
+        self.process_name = "ipc-%d-%s" % (self.pid, uuid.uuid4().hex[:8])
+        self._channels = {}
+        self._waiters = {}
+        self._members = {}
+        self._lock = threading.Lock()
+        self._receiver = None
+        self._sender = None
+        # Set by _stop(), after which the socket isn't bound again, e.g. by a
+        # listener thread's receive() at exit.
+        self._stopped = False
+        self._inline_limit = None
+        self._last_clean = 0.0
+
+        self.sent = 0
+        self.received = 0
+        self.dropped_full = 0
+        self.dropped_expired = 0
+        self.dropped_unreachable = 0
+        self.spilled = 0
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """
+        Send a message onto a (general or specific) channel.
+        """
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        process = self._process_of(channel)
+        if process in (None, self.process_name):
+            if not self._deliver(channel, message, time.time() + self.expiry):
+                raise ChannelFull(channel)
+            return
+        expires = time.time() + self.expiry
+        if not self._send_to(process, [channel], self._payload(message, expires), expires):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        """
+        Receive the first message that arrives on the channel. Only this
+        process's own channels can be received on.
+        """
+        assert self.valid_channel_name(channel)
+        self._start()
+        loop = asyncio.get_event_loop()
+
+        while True:
+            with self._lock:
+                queue = self._channels.get(channel)
+                now = time.time()
+                while queue:
+                    expires, message = queue.popleft()
+                    if expires >= now:
+                        if not queue:
+                            del self._channels[channel]
+                        return message
+                    self.dropped_expired += 1
+                if queue is not None:
+                    del self._channels[channel]
+                waiter = loop.create_future()
+                self._waiters.setdefault(channel, []).append(waiter)
+
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    waiters = self._waiters.get(channel, [])
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    if not waiters:
+                        self._waiters.pop(channel, None)
+
+    async def new_channel(self, prefix="specific."):
+        """
+        Returns a new channel name that can be used by something in our
+        process as a specific channel.
+        """
+        self._start()
+        return "%s%s!%s" % (prefix, self.process_name, uuid.uuid4().hex[:12])
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """
+        Adds the channel name to a group.
+        """
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        directory = self._group_dir(group)
+        member = os.path.join(directory, channel)
+        while True:
+            os.makedirs(directory, exist_ok=True)
+            try:
+                with open(member, "a"):
+                    os.utime(member)
+                return
+            except FileNotFoundError:
+                pass  # The group emptied and was removed in between.
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        directory = self._group_dir(group)
+        try:
+            os.unlink(os.path.join(directory, channel))
+            os.rmdir(directory)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno != errno.ENOTEMPTY:
+                raise
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._clean_expired()
+
+        by_process = {}
+        for channel in self._group_members(group):
+            by_process.setdefault(self._process_of(channel), []).append(channel)
+
+        expires = time.time() + self.expiry
+        payload = None
+        for process, channels in by_process.items():
+            if process in (None, self.process_name):
+                for channel in channels:
+                    self._deliver(channel, message, expires)
+            else:
+                # Packed (or written out) once for all the processes.
+                if payload is None:
+                    payload = self._payload(message, expires)
+                self._send_to(process, channels, payload, expires)
+
+    # Flush extension
+
+    async def flush(self):
+        """Forgets every group, for every process, and this process's queues."""
+        with self._lock:
+            self._channels.clear()
+            self._members.clear()
+        shutil.rmtree(os.path.join(self.path, "groups"), ignore_errors=True)
+
+    async def close(self):
+        self._stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'process': self.process_name,
+                'channels': len(self._channels),
+                'queued': sum(len(queue) for queue in self._channels.values()),
+                'sent': self.sent,
+                'received': self.received,
+                'dropped_full': self.dropped_full,
+                'dropped_expired': self.dropped_expired,
+                'dropped_unreachable': self.dropped_unreachable,
+                'spilled': self.spilled,
+            }
+
+    # This process's socket
+
+    def _socket_path(self, process):
+        return os.path.join(self.path, process + ".sock")
+
+    def _start(self):
+        """Binds this process's socket and starts reading it, once."""
+        if self.pid != os.getpid():
+            self._reset()
+        if self._receiver is not None or self._stopped:
+            return
+        with self._lock:
+            if self._receiver is not None or self._stopped:
+                return
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(self._socket_path(self.process_name))
+            self._receiver = receiver
+        threading.Thread(target=self._read, args=(receiver,), name="channel-layer", daemon=True).start()
+        atexit.register(self._stop)
+
+    def _stop(self):
+        with self._lock:
+            self._stopped = True
+            receiver, self._receiver = self._receiver, None
+            sender, self._sender = self._sender, None
+        for sock in (receiver, sender):
+            if sock is not None:
+                sock.close()
+        if receiver is not None:
+            try:
+                os.unlink(self._socket_path(self.process_name))
+            except FileNotFoundError:
+                pass
+
+    def _read(self, receiver):
+        # Big enough for any datagram another process's _payload() sends, as
+        # they have the same default buffer sizes.
+        buffer = bytearray(max(
+            receiver.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            receiver.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        ))
+        view = memoryview(buffer)
+        while True:
+            try:
+                size = receiver.recv_into(buffer)
+            except OSError:
+                return  # closed by _stop()
+            unpacker = msgpack.Unpacker(raw=False)
+            unpacker.feed(view[:size])
+            try:
+                channels, expires, spilled = next(unpacker)
+                if spilled is None:
+                    message = next(unpacker)
+                else:
+                    message = self._read_spilled(spilled)
+            except (ValueError, TypeError, StopIteration):
+                continue
+            if message is None:
+                with self._lock:
+                    self.dropped_expired += len(channels)
+                continue
+            for channel in channels:
+                self._deliver(channel, message, expires)
+
+    def _read_spilled(self, name):
+        """The message written to messages/name, or None if it has expired."""
+        try:
+            with open(os.path.join(self.path, "messages", os.path.basename(name)), "rb") as f:
+                return msgpack.unpackb(f.read(), raw=False)
+        except FileNotFoundError:
+            return None
+
+    def _deliver(self, channel, message, expires):
+        """
+        Queues message on one of this process's channels and wakes a receiver.
+        Returns False, and drops the message, when the channel is full.
+        """
+        with self._lock:
+            queue = self._channels.setdefault(channel, deque())
+            if len(queue) >= self.get_capacity(channel):
+                self.dropped_full += 1
+                return False
+            queue.append((expires, deepcopy(message)))
+            self.received += 1
+            for waiter in self._waiters.get(channel, ()):
+                # The receiver may be in another thread's event loop, or
+                # in one that has since been closed.
+                try:
+                    waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+                except RuntimeError:
+                    pass
+        return True
+
+    # Other processes
+
+    def _get_sender(self):
+        with self._lock:
+            if self._sender is None:
+                self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sender.setblocking(False)
+                self._inline_limit = self._sender.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // INLINE_SHARE
+            return self._sender
+
+    def _payload(self, message, expires):
+        """
+        What the datagrams for message carry after their header: the packed
+        message, or nothing, with the name of the file it was written to if it
+        is too big to go inline.
+        """
+        packed = msgpack.packb(message, use_bin_type=True)
+        self._get_sender()
+        if len(packed) <= self._inline_limit:
+            return None, packed
+        return self._spill(packed, expires)
+
+    def _spill(self, packed, expires):
+        """Writes a packed message to a file under messages/, named in the payload."""
+        directory = os.path.join(self.path, "messages")
+        os.makedirs(directory, exist_ok=True)
+        name = "%s-%s" % (self.process_name, uuid.uuid4().hex)
+        # Written under another name and renamed, so it is never read half-done.
+        temporary = os.path.join(directory, "." + name)
+        with open(temporary, "wb") as f:
+            f.write(packed)
+        os.utime(temporary, (expires, expires))
+        os.rename(temporary, os.path.join(directory, name))
+        with self._lock:
+            self.spilled += 1
+        return name, b""
+
+    def _send_to(self, process, channels, payload, expires):
+        """
+        Sends one datagram carrying a message, as _payload() returned it, for
+        channels, all in process. Returns False if it couldn't be sent right now.
+        """
+        spilled, packed = payload
+        datagram = msgpack.packb([channels, expires, spilled], use_bin_type=True) + packed
+
+        sender = self._get_sender()
+        try:
+            sender.sendto(datagram, self._socket_path(process))
+        except (BlockingIOError, InterruptedError):
+            with self._lock:
+                self.dropped_full += len(channels)
+            return False
+        except (FileNotFoundError, ConnectionRefusedError):
+            self._forget_process(process)
+            with self._lock:
+                self.dropped_unreachable += len(channels)
+            return True
+        except OSError as e:
+            if e.errno == errno.EMSGSIZE and spilled is None:
+                # The receiving end's limits are lower than ours; go by file.
+                return self._send_to(process, channels, self._spill(packed, expires), expires)
+            raise
+        with self._lock:
+            self.sent += 1
+        return True
+
+    def _forget_process(self, process):
+        """Drops a process that is gone from every group."""
+        groups = os.path.join(self.path, "groups")
+        marker = process + "!"
+        try:
+            directories = os.listdir(groups)
+        except FileNotFoundError:
+            return
+        for group in directories:
+            try:
+                members = os.listdir(os.path.join(groups, group))
+            except FileNotFoundError:
+                continue
+            for channel in members:
+                if marker in channel:
+                    try:
+                        os.unlink(os.path.join(groups, group, channel))
+                    except FileNotFoundError:
+                        pass
+        try:
+            os.unlink(self._socket_path(process))
+        except FileNotFoundError:
+            pass
+
+    # Groups
+
+    def _group_dir(self, group):
+        return os.path.join(self.path, "groups", group)
+
+    def _group_members(self, group):
+        """
+        The channels in group. The listing is cached until the directory
+        changes, which costs one stat() per group_send() instead of a scan.
+        """
+        directory = self._group_dir(group)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._members.pop(group, None)
+            return []
+
+        now = time.time()
+        with self._lock:
+            cached = self._members.get(group)
+        if cached is not None and cached[0] == mtime and now < cached[1]:
+            return cached[2]
+
+        members = []
+        oldest = now - self.group_expiry
+        # Directory mtimes are coarse: a change made in the same tick as the
+        # one we saw leaves mtime alone. Only trust a listing taken well after
+        # the last change.
+        refresh = now + self.group_expiry if now - mtime / 1e9 > MTIME_GRANULARITY else 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    joined = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if joined < oldest:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                members.append(entry.name)
+                refresh = min(refresh, joined + self.group_expiry)
+        with self._lock:
+            self._members[group] = (mtime, refresh, members)
+        return members
+
+    # Expiry
+
+    def _clean_expired(self):
+        """
+        Drops expired messages from every queue, and expired message files, at
+        most every CLEAN_INTERVAL.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_clean < CLEAN_INTERVAL:
+                return
+            self._last_clean = now
+            for channel, queue in list(self._channels.items()):
+                while queue and queue[0][0] < now:
+                    queue.popleft()
+                    self.dropped_expired += 1
+                if not queue:
+                    del self._channels[channel]
+
+        # A file's mtime is when its message expires; see _spill().
+        try:
+            entries = os.scandir(os.path.join(self.path, "messages"))
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < now:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _process_of(channel):
+        """The process a specific channel belongs to, or None for a general one."""
+        if "!" not in channel:
+            return None
+        return channel[: channel.index("!")].rsplit(".", 1)[-1]
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
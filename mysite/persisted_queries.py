@@ -0,0 +1,146 @@
+"""
+Automatic persisted queries (APQ), as spoken by Apollo's persisted-queries link.
+
+Instead of the full query text, a client sends only its sha256:
+
+{"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<hex>"}}}
+
+If the server knows that hash it runs the query stored under it. If not, it
+answers with a PersistedQueryNotFound error and the client sends the same
+request again with the query text included, which the server checks against
+the hash and stores for next time.
+
+The /graphql/ view (views.py) and the websocket consumer
+(snippets/consumer.py) share the one store below, so a query registered over
+one transport is known to the other. The store is an LRU bounded by
+GRAPHQL_PERSISTED_QUERIES_MAXSIZE and lives in process memory; a client
+whose hash was evicted, or that reaches another worker process, just
+registers the query again.
+
+https://www.apollographql.com/docs/apollo-server/performance/apq/
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from graphql.error import GraphQLError
+
+from snippets import metrics
+
+PERSISTED_QUERIES_MAXSIZE = getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_MAXSIZE', 1024)
+
+APQ_VERSION = 1
+
+
+class PersistedQueryNotFound(GraphQLError):
+    """The client sent a hash the server doesn't know. The client retries."""
+
+    def __init__(self):
+        super().__init__('PersistedQueryNotFound', extensions={'code': 'PERSISTED_QUERY_NOT_FOUND'})
+
+
+class PersistedQueryError(GraphQLError):
+    """The persistedQuery extension was malformed or didn't match the query."""
+
+    def __init__(self, message):
+        super().__init__(message, extensions={'code': 'BAD_USER_INPUT'})
+
+
+class PersistedQueryStore:
+    """
+Bounded, thread-safe LRU of sha256 hash -> query text.
+    """
+
+    def __init__(self, maxsize=PERSISTED_QUERIES_MAXSIZE):
+        self.maxsize = maxsize
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.registrations = 0
+        self.evictions = 0
+
+    def get(self, sha256_hash):
+        with self._lock:
+            query = self._queries.get(sha256_hash)
+            if query is None:
+                self.misses += 1
+            else:
+                self._queries.move_to_end(sha256_hash)
+                self.hits += 1
+            return query
+
+    def register(self, sha256_hash, query):
+        """Stores query under sha256_hash, which must really be its hash."""
+        if hashlib.sha256(query.encode('utf-8')).hexdigest() != sha256_hash:
+            raise PersistedQueryError('provided sha does not match query')
+
+        with self._lock:
+            if sha256_hash not in self._queries:
+                self.registrations += 1
+            self._queries[sha256_hash] = query
+            self._queries.move_to_end(sha256_hash)
+            while len(self._queries) > self.maxsize:
+                self._queries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+            self.hits = self.misses = self.registrations = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._queries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'registrations': self.registrations,
+                'evictions': self.evictions,
+            }
+
+
+persisted_queries = PersistedQueryStore()
+metrics.register('persisted_queries', persisted_queries.stats)
+
+
+def resolve_query(query, extensions, store=persisted_queries):
+    """
+Returns the query text to run for a request carrying query (possibly None)
+and extensions (a dict, a JSON string from a GET, or None).
+
+Requests without a persistedQuery extension come back unchanged.
+Raises PersistedQueryNotFound or PersistedQueryError.
+    """
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise PersistedQueryError('extensions must be a JSON object')
+
+    if not extensions:
+        return query
+    if not isinstance(extensions, dict):
+        raise PersistedQueryError('extensions must be a JSON object')
+
+    persisted = extensions.get('persistedQuery')
+    if not persisted:
+        return query
+
+    if not isinstance(persisted, dict) or persisted.get('version') != APQ_VERSION:
+        raise PersistedQueryError('Unsupported persistedQuery version')
+    sha256_hash = persisted.get('sha256Hash')
+    if not isinstance(sha256_hash, str):
+        raise PersistedQueryError('persistedQuery is missing sha256Hash')
+
+    if query:
+        store.register(sha256_hash, query)
+        return query
+
+    query = store.get(sha256_hash)
+    if query is None:
+        raise PersistedQueryNotFound()
+    return query
@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
+import hashlib
 import os
+import tempfile
 from pathlib import Path
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -141,11 +143,23 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 
-# In this simple example we use in-process in-memory Channel layer.
-# In a real-life cases you need Redis or something familiar.
+# Worker processes on this host share channels and groups over Unix domain
+# sockets in CONFIG["path"], with no broker. See mysite/channel_layer.py.
+# Across hosts you need Redis or something familiar.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+        "BACKEND": "mysite.channel_layer.UnixSocketChannelLayer",
+        "CONFIG": {
+            # One directory per checkout, kept short: socket paths are
+            # limited to 108 bytes.
+            "path": os.path.join(
+                tempfile.gettempdir(),
+                "snippets-channels-" + hashlib.sha1(str(BASE_DIR).encode()).hexdigest()[:8],
+            ),
+            "capacity": 100,  # messages per channel
+            "expiry": 60,  # seconds a message waits to be received
+            "group_expiry": 86400,  # seconds a channel stays in a group
+        },
     }
 }
 
@@ -158,6 +172,11 @@ GRAPHENE = {
     ],
 }
 
+GRAPHQL_JWT = {
+    # The user behind a token comes from the user cache; see snippets/usercache.py.
+    "JWT_GET_USER_BY_NATURAL_KEY_HANDLER": "snippets.usercache.get_user_by_natural_key",
+}
+
 # This is easy, but opens the server up to attack
 # CORS_ALLOW_ALL_ORIGINS = True
 
@@ -166,6 +185,62 @@ CORS_ORIGIN_WHITELIST = (
     'http://192.168.2.99:3000',
 )
 
+# whoami() keeps verified JWT payloads around rather than re-verifying the
+# same token on every request. Entries never outlive the token's own expiry.
+# See snippets/tokens.py.
+SNIPPETS_JWT_CACHE_MAXSIZE = 1024
+SNIPPETS_JWT_CACHE_TTL = 300  # seconds
+
+# Users found by websocket connections (by session) and by JWTs (by username)
+# are kept this long, unless they log out or their row changes first, which
+# every process hears about. See snippets/usercache.py.
+SNIPPETS_USER_CACHE_MAXSIZE = 4096
+SNIPPETS_USER_CACHE_TTL = 60  # seconds
+
+# Number of limitedSnippets pages kept per process, and for how long at most.
+# Writes also invalidate them, in every process. See snippets/cache.py.
+SNIPPETS_LIST_CACHE_MAXSIZE = 256
+SNIPPETS_LIST_CACHE_TTL = 60  # seconds
+
+# Number of parsed and validated query documents the /graphql/ view keeps.
+# 0 turns the cache off. See mysite/backend.py.
+GRAPHQL_DOCUMENT_CACHE_MAXSIZE = 512
+
+# Number of automatic persisted queries (hash -> query text) kept for the
+# /graphql/ view and the websocket consumer. See mysite/persisted_queries.py.
+GRAPHQL_PERSISTED_QUERIES_MAXSIZE = 1024
+
+# Number of rendered subscription notifications kept for sharing between
+# subscribers with the same document and visibility. See snippets/fanout.py.
+SUBSCRIPTION_PUBLISH_CACHE_MAXSIZE = 1024
+
+# Events for the same snippet within this many seconds reach subscribers as
+# one, e.g. a burst of updateSnippet mutations, but every event is then
+# delayed by up to that long. 0 sends every event as it happens. See
+# snippets/coalesce.py.
+SUBSCRIPTION_COALESCE_WINDOW = 0
+
+# Number of recent subscription events kept for clients that resume with
+# sinceSeq. See snippets/eventlog.py.
+SUBSCRIPTION_EVENT_LOG_SIZE = 1024
+
+# Subscription notifications queued per websocket connection for a client
+# that isn't keeping up, and what happens to more: 'drop_oldest',
+# 'coalesce' (by snippet) or 'disconnect'. See snippets/outbound.py.
+WEBSOCKET_SEND_QUEUE_LIMIT = 256
+WEBSOCKET_SEND_QUEUE_POLICY = 'drop_oldest'
+
+# Websocket connections taken on per process, in all and per logged-in user,
+# and subscriptions per connection; more are turned away. 0 means no limit.
+# Connections with no subscriptions are closed after WEBSOCKET_IDLE_TIMEOUT
+# seconds without a message, and clients get a keepalive every
+# WEBSOCKET_KEEPALIVE_EVERY seconds. See snippets/admission.py.
+WEBSOCKET_MAX_CONNECTIONS = 10000
+WEBSOCKET_MAX_CONNECTIONS_PER_USER = 20
+WEBSOCKET_MAX_SUBSCRIPTIONS_PER_CONNECTION = 20
+WEBSOCKET_IDLE_TIMEOUT = 300  # seconds
+WEBSOCKET_KEEPALIVE_EVERY = 30  # seconds
+
 AUTHENTICATION_BACKENDS = [
     "graphql_jwt.backends.JSONWebTokenBackend",
     "django.contrib.auth.backends.ModelBackend",
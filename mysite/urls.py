@@ -1,24 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include, re_path
-from graphene_django.views import GraphQLView
 from django.views.decorators.csrf import csrf_exempt
 from .schema import schema
 
 from django.views.generic import RedirectView
 from django.contrib.staticfiles.storage import staticfiles_storage
 
-from graphql.backend import GraphQLCoreBackend
-
-
-# Define a CustomCoreBackend to get around the following message:
-# "Subscriptions are not allowed. You will need to either use the subscribe 
-# function or pass allow_subscriptions=True"
-# https://github.com/eamigo86/graphene-django-subscriptions/issues/7
-class GraphQLCustomCoreBackend(GraphQLCoreBackend):
-    def __init__(self, executor=None):
-        # type: (Optional[Any]) -> None
-        super().__init__(executor)
-        self.execute_params['allow_subscriptions'] = True
+from .backend import graphql_backend
+from .views import PersistedQueryGraphQLView
 
 
 urlpatterns = [
@@ -45,9 +34,9 @@ urlpatterns = [
     # See curltest.sh for additional details about csrf_exempt().
     # Can turn off access to graphiql by setting to False, which basicall makes this
     # just a dumb endpoint -- I think.
-    path('graphql/', csrf_exempt(GraphQLView.as_view(
+    path('graphql/', csrf_exempt(PersistedQueryGraphQLView.as_view(
         graphiql=True, 
         schema=schema, 
-        backend=GraphQLCustomCoreBackend()
+        backend=graphql_backend
     ))),
 ]
@@ -0,0 +1,24 @@
+from graphene_django.views import GraphQLView
+from graphql.execution import ExecutionResult
+
+from .persisted_queries import PersistedQueryNotFound, PersistedQueryError, resolve_query
+
+
+class PersistedQueryGraphQLView(GraphQLView):
+    """
+GraphQLView that also accepts automatic persisted queries, i.e. a sha256 in
+extensions.persistedQuery in place of the query text.
+See persisted_queries.py.
+    """
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        try:
+            query = resolve_query(query, extensions)
+        except PersistedQueryNotFound as e:
+            # Not invalid: a 200 tells the client to send the query text along.
+            return ExecutionResult(errors=[e])
+        except PersistedQueryError as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        return super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
@@ -5,15 +5,10 @@ def whoami(info):
     """
 Determines who the user is based upon the passed header token.
 If there is no HTTP_AUTHORIZATION header, default to back end user value.
-    """
 
-    query = '''
-mutation mutVerifyJWT($token: String!) {
-  verifyToken(token: $token) {
-    payload
-  }
-}
-'''
+The token is verified at most once per request; the payload is stashed on
+info.context as jwt_payload for anyone else who asks during the same request.
+    """
 
     # default value from the back end; could be AnonymousUser
     username = info.context.user
@@ -23,22 +18,25 @@ mutation mutVerifyJWT($token: String!) {
         auth_string = info.context.META['HTTP_AUTHORIZATION']
 
         if auth_string.startswith('JWT '):
-            print(f"Splitting auth_string [{auth_string}]")
-            jwt, token = auth_string.split(' ')
-
-            # Pass the token back to get the authenticated username.
             # Note the import within the function else bad things happen:
             #       raise AppRegistryNotReady("Apps aren't loaded yet.")
-            from mysite import schema
-            result = schema.schema.execute(
-                query,
-                context=info.context,
-                variables={"token": token}
-            )
-            username = result.data['verifyToken']['payload']['username']
+            from .tokens import verify_token, get_username_from_payload
+
+            payload = getattr(info.context, 'jwt_payload', None)
+            if payload is None:
+                if settings.DEBUG:
+                    print(f"Splitting auth_string [{auth_string}]")
+                jwt, token = auth_string.split(' ')
+
+                # Verify the token directly rather than running a verifyToken
+                # mutation back through the schema. See tokens.py.
+                payload = verify_token(token, info.context)
+                info.context.jwt_payload = payload
+
+            username = get_username_from_payload(payload)
             if settings.DEBUG:
-                print(f"whoami(): Username from mutVerifyJWT [{username}]")
+                print(f"whoami(): Username from JWT payload [{username}]")
                 print(f"whoami(): Username from info.context.user [{info.context.user}]")
                 print("")
 
-    return username
\ No newline at end of file
+    return username
@@ -0,0 +1,143 @@
+"""
+How many websocket connections MyGraphqlWsConsumer (consumer.py) takes on,
+and for how long it keeps those that do nothing.
+
+A new connection is turned away when WEBSOCKET_MAX_CONNECTIONS are already
+open in this process, or when its user, if logged in, already has
+WEBSOCKET_MAX_CONNECTIONS_PER_USER open. It is accepted and at once closed
+with CLOSE_TRY_AGAIN_LATER, rather than refused at the handshake, so that
+the client can tell "busy" from "broken" and back off instead of retrying
+straight away. A START for a subscription past
+WEBSOCKET_MAX_SUBSCRIPTIONS_PER_CONNECTION gets an error, like any failed
+operation, and the connection stays open.
+
+A connection with no subscriptions that hasn't sent anything for
+WEBSOCKET_IDLE_TIMEOUT seconds is closed with CLOSE_IDLE. One with
+subscriptions is never idle as far as the server can tell; the subscription
+page closes its own connection while its tab is hidden (transactions.js).
+WEBSOCKET_KEEPALIVE_EVERY sets how often graphql-ws "ka" messages go to
+clients that sent connection_init, which keeps proxies from cutting quiet
+connections.
+
+Connections whose peer has gone away without closing are for the ASGI
+server to notice, by websocket pings: daphne (and channels' runserver) with
+--ping-interval and --ping-timeout, uvicorn with --ws-ping-interval and
+--ws-ping-timeout.
+
+0 (or None) turns a limit off. The counts are per process.
+"""
+import threading
+import weakref
+
+from django.conf import settings
+
+from . import metrics
+
+# Overridable from settings.py.
+MAX_CONNECTIONS = getattr(settings, 'WEBSOCKET_MAX_CONNECTIONS', 0)
+MAX_CONNECTIONS_PER_USER = getattr(settings, 'WEBSOCKET_MAX_CONNECTIONS_PER_USER', 0)
+MAX_SUBSCRIPTIONS_PER_CONNECTION = getattr(settings, 'WEBSOCKET_MAX_SUBSCRIPTIONS_PER_CONNECTION', 0)
+IDLE_TIMEOUT = getattr(settings, 'WEBSOCKET_IDLE_TIMEOUT', 0)  # seconds
+KEEPALIVE_EVERY = getattr(settings, 'WEBSOCKET_KEEPALIVE_EVERY', None)  # seconds
+
+# Close codes. daphne sends no codes between 1001 and 2999, so 1013 (Try
+# Again Later) and 1001 (Going Away) are moved into the application's range.
+CLOSE_TRY_AGAIN_LATER = 4013
+CLOSE_IDLE = 4001
+
+
+class Admission:
+    """
+Thread-safe register of the open connections (MyGraphqlWsConsumer
+instances), by user, that says whether one more may open. Connections are
+held weakly, so one that is never released doesn't count for ever.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_connections_per_user=MAX_CONNECTIONS_PER_USER,
+                 max_subscriptions=MAX_SUBSCRIPTIONS_PER_CONNECTION, idle_timeout=IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_connections_per_user = max_connections_per_user
+        self.max_subscriptions = max_subscriptions
+        self.idle_timeout = idle_timeout
+        self._connections = weakref.WeakSet()
+        self._by_user = {}  # user pk -> WeakSet of connections
+        self.subscriptions = 0
+        self.peak_connections = 0
+        self.rejected_connections = 0
+        self.rejected_user_connections = 0
+        self.rejected_subscriptions = 0
+        self.reaped = 0
+        self._lock = threading.Lock()
+
+    def admit(self, connection, user_pk=None):
+        """
+Registers connection, for the user with user_pk if it is logged in, unless
+that would take it past a limit. Returns whether it was registered.
+        """
+        with self._lock:
+            if self.max_connections and len(self._connections) >= self.max_connections:
+                self.rejected_connections += 1
+                return False
+            if user_pk is not None:
+                connections = self._by_user.get(user_pk)
+                if (self.max_connections_per_user and connections is not None
+                        and len(connections) >= self.max_connections_per_user):
+                    self.rejected_user_connections += 1
+                    return False
+                self._by_user.setdefault(user_pk, weakref.WeakSet()).add(connection)
+            self._connections.add(connection)
+            self.peak_connections = max(self.peak_connections, len(self._connections))
+            return True
+
+    def release(self, connection, user_pk=None):
+        with self._lock:
+            self._connections.discard(connection)
+            connections = self._by_user.get(user_pk)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self._by_user[user_pk]
+
+    def admit_subscription(self, subscriptions):
+        """Whether a connection with this many subscriptions may start another."""
+        if self.max_subscriptions and subscriptions >= self.max_subscriptions:
+            with self._lock:
+                self.rejected_subscriptions += 1
+            return False
+        return True
+
+    def subscribed(self, count=1):
+        """Counts subscriptions started, or ended if count is negative."""
+        with self._lock:
+            self.subscriptions += count
+
+    def count_reaped(self):
+        with self._lock:
+            self.reaped += 1
+
+    def __len__(self):
+        return len(self._connections)
+
+    def stats(self):
+        with self._lock:
+            connections = list(self._connections)
+            users = [len(user_connections) for user_connections in self._by_user.values()]
+            return {
+                'max_connections': self.max_connections,
+                'max_connections_per_user': self.max_connections_per_user,
+                'max_subscriptions_per_connection': self.max_subscriptions,
+                'idle_timeout': self.idle_timeout,
+                'connections': len(connections),
+                'peak_connections': self.peak_connections,
+                'users': len(users),
+                'most_user_connections': max(users, default=0),
+                'subscriptions': self.subscriptions,
+                'rejected_connections': self.rejected_connections,
+                'rejected_user_connections': self.rejected_user_connections,
+                'rejected_subscriptions': self.rejected_subscriptions,
+                'reaped': self.reaped,
+            }
+
+
+admission = Admission()
+metrics.register('websocket_connections', admission.stats)
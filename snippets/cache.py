@@ -0,0 +1,166 @@
+"""
+Result cache for limitedSnippets.
+
+Everyone in the same visibility class (see visibility.py) gets the same
+answer for the same arguments, so the resolved page is kept per
+(visibility class, arguments, selected fields) in a bounded LRU.
+
+The mutations call invalidate() after every write with the snippet's owner
+and whether it is, or was, public. A private snippet is only visible to its
+owner and SuperUser, so only those entries go; a public one is visible to
+everybody, so everything goes.
+
+The cache lives in process memory, one copy per worker process. invalidate()
+drops entries in its own process straight away, and again once the write is
+committed, when it also tells the other processes over the channel layer
+(the "snippets.cache" group; see mysite/channel_layer.py). Each process
+listens from a thread of its own (see listener.py), started by its first
+limitedSnippets read. Nothing is cached until that thread has joined the
+group, as invalidations could be missed before then, but no read waits for
+it. An invalidation that is lost on the way (a full channel) is made up for
+by entries living at most SNIPPETS_LIST_CACHE_TTL seconds.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+
+from . import metrics
+from .listener import GroupListener
+from .visibility import affected_classes
+
+# Overridable from settings.py.
+LIST_CACHE_MAXSIZE = getattr(settings, 'SNIPPETS_LIST_CACHE_MAXSIZE', 256)
+LIST_CACHE_TTL = getattr(settings, 'SNIPPETS_LIST_CACHE_TTL', 60)  # seconds
+
+INVALIDATION_GROUP = "snippets.cache"
+
+
+class VisibilityCache:
+    """
+Bounded, thread-safe LRU whose keys start with a visibility class, each entry
+living for at most ttl seconds. Invalidations go to the other processes over
+channel_layer (by default the one in settings.py), if there is one.
+    """
+
+    def __init__(self, maxsize=LIST_CACHE_MAXSIZE, ttl=LIST_CACHE_TTL, channel_layer=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._listener = GroupListener(INVALIDATION_GROUP, self._on_message, channel_layer, name="snippets-cache")
+        # Tells this cache's own invalidations apart when they come back.
+        self._origin = uuid.uuid4().hex
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        # Bumped by every invalidate(), so that a result computed from data
+        # read before a write can't be stored after that write invalidated it.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+
+    def get_or_set(self, key, compute):
+        """
+Returns the cached value for key, or calls compute() and caches that.
+key[0] must be the visibility class.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            generation = self._generation
+
+        # Nothing is cached before we hear about writes.
+        listening = self._listener.joined()
+        value = compute()
+
+        with self._lock:
+            if listening and generation == self._generation:
+                self._entries[key] = (time.time() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        return value
+
+    def invalidate(self, owner, public):
+        """
+Drops the entries that could contain a snippet owned by owner, here and,
+once the write is committed, in every process.
+public is True if the snippet is public now or was before the write.
+        """
+        self._drop(owner, public)
+
+        def on_commit():
+            # In case it was read again before the write was committed.
+            self._drop(owner, public)
+            self._broadcast(owner, public)
+
+        transaction.on_commit(on_commit)
+
+    def _drop(self, owner, public):
+        classes = affected_classes(owner, public)
+        with self._lock:
+            self._generation += 1
+            if classes is None:
+                doomed = list(self._entries)
+            else:
+                doomed = [key for key in self._entries if key[0] in classes]
+            for key in doomed:
+                del self._entries[key]
+            self.invalidations += len(doomed)
+
+    def _broadcast(self, owner, public):
+        layer = self._listener.layer()
+        if layer is None:
+            return
+        async_to_sync(layer.group_send)(INVALIDATION_GROUP, {
+            "type": "cache.invalidate",
+            "origin": self._origin,
+            "owner": owner,
+            "public": public,
+        })
+
+    def _on_message(self, message):
+        if message.get("origin") != self._origin:
+            with self._lock:
+                self.remote_invalidations += 1
+            self._drop(message["owner"], message["public"])
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+            self.remote_invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'remote_invalidations': self.remote_invalidations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+limited_snippets_cache = VisibilityCache()
+metrics.register('limited_snippets_cache', limited_snippets_cache.stats)
@@ -0,0 +1,199 @@
+"""
+Coalescing of subscription events for the same snippet.
+
+A client editing a snippet sends many updateSnippet mutations a second, and
+each one used to reach every subscriber. Instead, the first event for a
+snippet opens a window of SUBSCRIPTION_COALESCE_WINDOW seconds, and what
+else happens to that snippet inside the window is merged into it:
+
+    CREATE, then UPDATE   ->  CREATE, with the latest state
+    UPDATE, then UPDATE   ->  UPDATE, with the latest state
+    UPDATE, then DELETE   ->  DELETE
+    CREATE, then DELETE   ->  nothing at all
+
+An UPDATE merged from UPDATEs names every field any of them changed, and
+the version the first one applied to (see notification_data() in
+subscriptions.py). When the window closes, the one event left goes out. Anything else (e.g. a
+CREATE after a DELETE) first sends what is pending and then opens a new
+window. The window is counted from the first event, not the last, so a
+snippet that never stops changing is still heard about once per window.
+
+Events about many snippets at once (createSnippets, etc.) are not held back,
+but whatever is pending for their snippets is sent first, so subscribers see
+everything in order.
+
+Each subscription class coalesces on its own, and each process does too: two
+workers editing the same snippet send an event each.
+
+It is off by default (a window of 0), and every event goes out as it
+happens. Turned on, it delays every event by up to the window, even one
+that nothing else is merged into. Events still pending when the process
+exits are lost: the interpreter is past sending them by then.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+COALESCE_WINDOW = getattr(settings, 'SUBSCRIPTION_COALESCE_WINDOW', 0)
+
+# merge(first, then) results other than an event type.
+CANCEL = object()
+SEPARATE = object()
+
+_MERGED = {
+    ("CREATE", "UPDATE"): "CREATE",
+    ("CREATE", "DELETE"): CANCEL,
+    ("UPDATE", "UPDATE"): "UPDATE",
+    ("UPDATE", "DELETE"): "DELETE",
+}
+
+
+def merge(first, then):
+    """
+The event type standing for `first` followed by `then`, CANCEL if the two
+cancel out, or SEPARATE if they can't be merged.
+    """
+    return _MERGED.get((first, then), SEPARATE)
+
+
+def merge_data(merged, first, then):
+    """
+The data (notification_data()) of the event `merged` from events with data
+first and then: the latest state, plus, for an UPDATE that both were, what
+either changed since the first one's base version.
+    """
+    if merged == "UPDATE" and "changed" in first and "changed" in then:
+        changed = sorted(set(first["changed"]) | set(then["changed"]))
+        return {**then, "changed": changed, "base_version": first["base_version"]}
+    return {name: value for name, value in then.items() if name not in ("changed", "base_version")}
+
+
+class Coalescer:
+    """
+Holds one pending event per key (a subscription class and a snippet id) for
+`window` seconds, merging later events for the key into it. A background
+thread sends each one by calling its emit(trans_type, sender, data) when its
+window closes.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self.window = window
+        self._pending = OrderedDict()
+        self._lock = threading.Condition()
+        # Held while sending, so that events go out in the order they were made.
+        self._emitting = threading.RLock()
+        self._thread = None
+        self.events = 0
+        self.emitted = 0
+        self.merged = 0
+        self.cancelled = 0
+
+    def add(self, key, trans_type, sender, data, emit):
+        """Adds an event for key, to be sent by emit(trans_type, sender, data)."""
+        if self.window <= 0:
+            emit(trans_type, sender, data)
+            return
+
+        with self._emitting:
+            with self._lock:
+                self.events += 1
+                pending = self._pending.get(key)
+                merged = SEPARATE if pending is None else merge(pending[1], trans_type)
+                if merged is CANCEL:
+                    del self._pending[key]
+                    self.cancelled += 1
+                    return
+                if merged is not SEPARATE:
+                    pending[1:4] = [merged, sender, merge_data(merged, pending[3], data)]
+                    self.merged += 1
+                    return
+                if pending is not None:
+                    del self._pending[key]
+
+            if pending is not None:
+                self._emit(pending)
+
+            with self._lock:
+                self._pending[key] = [time.monotonic() + self.window, trans_type, sender, data, emit]
+                self._start()
+                self._lock.notify()
+
+    def passthrough(self, keys, send):
+        """
+Calls send() now, for an event that isn't coalesced, after sending whatever
+is pending for keys.
+        """
+        with self._emitting:
+            self.flush(keys)
+            send()
+
+    def flush(self, keys=None):
+        """Sends what is pending for keys (all of it by default) now."""
+        with self._emitting:
+            with self._lock:
+                if keys is None:
+                    keys = list(self._pending)
+                due = [self._pending.pop(key) for key in keys if key in self._pending]
+            for pending in due:
+                self._emit(pending)
+
+    def _emit(self, pending):
+        _, trans_type, sender, data, emit = pending
+        with self._lock:
+            self.emitted += 1
+        emit(trans_type, sender, data)
+
+    def _start(self):
+        # Called with self._lock held.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="coalesce", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+                # Windows are all the same length, so the oldest closes first.
+                key, pending = next(iter(self._pending.items()))
+                delay = pending[0] - time.monotonic()
+                if delay > 0:
+                    self._lock.wait(delay)
+                    continue
+            with self._emitting:
+                with self._lock:
+                    if self._pending.get(key) is not pending:
+                        continue
+                    del self._pending[key]
+                try:
+                    self._emit(pending)
+                except Exception as e:
+                    # Keep the thread alive for the next event.
+                    print("coalesced event for {} not sent: {!r}".format(key, e))
+
+    def clear(self):
+        """Forgets what is pending, without sending it."""
+        with self._lock:
+            self._pending.clear()
+            self.events = self.emitted = self.merged = self.cancelled = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window': self.window,
+                'pending': len(self._pending),
+                'events': self.events,
+                'emitted': self.emitted,
+                'merged': self.merged,
+                'cancelled': self.cancelled,
+                # Events that subscribers never had to hear about.
+                'saved': self.events - self.emitted - len(self._pending),
+            }
+
+
+coalescer = Coalescer()
+metrics.register('subscription_coalescer', coalescer.stats)
@@ -1,11 +1,32 @@
+import asyncio
+import time
+
 import graphene
-import channels
 import channels_graphql_ws
+import rx
+
+from channels_graphql_ws.serializer import Serializer
+from graphql import set_default_backend
+from graphql.error import GraphQLError
 
+from mysite.backend import graphql_backend
+from mysite.persisted_queries import PersistedQueryNotFound, PersistedQueryError, resolve_query
 from mysite.schema import Mutation, Subscription
+from .admission import CLOSE_IDLE, CLOSE_TRY_AGAIN_LATER, KEEPALIVE_EVERY, admission
+from .eventlog import RESYNC, event_log, resume_request
+from .fanout import SKIP, data_payload, document_key, event_key, publish_cache
+from .outbound import COALESCE, SendQueue
+from .usercache import get_user
+from .wire import GRAPHQL_WS, WIRE_FORMATS, negotiate
+from .visibility import PUBLIC, visibility_of_user
 
 from django.conf import settings
 
+# channels_graphql_ws runs every operation through graphql.graphql(), which
+# takes the default backend. Make that the caching one the /graphql/ view
+# uses, so known documents skip parsing and validation here too.
+set_default_backend(graphql_backend)
+
 
 # ----------------------------------------------------------- GRAPHQL WEBSOCKET CONSUMER
 
@@ -26,6 +47,57 @@ For example, the client may send an authToken that can be handled here.
         if "authToken" in payload:
             print("Client passed authToken of [{}]".format(payload["authToken"]))
 
+        # connect() has already replaced scope["user"] with the user itself.
+
+        # Which subprotocols are available?
+        # For example, soap, wamp, or even json.
+        # Subprotocols are additional restrictions and structure.
+        # connect() picked one of them to speak; see wire.py.
+        subprotocols = self.scope['subprotocols']
+        if settings.DEBUG and subprotocols:
+            print("Available subprotocols: {}".format(self.scope['subprotocols']))
+            print("Speaking: {}".format(self._wire.subprotocol))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Operation id -> fanout.document_key() of each active subscription.
+        self._documents = {}
+        # Operation id -> (list the rendered notification is appended to, its
+        # send queue key), while _notify() is rendering one for it.
+        self._renders = {}
+        # What goes to the client, and the task writing it out; see outbound.py.
+        self._send_queue = None
+        self._writer = None
+        # Operation id -> event set once the subscription's stream is
+        # observed, which its notifier waits for, and the events it is to
+        # replay first with the seq they go up to; see eventlog.py.
+        self._observed = {}
+        self._replays = {}
+        # How messages are encoded; see wire.py.
+        self._wire = WIRE_FORMATS[GRAPHQL_WS]
+        # Whether admission.py let the connection in, for whom, and the task
+        # closing it when idle.
+        self._admitted = False
+        self._user_pk = None
+        # Operation ids of the subscriptions admission.py counts.
+        self._subscribed = set()
+        self._last_received = None
+        self._reaper = None
+
+    async def connect(self):
+        """
+Accepts the connection with the first subprotocol the client offers that
+wire.py knows, e.g. graphql-ws+msgpack, where GraphqlWsConsumer only knows
+graphql-ws, and closes it again straight away if admission.py says there are
+too many. Otherwise it is closed once it has been idle for long enough.
+        """
+        self._assert_thread()
+        wire = negotiate(self.scope["subprotocols"])
+        assert wire is not None, (
+            f"WebSocket client does not request any of the subprotocols {list(WIRE_FORMATS)}!"
+        )
+        self._wire = wire
+
         # Use auxiliary Channels function `get_user` to replace an
         # instance of `channels.auth.UserLazyObject` with a native
         # Django user object (user model instance or `AnonymousUser`)
@@ -35,13 +107,279 @@ For example, the client may send an authToken that can be handled here.
         # type Graphene Django type `DjangoObjectType` does not accept
         # `channels.auth.UserLazyObject` instances.
         # https://github.com/datadvance/DjangoChannelsGraphqlWs/issues/23
-        self.scope["user"] = await channels.auth.get_user(self.scope)
+        # The middleware has usually just looked the user up; see usercache.py.
+        # It is done here rather than in on_connect(), which only runs for
+        # clients that send connection_init, so that the user's connections
+        # can be counted.
+        user = self.scope["user"] = await get_user(self.scope)
+        self._user_pk = user.pk if user.is_authenticated else None
 
-        # Which subprotocols are available?
-        # For example, soap, wamp, or even json.
-        # Subprotocols are additional restrictions and structure.
-        subprotocols = self.scope['subprotocols']
-        if settings.DEBUG and subprotocols:
-            print("Available subprotocols: {}".format(self.scope['subprotocols']))
+        self._admitted = admission.admit(self, self._user_pk)
+        await self.accept(subprotocol=wire.subprotocol)
+        if not self._admitted:
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
+            return
+
+        self._last_received = time.monotonic()
+        if admission.idle_timeout:
+            self._reaper = asyncio.ensure_future(self._reap(admission.idle_timeout))
+
+    async def _reap(self, idle_timeout):
+        """Closes the connection once it has no subscriptions and has been idle for idle_timeout."""
+        while True:
+            idle = time.monotonic() - self._last_received
+            if idle >= idle_timeout and not self._subscribed:
+                break
+            await asyncio.sleep(idle_timeout - idle if idle < idle_timeout else idle_timeout)
+        admission.count_reaped()
+        await self.close(code=CLOSE_IDLE)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """Also takes binary messages, in the negotiated encoding."""
+        if not self._admitted:
+            return  # Being closed.
+        self._last_received = time.monotonic()
+        if bytes_data is not None and self._wire.binary:
+            await self.receive_json(self._wire.decode(bytes_data))
+            return
+        await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        await self.send(**self._wire.encode(content), close=close)
+
+    async def _on_gql_start(self, operation_id, payload):
+        """
+Handle the START message, first swapping an automatic persisted query's
+hash for its text. See mysite/persisted_queries.py.
+
+GraphqlWsConsumer has no public hook between receiving a START and running
+it, so this wraps the private handler.
+        """
+        try:
+            query = resolve_query(payload.get("query"), payload.get("extensions"))
+        except (PersistedQueryNotFound, PersistedQueryError) as e:
+            # Answer like any other failed query; the client retries with the text.
+            await self._send_gql_data(operation_id, None, [e])
+            await self._send_gql_complete(operation_id)
+            return
+
+        # Kept if this turns out to be a subscription; see _notify().
+        self._documents[operation_id] = document_key(
+            query, payload.get("operationName"), payload.get("variables") or {}
+        )
+        try:
+            await super()._on_gql_start(operation_id, {**payload, "query": query})
+        finally:
+            if operation_id not in self._subscribed:
+                self._documents.pop(operation_id, None)
+            observed = self._observed.get(operation_id)
+            if observed is not None:
+                observed.set()
+
+    async def _on_gql_stop(self, operation_id):
+        await super()._on_gql_stop(operation_id)
+        self._documents.pop(operation_id, None)
+        self._observed.pop(operation_id, None)
+        self._replays.pop(operation_id, None)
+        if operation_id in self._subscribed:
+            self._subscribed.remove(operation_id)
+            admission.subscribed(-1)
+
+    async def disconnect(self, code):
+        await super().disconnect(code)
+        admission.release(self, self._user_pk)
+        admission.subscribed(-len(self._subscribed))
+        self._subscribed.clear()
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self._writer is not None:
+            self._writer.cancel()
+        if self._send_queue is not None:
+            self._send_queue.close()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Queues a frame for the client; see outbound.py."""
+        self._queue_frame((text_data, bytes_data, close))
+
+    async def _send_notification(self, operation_id, key, payload_json):
+        """
+Queues a subscription notification, given its payload as rendered by
+fanout.data_payload(). It may be dropped or coalesced if the client isn't
+keeping up, and the connection is closed if the policy says so.
+        """
+        if self._send_queue is not None and self._send_queue.overflowed:
+            return  # Already closing.
+        text_data, bytes_data = self._wire.data_frame(operation_id, payload_json)
+        if not self._queue_frame((text_data, bytes_data, False), notification=True, key=key):
+            self._writer.cancel()
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
+
+    def _queue_frame(self, frame, notification=False, key=()):
+        if self._send_queue is None:
+            self._send_queue = SendQueue(self.channel_name)
+            self._writer = asyncio.ensure_future(self._write())
+        return self._send_queue.put(frame, notification=notification, key=key)
+
+    async def _write(self):
+        """Sends the queued frames, in order, as fast as the client takes them."""
+        while True:
+            text_data, bytes_data, close = await self._send_queue.get()
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def _register_subscription(self, operation_id, groups, publish_callback, unsubscribed_callback):
+        """
+Registers the subscription as GraphqlWsConsumer does, through
+_add_subscription(), but with a notifier that goes through _notify(), so
+that subscribers with the same document and visibility share one rendering
+of each event. See fanout.py.
+
+A subscription resuming with sinceSeq is first sent the events it missed,
+or told to resync. See eventlog.py. One past the connection's limit of
+subscriptions gets an error instead, unless it reuses the operation id of
+one it has already. See admission.py.
+        """
+        self._assert_thread()
+        resume = resume_request.get()
+        resume_request.set(None)
+        if operation_id not in self._subscribed and not admission.admit_subscription(len(self._subscribed)):
+            raise GraphQLError("Too many subscriptions on this connection")
+
+        # Nothing triggered before _on_gql_start() observes the stream would
+        # reach the client, so the notifier waits for that.
+        self._observed[operation_id] = asyncio.Event()
+        stream, waitlist = self._add_subscription(operation_id, groups, publish_callback, unsubscribed_callback)
+        if operation_id not in self._subscribed:
+            self._subscribed.add(operation_id)
+            admission.subscribed()
+
+        # This process's event log hears every event from here on.
+        waitlist.append(event_log.listen())
+        await asyncio.wait(waitlist)
+
+        # Anything from here on arrives live; what came before is replayed.
+        if resume is not None:
+            subscription, plain_groups, since_seq, since_stream = resume
+            await event_log.caught_up()
+            payloads, replayed_to = event_log.since(subscription, plain_groups, since_seq, since_stream)
+            if payloads is RESYNC:
+                payloads, replayed_to = [event_log.resync_payload()], None
+            self._replays[operation_id] = ([Serializer.serialize(payload) for payload in payloads], replayed_to)
+
+        return stream
+
+    def _add_subscription(self, operation_id, groups, publish_callback, unsubscribed_callback):
+        """
+The part of GraphqlWsConsumer._register_subscription() up to its await, as
+in channels_graphql_ws 0.8.0 (pinned in requirements.txt), with _notifier()
+for its notifier. Returns the stream and the group_add()s to wait for. Keep
+it in step with the library; tests/test_consumer.py fails when that changes.
+        """
+        # The subject we will trigger on the `broadcast` message.
+        trigger = rx.subjects.Subject()
+
+        notification_queue = asyncio.Queue(maxsize=self.subscription_notification_queue_limit)
+
+        # Do not notify the client when `publish` returns `SKIP`.
+        stream = trigger.map(publish_callback).filter(  # pylint: disable=no-member
+            lambda publish_returned: publish_returned is not self.SKIP
+        )
+
+        # NOTE: Update of `_sids_by_group` & `_subscriptions` must be
+        # atomic i.e. without `awaits` in between.
+        waitlist = []
+        for group in groups:
+            self._sids_by_group.setdefault(group, []).append(operation_id)
+            waitlist.append(self._channel_layer.group_add(group, self.channel_name))
+        notifier_task = self._spawn_background_task(self._notifier(operation_id, trigger, notification_queue))
+        self._subscriptions[operation_id] = self._SubInf(
+            groups=groups,
+            sid=operation_id,
+            unsubscribed_callback=unsubscribed_callback,
+            notification_queue=notification_queue,
+            notifier_task=notifier_task,
+        )
+        return stream, waitlist
+
+    async def _notifier(self, operation_id, trigger, notification_queue):
+        """Watch the notification queue and notify the client, after any replay."""
+        self._assert_thread()
+        await self._observed[operation_id].wait()
+        replay, replayed_to = self._replays.pop(operation_id, ((), None))
+        for payload in replay:
+            await self._notify(operation_id, trigger, payload)
+        while True:
+            payload = await notification_queue.get()
+            if replayed_to is not None:
+                # Live events up to this seq were already in the replay.
+                data = Serializer.deserialize(payload)
+                if (event_log.position(data)["seq"] or 0) <= replayed_to:
+                    notification_queue.task_done()
+                    continue
+                replayed_to = None
+            await self._notify(operation_id, trigger, payload)
+            notification_queue.task_done()
+
+    async def _notify(self, operation_id, trigger, payload):
+        """
+Sends the client the notification for one broadcast payload, rendering it
+(running publish() and the selection set) only if no other subscriber with
+the same key has.
+        """
+        def publish():
+            # The deserialization runs in the worker thread as well.
+            trigger.on_next(Serializer.deserialize(payload))
+
+        document = self._documents.get(operation_id)
+        if document is None:
+            await self._run_in_worker(publish)
+            return
+
+        user = self.scope.get("user")
+        visibility = visibility_of_user(user) if user is not None else PUBLIC
+        authenticated = user is not None and user.is_authenticated
+        event = Serializer.deserialize(payload) if authenticated or self._coalescing() else {}
+        # publish() skips a user's own changes, so the sender can't share.
+        is_sender = bool(authenticated and event.get("sender") == user.username)
+        # Queued notifications about the same snippet may replace each other.
+        snippet = event.get("snippet")
+        send_key = (operation_id, snippet["id"]) if snippet else ()
+
+        sent = False
+
+        async def render():
+            # The usual path, which also sends it to this client.
+            nonlocal sent
+            sent = True
+            rendered = []
+            self._renders[operation_id] = (rendered, send_key)
+            try:
+                await self._run_in_worker(publish)
+            finally:
+                del self._renders[operation_id]
+            return rendered[0] if rendered else SKIP
+
+        key = (event_key(payload), document, visibility, is_sender)
+        rendered = await publish_cache.get_or_render(key, render)
+        if not sent and rendered is not SKIP:
+            await self._send_notification(operation_id, send_key, rendered)
+
+    def _coalescing(self):
+        return self._send_queue is not None and self._send_queue.policy == COALESCE
+
+    async def _send_gql_data(self, operation_id, data, errors):
+        """
+Also hands a notification being rendered by _notify() back to it, and
+queues it as a notification.
+        """
+        render = self._renders.get(operation_id)
+        if render is None:
+            await super()._send_gql_data(operation_id, data, errors)
+            return
+        rendered, send_key = render
+        payload_json = data_payload(data, [self._format_error(e) for e in errors or []])
+        rendered.append(payload_json)
+        await self._send_notification(operation_id, send_key, payload_json)
+
+    send_keepalive_every = KEEPALIVE_EVERY
 
     schema = graphene.Schema(subscription=Subscription, mutation=Mutation)
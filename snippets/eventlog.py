@@ -0,0 +1,216 @@
+"""
+Sequence numbers for subscription events, and replay of the ones a client
+missed.
+
+Events are numbered where they are delivered: each worker process numbers
+them in the order they reach it, in its own sequence, and keeps them, with
+their routes (see groups.py), in a ring buffer of the last
+SUBSCRIPTION_EVENT_LOG_SIZE events. Notifications carry the number as `seq`,
+and the sequence's name as `stream`, so what a client sees is always the
+stream of the process it is connected to, whichever process the events
+came from.
+
+To that end, broadcast_routed() gives every event an id and also sends it
+whole, once, to the "snippets.events" group, where each process with
+subscribers listens (see listener.py). That way a process has every event,
+not just those for groups someone in it had joined. An event is numbered on
+first sight, from that group or from a subscriber's notification, and is
+the same number for every subscriber in the process.
+
+A client that reconnects subscribes with sinceSeq (and stream) set to the
+last notification it saw. It first gets the events after that one which it
+would have been sent, through publish() as usual, and then live events. If
+the buffer no longer goes back that far, or the stream is another one (the
+server restarted, or the client landed on another worker process), it gets
+a single notification with resync set instead, and should refetch in full.
+Resuming works as long as clients come back to the same worker, e.g. with a
+sticky load balancer.
+"""
+import asyncio
+import concurrent.futures
+import threading
+import uuid
+from collections import deque
+from contextvars import ContextVar
+
+from asgiref.sync import async_to_sync
+from channels_graphql_ws.serializer import Serializer
+from django.conf import settings
+
+from . import metrics
+from .listener import GroupListener
+
+EVENT_LOG_SIZE = getattr(settings, 'SUBSCRIPTION_EVENT_LOG_SIZE', 1024)
+
+EVENTS_GROUP = "snippets.events"
+
+# How long a replay waits for this process to have taken in the events that
+# reached it before the client resumed.
+CATCH_UP_TIMEOUT = 1.0  # seconds
+
+# Set by subscribe() for the consumer to pick up when it registers the
+# subscription: (subscription class, groups, since_seq, stream), or None.
+resume_request = ContextVar('resume_request', default=None)
+
+# Returned by EventLog.since() when it can't replay.
+RESYNC = object()
+
+
+class EventLog:
+    """
+Bounded, thread-safe ring buffer of [seq, event id, subscription class
+name, routes], the routes None until the event itself comes in from
+EVENTS_GROUP.
+    """
+
+    def __init__(self, size=EVENT_LOG_SIZE, channel_layer=None):
+        self.stream = uuid.uuid4().hex[:12]
+        self._events = deque()
+        self._maxsize = size
+        self._by_id = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._listener = GroupListener(EVENTS_GROUP, self._on_message, channel_layer, name="snippets-events")
+        # Marker id -> future set once the listener gets to the marker.
+        self._markers = {}
+        self.replays = 0
+        self.replayed = 0
+        self.resyncs = 0
+
+    def announce(self, subscription, routes):
+        """
+Gives an event an id, stamped on its payloads, and sends it whole to every
+process's log. Call from synchronous code, before broadcasting the payloads
+themselves. Returns routes.
+        """
+        event_id = uuid.uuid4().hex
+        for payload in routes.values():
+            payload["event"] = event_id
+        layer = self._listener.layer()
+        if layer is not None:
+            async_to_sync(layer.group_send)(EVENTS_GROUP, {
+                "type": "event.log",
+                "event": event_id,
+                "subscription": subscription.__name__,
+                "routes": Serializer.serialize(routes),
+            })
+        return routes
+
+    def number(self, event_id, subscription=None, routes=None):
+        """The event's seq here, numbering it if this is the first sight of it."""
+        with self._lock:
+            entry = self._by_id.get(event_id)
+            if entry is None:
+                self._seq += 1
+                entry = [self._seq, event_id, subscription, routes]
+                self._events.append(entry)
+                self._by_id[event_id] = entry
+                while len(self._events) > self._maxsize:
+                    del self._by_id[self._events.popleft()[1]]
+            elif routes is not None:
+                entry[2], entry[3] = subscription, routes
+            return entry[0]
+
+    def position(self, payload):
+        """The seq and stream of a notification payload, as delivered in this process."""
+        if "seq" in payload:
+            # Replayed, or a resync; see since() and resync_payload().
+            return {"seq": payload["seq"], "stream": payload["stream"]}
+        if "event" not in payload:
+            return {"seq": None, "stream": None}
+        return {"seq": self.number(payload["event"]), "stream": self.stream}
+
+    def since(self, subscription, groups, seq, stream=None):
+        """
+Returns (payloads, last): the payloads, in order, for subscription's groups
+of the events after seq, up to and including event number last. payloads is
+RESYNC if they aren't all here.
+        """
+        with self._lock:
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            missed = [entry for entry in self._events if entry[0] > seq]
+            # The newest events may have reached a subscriber here before the
+            # listener; those arrived after caught_up(), so come live.
+            while missed and missed[-1][3] is None:
+                missed.pop()
+            last = missed[-1][0] if missed else seq
+            if (stream not in (None, self.stream) or seq > self._seq or seq < oldest - 1
+                    or any(entry[3] is None for entry in missed)):
+                self.resyncs += 1
+                return RESYNC, self._seq
+
+            payloads = [
+                {**routes[group], "seq": number, "stream": self.stream}
+                for number, _, name, routes in missed
+                if name == subscription.__name__
+                for group in groups if group in routes
+            ]
+            self.replays += 1
+            self.replayed += len(payloads)
+            return payloads, last
+
+    def resync_payload(self):
+        """The one notification sent in place of a replay that can't be done."""
+        return {"sender": None, "resync": True, "seq": self._seq, "stream": self.stream}
+
+    async def listen(self):
+        """Starts this process's listener on EVENTS_GROUP, if need be, and waits until it has joined."""
+        joined = self._listener.start()
+        if joined is not None:
+            await asyncio.wrap_future(joined)
+
+    async def caught_up(self):
+        """
+Waits (up to CATCH_UP_TIMEOUT) until the listener has taken in every event
+that had reached this process when called. It queues a marker behind them.
+        """
+        layer, channel = self._listener.layer(), self._listener.channel
+        if layer is None or channel is None:
+            return
+        marker = uuid.uuid4().hex
+        reached = self._markers[marker] = concurrent.futures.Future()
+        try:
+            await layer.send(channel, {"type": "event.marker", "marker": marker})
+            await asyncio.wait_for(asyncio.wrap_future(reached), CATCH_UP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._markers.pop(marker, None)
+
+    def _on_message(self, message):
+        if message["type"] == "event.marker":
+            reached = self._markers.get(message["marker"])
+            if reached is not None and not reached.done():
+                reached.set_result(None)
+            return
+        self.number(message["event"], message["subscription"], Serializer.deserialize(message["routes"]))
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+            self._by_id.clear()
+            self.replays = self.replayed = self.resyncs = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stream': self.stream,
+                'seq': self._seq,
+                'size': len(self._events),
+                'maxsize': self._maxsize,
+                'replays': self.replays,
+                'replayed': self.replayed,
+                'resyncs': self.resyncs,
+            }
+
+
+event_log = EventLog()
+metrics.register('subscription_event_log', event_log.stats)
+
+
+def resume_from(subscription, groups, since_seq=None, stream=None):
+    """
+Called by subscribe() with the groups it joins. Asks the consumer to replay
+the events after since_seq first, if it was given.
+    """
+    resume_request.set(None if since_seq is None else (subscription, groups, since_seq, stream))
@@ -0,0 +1,145 @@
+"""
+Shared rendering of subscription notifications.
+
+channels_graphql_ws runs a subscription's publish() and resolves its
+selection set separately for every subscriber, so 10,000 clients running the
+same onSnippetNoGroup document cost 10,000 executions per event. But two
+subscribers get byte-for-byte the same notification when they have
+
+- the same event (the serialized broadcast payload),
+- the same document, operation name and variables,
+- the same visibility class (see visibility.py), and
+- the same answer to "did I send this?", which publish() uses to skip
+  self-notifications.
+
+That holds as long as publish() and the resolvers below it look at nothing
+else about the subscriber, which new subscriptions must keep to.
+
+So the consumer (consumer.py) asks PublishCache for the rendered payload
+under that key. The first subscriber to ask renders it the usual way and
+the cache keeps the JSON; everyone else in the group gets those same
+characters, wrapped in a frame with their own operation id. A render that
+publish() skipped is remembered as SKIP.
+
+Subscribers in one process share one event loop, so a key being rendered
+has a future the rest of its group waits on rather than rendering again.
+The cache is per process, like the other caches here.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+PUBLISH_CACHE_MAXSIZE = getattr(settings, 'SUBSCRIPTION_PUBLISH_CACHE_MAXSIZE', 1024)
+
+# Stored for a group whose publish() returned SKIP.
+SKIP = object()
+
+
+def document_key(query, operation_name, variables):
+    """Identifies what a subscriber asked for, whatever the event."""
+    document = json.dumps([query, operation_name, variables], sort_keys=True, default=str)
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def event_key(payload):
+    """Identifies an event by its serialized broadcast payload."""
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def data_payload(data, errors):
+    """The JSON of a GraphQL "data" message's payload, as the consumer sends it."""
+    return json.dumps({"data": data, **({"errors": errors} if errors else {})})
+
+
+def data_frame(operation_id, payload_json):
+    """
+Wraps a rendered payload in a "data" message for one operation. The result
+is exactly what send_json() would have produced for the same message.
+    """
+    return '{"type": "data", "id": %s, "payload": %s}' % (json.dumps(operation_id), payload_json)
+
+
+class PublishCache:
+    """
+Bounded, thread-safe LRU of rendered notifications, with renders in
+progress tracked so that each key is rendered once.
+    """
+
+    def __init__(self, maxsize=PUBLISH_CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._rendered = OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.renders = 0
+        self.skips = 0
+        self.evictions = 0
+
+    async def get_or_render(self, key, render):
+        """
+Returns the rendered payload JSON for key, or SKIP, awaiting render() for it
+if no one has yet. render() returns the same; None means it couldn't be
+shared (e.g. publish() failed), and the caller should not reuse it.
+        """
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            if key in self._rendered:
+                self._rendered.move_to_end(key)
+                self.hits += 1
+                return self._rendered[key]
+            pending = self._rendering.get(key)
+            if pending is None or pending.get_loop() is not loop:
+                pending = None
+                self._rendering[key] = loop.create_future()
+
+        if pending is not None:
+            rendered = await asyncio.shield(pending)
+            if rendered is not None:
+                with self._lock:
+                    self.hits += 1
+                return rendered
+            # Whoever rendered it couldn't share it; do it ourselves.
+            return await render()
+
+        rendered = None
+        try:
+            rendered = await render()
+        finally:
+            with self._lock:
+                future = self._rendering.pop(key, None)
+                if rendered is not None:
+                    self.renders += 1
+                    self.skips += rendered is SKIP
+                    self._rendered[key] = rendered
+                    while len(self._rendered) > self.maxsize:
+                        self._rendered.popitem(last=False)
+                        self.evictions += 1
+            if future is not None and not future.done():
+                future.set_result(rendered)
+        return rendered
+
+    def clear(self):
+        with self._lock:
+            self._rendered.clear()
+            self.hits = self.renders = self.skips = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._rendered),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'renders': self.renders,
+                'skips': self.skips,
+                'evictions': self.evictions,
+            }
+
+
+publish_cache = PublishCache()
+metrics.register('subscription_publish_cache', publish_cache.stats)
@@ -0,0 +1,95 @@
+"""
+Which subscribers hear about which snippets.
+
+Subscriptions can be narrowed with owner, snippetId and includePrivate, and
+nobody is ever sent a private snippet that limitedSnippets wouldn't show
+them (see visibility.py). Rather than send every event to every connection
+and filter there, each subscription joins channel-layer groups named after
+what it may receive, and each event is sent only to the groups it belongs
+in. A connection that wants nothing from an event never hears of it.
+
+A group name is a base and a scope:
+
+    all.public              every public snippet
+    owner.<name>.public     public snippets owned by <name>
+    snippet.<id>.public     snippet <id>, while public
+
+and, for private snippets, the same with .private: open to SuperUser,
+and to <name> for owner.<name>.private. A user other than SuperUser who
+follows one snippet gets its private events through
+snippet.<id>.private.<name>, which only that snippet's owner joins.
+
+A subscription joins one public group and at most one private one, so it
+never gets the same single-snippet event twice. An event covering many
+snippets (e.g. createSnippets) goes to each group with just the snippets
+that belong there. So a subscriber can get it as two notifications, one for
+the public snippets and one for the private ones.
+"""
+from .visibility import PUBLIC, SUPERUSER
+
+
+def _base(owner=None, snippet_id=None):
+    if snippet_id is not None:
+        return f"snippet.{snippet_id}"
+    if owner is not None:
+        return f"owner.{owner}"
+    return "all"
+
+
+def subscriber_groups(visibility, owner=None, snippet_id=None, include_private=True):
+    """
+The groups a subscription joins, for a subscriber of the given visibility
+class. With both owner and snippet_id, it follows the snippet and publish()
+checks the owner (see matches()).
+    """
+    base = _base(owner, snippet_id)
+    groups = [f"{base}.public"]
+    if not include_private or visibility == PUBLIC:
+        return groups
+
+    if visibility == SUPERUSER:
+        groups.append(f"{base}.private")
+        return groups
+
+    me = visibility[1]
+    if snippet_id is not None:
+        groups.append(f"snippet.{snippet_id}.private.{me}")
+    elif owner is None or owner == me:
+        groups.append(f"owner.{me}.private")
+    return groups
+
+
+def event_groups(data):
+    """The groups that hear about one snippet, given its notification_data()."""
+    snippet_id, owner = data['id'], data['owner']
+    if not data['private']:
+        return ["all.public", f"owner.{owner}.public", f"snippet.{snippet_id}.public"]
+    return [
+        "all.private", f"owner.{owner}.private",
+        f"snippet.{snippet_id}.private", f"snippet.{snippet_id}.private.{owner}",
+    ]
+
+
+def single_snippet_routes(routes):
+    """Just the routes (group -> payload) to groups that follow one snippet."""
+    return {group: payload for group, payload in routes.items() if group.startswith("snippet.")}
+
+
+def route(snippets):
+    """
+Maps each group to the notification_data() dicts, out of snippets, that it
+should be sent.
+    """
+    routes = {}
+    for data in snippets:
+        for group in event_groups(data):
+            routes.setdefault(group, []).append(data)
+    return routes
+
+
+def matches(data, owner=None, snippet_id=None):
+    """Whether a snippet passes a subscription's owner and snippetId arguments."""
+    return (
+        (owner is None or data['owner'] == owner)
+        and (snippet_id is None or str(data['id']) == str(snippet_id))
+    )
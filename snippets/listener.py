@@ -0,0 +1,92 @@
+"""
+A thread per process that hears what is sent to a channel-layer group, for
+state every worker process keeps a copy of: the limitedSnippets cache
+(cache.py) and the subscription event log (eventlog.py).
+
+The listener joins its group once, the first time start() is called in a
+process, and again now and then so that group_expiry never drops it. The
+handler is called in the listener's thread for every message.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+
+from channels.layers import get_channel_layer
+
+
+class GroupListener:
+    """
+Calls handle(message) for each message sent to group, from a daemon thread
+with its own event loop.
+    """
+
+    def __init__(self, group, handle, channel_layer=None, name="listener"):
+        self.group = group
+        self.handle = handle
+        self.name = name
+        self._channel_layer = channel_layer
+        self._pid = None
+        self._joined = None
+        self.channel = None
+        self._lock = threading.Lock()
+
+    def layer(self):
+        if self._channel_layer is None:
+            self._channel_layer = get_channel_layer()
+        return self._channel_layer
+
+    def start(self):
+        """
+Starts listening, once per process. Returns a concurrent.futures.Future
+that is done once the group has been joined, or None if there is no
+channel layer to listen on.
+        """
+        if self.layer() is None:
+            return None
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._joined = concurrent.futures.Future()
+                threading.Thread(
+                    target=lambda: asyncio.new_event_loop().run_until_complete(self._listen(self._joined)),
+                    name=self.name, daemon=True,
+                ).start()
+            return self._joined
+
+    def joined(self):
+        """
+start(), without waiting: whether the group has been joined yet, or there
+is no channel layer, and so nothing to miss.
+        """
+        joined = self.start()
+        return joined is None or joined.done()
+
+    def wait(self, timeout=5):
+        """start(), and wait for the group to be joined, from synchronous code, e.g. tests."""
+        joined = self.start()
+        if joined is not None:
+            concurrent.futures.wait([joined], timeout=timeout)
+
+    async def _listen(self, joined):
+        layer = self.layer()
+        self.channel = await layer.new_channel()
+        # Joined again now and then, so the membership doesn't expire.
+        rejoin = getattr(layer, 'group_expiry', 86400) / 2
+        while True:
+            await layer.group_add(self.group, self.channel)
+            if not joined.done():
+                joined.set_result(self.channel)
+            deadline = time.time() + rejoin
+            while time.time() < deadline:
+                try:
+                    message = await asyncio.wait_for(layer.receive(self.channel), timeout=deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+                try:
+                    self.handle(message)
+                except Exception:
+                    # One bad message mustn't stop the listening.
+                    traceback.print_exc()
@@ -0,0 +1,144 @@
+"""
+Per-request DataLoaders.
+
+Resolvers that look records up one at a time (snippetById, ownerUser) ask a
+loader instead of the database, so that each distinct key is fetched once
+per operation and the fetches happen in one pk__in / username__in query.
+
+A DataLoader normally batches by waiting for the promise "trampoline" to
+drain before dispatching, but channels_graphql_ws switches the trampoline
+off (see graphql_ws_consumer.py), and without it every load() would
+dispatch on its own. So the loaders are primed up front instead, by looking
+ahead at the selection set the same way projection.py does:
+
+- prime_snippets_by_id() reads the id of every snippetById in the operation;
+- prime_owners() takes the page of snippets a list resolver just loaded.
+
+https://docs.graphene-python.org/en/latest/execution/dataloader/
+"""
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from graphql.execution.values import get_argument_values
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .models import Snippet
+from .projection import only_selected, root_fields, selected_fields
+
+
+class PrimingLoader(DataLoader):
+    """A DataLoader that can also be filled with one query up front."""
+
+    def prime_many(self, keys):
+        """
+Loads whichever of keys aren't cached yet with a single batch_load_fn()
+call and caches them. Returns the values loaded.
+        """
+        keys = list(dict.fromkeys(
+            key for key in keys if self.get_cache_key(key) not in self._promise_cache
+        ))
+        if not keys:
+            return []
+
+        values = self.batch_load_fn(keys).get()
+        for key, value in zip(keys, values):
+            self.prime(key, value)
+        return values
+
+
+class SnippetLoader(PrimingLoader):
+    """
+Loads snippets by primary key. A key that doesn't exist is rejected with
+Snippet.DoesNotExist, just as Snippet.objects.get() would have raised.
+    """
+
+    def __init__(self, queryset):
+        super().__init__()
+        # Usually narrowed with only_selected().
+        self.queryset = queryset
+
+    def batch_load_fn(self, keys):
+        snippets = self.queryset.in_bulk(keys)
+        return Promise.resolve([
+            snippets.get(key) or Snippet.DoesNotExist("Snippet matching query does not exist.")
+            for key in keys
+        ])
+
+
+class UserLoader(PrimingLoader):
+    """
+Loads users by username. Snippet.owner is a plain CharField, so an owner
+with no matching user resolves to None.
+    """
+
+    def batch_load_fn(self, keys):
+        users = get_user_model().objects.in_bulk(keys, field_name='username')
+        return Promise.resolve([users.get(key) for key in keys])
+
+
+class Loaders:
+    """The loaders belonging to one execution of an operation."""
+
+    def __init__(self, variable_values):
+        self.variable_values = variable_values
+        self.users = UserLoader()
+        # Created by prime_snippets_by_id().
+        self.snippets = None
+
+
+def loaders_for(info):
+    """
+Returns the Loaders for this execution, creating them on first use.
+
+They are kept on info.context. Over HTTP that is the request, but on a
+websocket it is the connection's scope, which outlives any one operation.
+So the loaders also remember which execution they belong to by its
+variable_values, a dict graphql-core builds afresh for every execution.
+    """
+    loaders = getattr(info.context, 'loaders', None)
+    if loaders is None or loaders.variable_values is not info.variable_values:
+        loaders = Loaders(info.variable_values)
+        info.context.loaders = loaders
+    return loaders
+
+
+def prime_snippets_by_id(info):
+    """
+Loads the snippet of every snippetById field in the operation in one query,
+the first time any of them is resolved. Returns the SnippetLoader.
+
+The columns loaded are the union of what all of those fields select.
+    """
+    loaders = loaders_for(info)
+    if loaders.snippets is None:
+        field_asts = root_fields(info, info.field_name)
+        field_def = info.parent_type.fields[info.field_name]
+
+        keys = []
+        for field_ast in field_asts:
+            args = get_argument_values(field_def.args, field_ast.arguments, info.variable_values)
+            try:
+                key = Snippet._meta.pk.to_python(args.get('id'))
+            except ValidationError:
+                continue  # Reported by that field's own resolver.
+            if key is not None:
+                keys.append(key)
+
+        queryset = only_selected(Snippet.objects.all(), info, field_asts=field_asts)
+        loaders.snippets = SnippetLoader(queryset)
+        snippets = loaders.snippets.prime_many(keys)
+        found = [snippet for snippet in snippets if isinstance(snippet, Snippet)]
+        prime_owners(info, found, field_asts=field_asts)
+
+    return loaders.snippets
+
+
+def prime_owners(info, snippets, path=(), field_asts=None):
+    """
+Loads the User behind each snippet's owner in one query, if ownerUser is
+selected (below path). Returns snippets.
+    """
+    fields = selected_fields(info, path, field_asts=field_asts)
+    if fields and 'ownerUser' in fields:
+        loaders_for(info).users.prime_many(snippet.owner for snippet in snippets)
+    return snippets
@@ -0,0 +1,18 @@
+"""
+Counters from the various caches and queues, gathered in one place.
+
+A module registers a function that returns a dict of its current numbers,
+and the superuser-only `metrics` query returns them all, keyed by name:
+
+query { metrics }
+"""
+_sources = {}
+
+
+def register(name, source):
+    """source() is called every time metrics are read and returns a dict."""
+    _sources[name] = source
+
+
+def collect():
+    return {name: source() for name, source in sorted(_sources.items())}
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['created', 'id'], name='snippet_created_id_idx'),
+        ),
+    ]
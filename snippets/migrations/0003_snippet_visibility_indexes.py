@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0002_snippet_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['private', 'created'], name='snippet_private_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['owner', 'private', 'created'], name='snippet_owner_private_idx'),
+        ),
+    ]
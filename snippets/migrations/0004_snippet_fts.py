@@ -0,0 +1,55 @@
+# FTS5 full-text index over Snippet.title and Snippet.body. See snippets/search.py.
+#
+# NOTE: Django rebuilds SQLite tables (copy, drop, rename) for many schema
+# changes, and dropping snippets_snippet drops these triggers with it. A later
+# migration that does that must re-create them and rebuild the index.
+
+from django.db import migrations
+
+FORWARD = [
+    # External content: the index points back at snippets_snippet by rowid
+    # rather than storing its own copy of every title and body.
+    '''
+    CREATE VIRTUAL TABLE snippets_snippet_fts USING fts5(
+        title, body, content='snippets_snippet', content_rowid='id'
+    )
+    ''',
+    '''
+    CREATE TRIGGER snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    ''',
+    '''
+    CREATE TRIGGER snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, old.body);
+    END
+    ''',
+    '''
+    CREATE TRIGGER snippets_snippet_fts_update AFTER UPDATE OF title, body ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, title, body)
+            VALUES ('delete', old.id, old.title, old.body);
+        INSERT INTO snippets_snippet_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    ''',
+    # Index whatever is already in the table.
+    "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+]
+
+BACKWARD = [
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_update',
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_delete',
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_insert',
+    'DROP TABLE IF EXISTS snippets_snippet_fts',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0003_snippet_visibility_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD, reverse_sql=BACKWARD),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:01
+#
+# Adding a column makes Django rebuild snippets_snippet on SQLite, which drops
+# the FTS triggers from 0004_snippet_fts; they are re-created here and the
+# index rebuilt.
+
+import importlib
+
+from django.db import migrations, models
+
+fts = importlib.import_module('snippets.migrations.0004_snippet_fts')
+
+TRIGGERS = [
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_insert',
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_delete',
+    'DROP TRIGGER IF EXISTS snippets_snippet_fts_update',
+    *[sql for sql in fts.FORWARD if 'CREATE TRIGGER' in sql],
+    "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0004_snippet_fts'),
+    ]
+
+    operations = [
+        # Unapplying, after the column is removed (and the table rebuilt again).
+        migrations.RunSQL(migrations.RunSQL.noop, reverse_sql=TRIGGERS),
+        migrations.AddField(
+            model_name='snippet',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.RunSQL(TRIGGERS, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -1,4 +1,133 @@
-from django.db import models
+import sqlite3
+
+from django.db import connections, models, transaction
+from django.db.models import sql
+from django.db.models import Q, Value
+from django.db.models.functions import Substr
+
+
+# Visibility filters for use in place of private=False/private=True.
+# Django renders a plain boolean filter as WHERE NOT "private", which SQLite
+# can't look up in an index, nor use as one arm of an indexed OR. Comparing
+# against a Value keeps it as "private" = False so the indexes below apply.
+IS_PUBLIC = Q(private=Value(False))
+IS_PRIVATE = Q(private=Value(True))
+
+BODY_PREVIEW_LENGTH = 50
+
+
+class SnippetQuerySet(models.QuerySet):
+    def with_body_preview(self):
+        """
+Has the database cut out the body preview, so that together with
+defer('body') only the first few characters of each body leave SQLite.
+        """
+        return self.annotate(preview=Substr('body', 1, BODY_PREVIEW_LENGTH))
+
+    def bulk_create_with_ids(self, objs):
+        """
+bulk_create() that leaves every object with its primary key set.
+
+Django 3.2 can't read back the keys of rows bulk inserted into SQLite, but
+the table's AUTOINCREMENT key hands out consecutive ids while one transaction
+holds the write lock, so they can be worked back from last_insert_rowid()
+(which FTS triggers don't disturb). Must be called inside a transaction.
+        """
+        objs = self.bulk_create(objs)
+        connection = connections[self.db]
+        if objs and objs[0].pk is None and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT last_insert_rowid()')
+                last_id = cursor.fetchone()[0]
+            for pk, obj in enumerate(objs, start=last_id - len(objs) + 1):
+                obj.pk = pk
+        return objs
+
+    def update_returning(self, values, fields):
+        """
+Updates the matching rows with values and returns them as they are now, as
+instances holding only fields (the others are deferred) plus any
+annotations on this queryset, e.g. with_body_preview().
+
+Where the database can, this is a single UPDATE ... RETURNING statement, so
+only the columns in values are written and only those in fields are read.
+Elsewhere it falls back to a narrow SELECT and then the UPDATE.
+        """
+        if not values:
+            return list(self.only(*fields))
+
+        query = self.query.chain(sql.UpdateQuery)
+        query.add_update_values(values)
+        query.annotations = {}
+        return self._returning(query, fields, lambda: self.update(**values))
+
+    def delete_returning(self, fields):
+        """
+Deletes the matching rows and returns them as they were, as instances
+holding only fields. Like update_returning(), a single DELETE ... RETURNING
+where the database can. Snippet has no relations or delete signals to
+honour, so nothing is lost by skipping Model.delete().
+        """
+        query = self.query.chain()
+        query.__class__ = sql.DeleteQuery
+        query.annotations = {}
+        return self._returning(query, fields, lambda: self._raw_delete(self.db))
+
+    def _returning(self, query, fields, fallback):
+        connection = connections[self.db]
+        opts = self.model._meta
+        # In model order, which is what from_db() expects.
+        wanted = {opts.pk.attname, *fields}
+        fields = [field.attname for field in opts.concrete_fields if field.attname in wanted]
+        if not supports_returning(connection):
+            with transaction.atomic(using=self.db):
+                rows = list(self.only(*fields))
+                fallback()
+            return rows
+
+        compiler = query.get_compiler(self.db)
+        statement, params = compiler.as_sql()
+        params = list(params)
+
+        # Columns first, then annotations, compiled the way a SELECT would.
+        expressions = [opts.get_field(name).get_col(opts.db_table) for name in fields]
+        expressions += self.query.annotations.values()
+        returning = []
+        for expression in expressions:
+            expression_sql, expression_params = compiler.compile(expression)
+            returning.append(expression_sql)
+            params.extend(expression_params)
+        statement += ' RETURNING ' + ', '.join(returning)
+
+        with transaction.mark_for_rollback_on_error(using=self.db), connection.cursor() as cursor:
+            cursor.execute(statement, params)
+            rows = cursor.fetchall()
+
+        # What the compiler would do to turn raw values into Python ones.
+        converters = [
+            connection.ops.get_db_converters(expression) + expression.get_db_converters(connection)
+            for expression in expressions
+        ]
+
+        instances = []
+        for row in rows:
+            values = []
+            for value, expression, expression_converters in zip(row, expressions, converters):
+                for converter in expression_converters:
+                    value = converter(value, expression, connection)
+                values.append(value)
+            instance = self.model.from_db(self.db, fields, values[:len(fields)])
+            for name, value in zip(self.query.annotations, values[len(fields):]):
+                setattr(instance, name, value)
+            instances.append(instance)
+        return instances
+
+
+def supports_returning(connection):
+    """UPDATE/DELETE ... RETURNING arrived in SQLite 3.35; PostgreSQL has always had it."""
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 35)
+    return connection.vendor == 'postgresql'
 
 
 # Define a single Django model for use in the tutorial.
@@ -10,6 +139,22 @@ class Snippet(models.Model):
     private = models.BooleanField(default=True,
                                   help_text='Private requires authenticated user (any) to see. If this is False, anyone can see it.')
     created = models.DateTimeField(auto_now_add=True)
+    # Bumped by every update, so that subscribers applying changes can tell
+    # whether they have the state a change applies to. See subscriptions.py.
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = SnippetQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination seeks and sorts on (created, id). See pagination.py.
+            models.Index(fields=['created', 'id'], name='snippet_created_id_idx'),
+            # Every read path filters on private, owner, or both, and then sorts
+            # by created. "private=False OR owner=X" uses both of these at once.
+            # See tests/test_query_plans.py.
+            models.Index(fields=['private', 'created'], name='snippet_private_created_idx'),
+            models.Index(fields=['owner', 'private', 'created'], name='snippet_owner_private_idx'),
+        ]
 
     # Handy display of title from the object itself
     def __str__(self):
@@ -17,4 +162,7 @@ class Snippet(models.Model):
 
     @property
     def body_preview(self):
-        return self.body[:50]
+        # Already computed by the database if this came from with_body_preview().
+        if 'preview' in self.__dict__:
+            return self.preview
+        return self.body[:BODY_PREVIEW_LENGTH]
@@ -4,7 +4,6 @@ This mutation file sets up C.UD of CRUD for the snippets model.
 
 https://docs.graphene-python.org/en/latest/types/mutations/
 """
-import datetime
 
 import django
 import graphene
@@ -12,29 +11,38 @@ import graphql_jwt
 import asgiref
 from channels.auth import login, logout
 from graphene_django.forms.mutation import DjangoModelFormMutation
-import copy
 from django.conf import settings
 
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
 
 # Project imports
 from .models import Snippet
 from .types import SnippetType, UserType
 from .forms import SnippetForm
 from . import whoami
+from .cache import limited_snippets_cache
+from .projection import selected_columns
 
 from .subscriptions import OnSnippetTransaction  # one group name
 from .subscriptions import OnSnippetNoGroup  # no group names
+from .subscriptions import OnSnippetChanged  # one snippet's group names
+from .subscriptions import NOTIFY_FIELDS
 
 
 # The input arguments for a Snippets mutation.
 # Obviously, ID isn't in there.
+# Only the fields a client actually sends end up in the input, so an update
+# changes just those. (created used to default to the date the server
+# started, which every update then wrote over the snippet's real date.)
 # TODO: assess if created should be updateable
 class SnippetInput(graphene.InputObjectType):
     title = graphene.String()
     body = graphene.String()
     private = graphene.Boolean()
-    created = graphene.DateTime(required=False, default=datetime.datetime.now().date())
+    created = graphene.DateTime(required=False)
 
 
 # Input arguments for authentication.
@@ -64,16 +72,71 @@ class CreateSnippetMutation(graphene.Mutation):
         snippet.owner = info.context.user.username  # Set by the API only
         snippet.save()
 
+        # Drop any cached limitedSnippets pages that should now include it.
+        limited_snippets_cache.invalidate(snippet.owner, public=not snippet.private)
+
         # print(vars(snippet))
 
         # Notify subscribers.
         OnSnippetTransaction.snippet_event(broadcast_group="CREATE", sender="SENDER", snippet=snippet)
         OnSnippetNoGroup.snippet_event(trans_type="CREATE", sender="SENDER", snippet=snippet)
+        OnSnippetChanged.snippet_event(trans_type="CREATE", sender="SENDER", snippet=snippet)
 
         # Notice we return an instance of this mutation
         return CreateSnippetMutation(snippet=snippet, ok=True)
 
 
+class CreateSnippetsMutation(graphene.Mutation):
+    """
+Creates many snippets at once, e.g. for an ingestion job.
+
+Every input is validated before anything is written; if any is invalid,
+nothing is. The rows go in with one bulk INSERT inside one transaction, and
+subscribers get one event per subscription type for the lot, with the
+snippets in its snippets field.
+    """
+    snippets = graphene.List(lambda: SnippetType)
+    ok = graphene.Boolean()
+
+    class Arguments:
+        inputs = graphene.List(graphene.NonNull(SnippetInput), required=True)
+
+    @staticmethod
+    def mutate(self, info, inputs):
+        owner = info.context.user.username  # Set by the API only
+
+        snippets = []
+        errors = []
+        for index, input in enumerate(inputs):
+            snippet = Snippet(title=input.get('title'), body=input.get('body'), owner=owner)
+            if input.get('private') is not None:
+                snippet.private = input['private']
+            try:
+                # owner comes from the user, not the input
+                snippet.full_clean(exclude=['owner'])
+            except ValidationError as e:
+                errors.append(f"inputs[{index}]: {e.message_dict}")
+            snippets.append(snippet)
+
+        if errors:
+            raise Exception("Nothing was created. " + "; ".join(errors))
+
+        with transaction.atomic():
+            Snippet.objects.bulk_create_with_ids(snippets)
+
+        # Drop any cached limitedSnippets pages that should now include them.
+        for private in {snippet.private for snippet in snippets}:
+            limited_snippets_cache.invalidate(owner, public=not private)
+
+        # Notify subscribers, once for the whole batch.
+        if snippets:
+            OnSnippetTransaction.snippets_event(broadcast_group="CREATE", sender="SENDER", snippets=snippets)
+            OnSnippetNoGroup.snippets_event(trans_type="CREATE", sender="SENDER", snippets=snippets)
+            OnSnippetChanged.snippets_event(trans_type="CREATE", sender="SENDER", snippets=snippets)
+
+        return CreateSnippetsMutation(snippets=snippets, ok=True)
+
+
 class FormCreateSnippetMutation(DjangoModelFormMutation):
     """
 DjangoModelFormMutation will pull the fields from a ModelForm,
@@ -128,14 +191,22 @@ The owner is passed, but it is replaced with the authenticated username.
 
         snippet.save()  # Persist the data of this model instance
 
+        # Drop any cached limitedSnippets pages that should now include it.
+        limited_snippets_cache.invalidate(snippet.owner, public=not snippet.private)
+
         # Notify subscribers.
         OnSnippetTransaction.snippet_event(broadcast_group="CREATE", sender="SENDER", snippet=snippet)
         OnSnippetNoGroup.snippet_event(trans_type="CREATE", sender="SENDER", snippet=snippet)
+        OnSnippetChanged.snippet_event(trans_type="CREATE", sender="SENDER", snippet=snippet)
 
         return FormCreateSnippetMutation(snippet=snippet, ok=True)
 
 
 class UpdateSnippetMutation(graphene.Mutation):
+    """
+Writes just the fields present in input, with one UPDATE ... RETURNING that
+reads back only what subscribers and the response selection need.
+    """
     # The class attributes define the response of the mutation
     snippet = graphene.Field(lambda: SnippetType)
     ok = graphene.Boolean()
@@ -147,23 +218,138 @@ class UpdateSnippetMutation(graphene.Mutation):
 
     @staticmethod
     def mutate(self, info, id, input=None):
-        snippet = Snippet.objects.get(pk=id)
+        values = clean_input(input)
 
-        # Loop over all the things
-        for key, value in input.items():
-            setattr(snippet, key, value)
+        # Whatever the response selects, plus what subscribers are sent.
+        fields = selected_columns(info, ('snippet',), extra=NOTIFY_FIELDS)
+        if fields is None:
+            fields = [field.attname for field in Snippet._meta.concrete_fields]
 
-        snippet.save()
+        snippets, was_public = update_snippets(Snippet.objects.filter(pk=Snippet._meta.pk.to_python(id)), values, fields)
+        if not snippets:
+            raise Snippet.DoesNotExist("Snippet matching query does not exist.")
+        snippet = snippets[0]
+
+        # If it was or now is public, everyone's cached pages are stale.
+        limited_snippets_cache.invalidate(snippet.owner, public=was_public[snippet.pk] or not snippet.private)
 
         # Notify subscribers.
-        OnSnippetTransaction.snippet_event(broadcast_group="UPDATE", sender="SENDER", snippet=snippet)
-        OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=snippet)
+        OnSnippetTransaction.snippet_event(broadcast_group="UPDATE", sender="SENDER", snippet=snippet, changed=values)
+        OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=snippet, changed=values)
+        OnSnippetChanged.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=snippet, changed=values)
 
         # Notice we return an instance of this mutation
         return UpdateSnippetMutation(snippet=snippet, ok=True)
 
 
+def clean_input(input):
+    """
+Checks each supplied SnippetInput value against its model field, the way
+full_clean() would, for writes that don't go through a model instance.
+Returns the values as the model wants them.
+    """
+    values = {}
+    errors = {}
+    for name, value in input.items():
+        try:
+            values[name] = Snippet._meta.get_field(name).clean(value, None)
+        except ValidationError as e:
+            errors[name] = e.messages
+    if errors:
+        raise Exception(f"Invalid input {errors}")
+    return values
+
+
+def update_snippets(queryset, values, fields):
+    """
+Applies values to the snippets in queryset with one UPDATE ... RETURNING
+fields (and bodyPreview), bumping their versions. Returns the snippets and,
+by pk, whether each was public beforehand, which only needs reading first
+when private is changing.
+    """
+    if values:
+        values = {**values, 'version': F('version') + 1}
+    with transaction.atomic():
+        was_public = {}
+        if 'private' in values:
+            was_public = {pk: not private for pk, private in queryset.values_list('pk', 'private')}
+        snippets = queryset.with_body_preview().update_returning(values, fields)
+
+    for snippet in snippets:
+        was_public.setdefault(snippet.pk, not snippet.private)
+    return snippets, was_public
+
+
+def to_pks(ids):
+    return [Snippet._meta.pk.to_python(id) for id in ids]
+
+
+class UpdateSnippetsMutation(graphene.Mutation):
+    """
+Applies the same input to many snippets with one UPDATE ... RETURNING.
+Ids that don't exist are skipped; ids holds the ones that were updated.
+Subscribers get one event per subscription type for the lot.
+    """
+    ids = graphene.List(graphene.ID)
+    ok = graphene.Boolean()
+
+    class Arguments:
+        ids = graphene.List(graphene.NonNull(graphene.ID), required=True)
+        input = SnippetInput(required=True)
+
+    @staticmethod
+    def mutate(self, info, ids, input):
+        values = clean_input(input)
+
+        snippets, was_public = update_snippets(Snippet.objects.filter(pk__in=to_pks(ids)), values, NOTIFY_FIELDS)
+
+        for owner, public in {(s.owner, was_public[s.pk] or not s.private) for s in snippets}:
+            limited_snippets_cache.invalidate(owner, public=public)
+
+        # Notify subscribers, once for the whole batch.
+        if snippets:
+            OnSnippetTransaction.snippets_event(broadcast_group="UPDATE", sender="SENDER", snippets=snippets,
+                                                changed=values)
+            OnSnippetNoGroup.snippets_event(trans_type="UPDATE", sender="SENDER", snippets=snippets, changed=values)
+            OnSnippetChanged.snippets_event(trans_type="UPDATE", sender="SENDER", snippets=snippets, changed=values)
+
+        return UpdateSnippetsMutation(ids=[snippet.pk for snippet in snippets], ok=True)
+
+
+class DeleteSnippetsMutation(graphene.Mutation):
+    """
+Deletes many snippets with one DELETE ... RETURNING.
+Ids that don't exist are skipped; ids holds the ones that were deleted.
+Subscribers get one event per subscription type for the lot.
+    """
+    ids = graphene.List(graphene.ID)
+    ok = graphene.Boolean()
+
+    class Arguments:
+        ids = graphene.List(graphene.NonNull(graphene.ID), required=True)
+
+    @staticmethod
+    def mutate(self, info, ids):
+        snippets = Snippet.objects.filter(pk__in=to_pks(ids)) \
+            .with_body_preview().delete_returning(NOTIFY_FIELDS)
+
+        for owner, public in {(snippet.owner, not snippet.private) for snippet in snippets}:
+            limited_snippets_cache.invalidate(owner, public=public)
+
+        # Notify subscribers, once for the whole batch.
+        if snippets:
+            OnSnippetTransaction.snippets_event(broadcast_group="DELETE", sender="SENDER", snippets=snippets)
+            OnSnippetNoGroup.snippets_event(trans_type="DELETE", sender="SENDER", snippets=snippets)
+            OnSnippetChanged.snippets_event(trans_type="DELETE", sender="SENDER", snippets=snippets)
+
+        return DeleteSnippetsMutation(ids=[snippet.pk for snippet in snippets], ok=True)
+
+
 class DeleteSnippetMutation(graphene.Mutation):
+    """
+Deletes with one DELETE ... RETURNING, which hands back the columns
+subscribers are sent.
+    """
     # The class attributes define the response of the mutation
     ok = graphene.Boolean()
 
@@ -173,15 +359,18 @@ class DeleteSnippetMutation(graphene.Mutation):
 
     @staticmethod
     def mutate(self, info, id):
-        snippet = Snippet.objects.get(pk=id)
-        snippet_clone = copy.copy(snippet)
-        snippet.delete()
+        snippets = Snippet.objects.filter(pk=Snippet._meta.pk.to_python(id)) \
+            .with_body_preview().delete_returning(NOTIFY_FIELDS)
+        if not snippets:
+            raise Snippet.DoesNotExist("Snippet matching query does not exist.")
+        snippet = snippets[0]
 
-        snippet_clone.id = id
+        limited_snippets_cache.invalidate(snippet.owner, public=not snippet.private)
 
         # Notify subscribers.
-        OnSnippetTransaction.snippet_event(broadcast_group="DELETE", sender="SENDER", snippet=snippet_clone)
-        OnSnippetNoGroup.snippet_event(trans_type="DELETE", sender="SENDER", snippet=snippet_clone)
+        OnSnippetTransaction.snippet_event(broadcast_group="DELETE", sender="SENDER", snippet=snippet)
+        OnSnippetNoGroup.snippet_event(trans_type="DELETE", sender="SENDER", snippet=snippet)
+        OnSnippetChanged.snippet_event(trans_type="DELETE", sender="SENDER", snippet=snippet)
 
         # Notice we return an instance of this mutation
         return DeleteSnippetMutation(ok=True)
@@ -255,7 +444,10 @@ class Mutation(graphene.ObjectType):
     # Defined herein
     update_snippet = UpdateSnippetMutation.Field()
     create_snippet = CreateSnippetMutation.Field()
+    create_snippets = CreateSnippetsMutation.Field()
     delete_snippet = DeleteSnippetMutation.Field()
+    update_snippets = UpdateSnippetsMutation.Field()
+    delete_snippets = DeleteSnippetsMutation.Field()
 
     # This uses Form fields rather than my own defined fields
     create_form_snippet = FormCreateSnippetMutation.Field()
@@ -0,0 +1,179 @@
+"""
+Bounded outbound queues for websocket connections.
+
+Everything MyGraphqlWsConsumer (consumer.py) sends to a client goes through
+the connection's SendQueue, and one task per connection writes it out in
+order. A client that reads slowly holds that task up, not the consumer, and
+its queue holds at most WEBSOCKET_SEND_QUEUE_LIMIT subscription
+notifications. When a notification arrives at a full queue,
+WEBSOCKET_SEND_QUEUE_POLICY decides:
+
+    drop_oldest   the oldest queued notification is dropped
+    coalesce      it replaces a queued notification, for the same
+                  subscription, about the same snippet, if there is one;
+                  otherwise the oldest is dropped
+    disconnect    the connection is closed, and the client can reconnect
+                  and resume (see eventlog.py)
+
+Everything else (acks, query results, errors, keepalives) is always queued;
+there are only ever a few of those.
+
+How soon a slow client fills its queue depends on the ASGI server: one that
+applies backpressure to websocket sends (e.g. uvicorn) holds the writer up
+as soon as the client stops reading, one that buffers sends itself only
+once that buffer is handed over.
+"""
+import asyncio
+import threading
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+SEND_QUEUE_LIMIT = getattr(settings, 'WEBSOCKET_SEND_QUEUE_LIMIT', 256)
+SEND_QUEUE_POLICY = getattr(settings, 'WEBSOCKET_SEND_QUEUE_POLICY', DROP_OLDEST)
+
+# How many connections the metrics list one by one, deepest queue first.
+METRICS_CONNECTIONS = 20
+
+_queues = weakref.WeakSet()
+_queues_lock = threading.Lock()
+# Counts carried over from connections that have closed.
+_closed = {'dropped': 0, 'coalesced': 0, 'disconnects': 0}
+
+
+class SendQueue:
+    """
+One connection's outbound frames, each the (text_data, bytes_data, close)
+arguments of a websocket send. Used from the connection's event loop only.
+    """
+
+    def __init__(self, name, limit=SEND_QUEUE_LIMIT, policy=SEND_QUEUE_POLICY):
+        if policy not in POLICIES:
+            raise ValueError("Unknown send queue policy {!r}; use one of {}".format(policy, POLICIES))
+        self.name = name
+        self.limit = limit
+        self.policy = policy
+        # Entries are [notification key or None, frame]; only notifications
+        # have a key, which is () if they can't be coalesced.
+        self._entries = deque()
+        self._by_key = {}
+        self._notifications = 0
+        self._waiter = None
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.overflowed = False
+        with _queues_lock:
+            _queues.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, frame, notification=False, key=()):
+        """
+Queues a frame. notification marks a subscription notification, and key
+(e.g. the operation id and snippet id) says which ones may replace each
+other under the coalesce policy. Returns False if, under the disconnect
+policy, the connection should be closed instead.
+        """
+        if notification and self._notifications >= self.limit:
+            if self.policy == DISCONNECT:
+                self.overflowed = True
+                return False
+            queued = self._by_key.get(key) if self.policy == COALESCE and key else None
+            if queued is not None:
+                queued[1] = frame
+                self.coalesced += 1
+                return True
+            self._drop_oldest()
+
+        entry = [key if notification else None, frame]
+        self._entries.append(entry)
+        if notification:
+            self._notifications += 1
+            if key:
+                self._by_key[key] = entry
+        self.max_depth = max(self.max_depth, len(self._entries))
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        return True
+
+    async def get(self):
+        """The next frame to send, waiting for one if need be."""
+        while not self._entries:
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+        entry = self._entries.popleft()
+        self._forget(entry)
+        self.sent += 1
+        return entry[1]
+
+    def _drop_oldest(self):
+        for entry in self._entries:
+            if entry[0] is not None:
+                self._entries.remove(entry)
+                self._forget(entry)
+                self.dropped += 1
+                return
+
+    def _forget(self, entry):
+        key = entry[0]
+        if key is None:
+            return
+        self._notifications -= 1
+        if key and self._by_key.get(key) is entry:
+            del self._by_key[key]
+
+    def close(self):
+        """Drops what is left, and counts this connection into the totals."""
+        with _queues_lock:
+            if self in _queues:
+                _queues.discard(self)
+                _closed['dropped'] += self.dropped + sum(1 for entry in self._entries if entry[0] is not None)
+                _closed['coalesced'] += self.coalesced
+                _closed['disconnects'] += self.overflowed
+        self._entries.clear()
+        self._by_key.clear()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.cancel()
+
+    def stats(self):
+        return {
+            'depth': len(self._entries),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+
+def stats():
+    with _queues_lock:
+        queues = list(_queues)
+        closed = dict(_closed)
+    deepest = sorted(queues, key=lambda queue: (len(queue), queue.dropped), reverse=True)
+    return {
+        'limit': SEND_QUEUE_LIMIT,
+        'policy': SEND_QUEUE_POLICY,
+        'connections': len(queues),
+        'depth': sum(len(queue) for queue in queues),
+        'dropped': closed['dropped'] + sum(queue.dropped for queue in queues),
+        'coalesced': closed['coalesced'] + sum(queue.coalesced for queue in queues),
+        'disconnects': closed['disconnects'],
+        'deepest': {
+            queue.name: queue.stats()
+            for queue in deepest[:METRICS_CONNECTIONS] if len(queue) or queue.dropped
+        },
+    }
+
+
+metrics.register('websocket_send_queues', stats)
@@ -0,0 +1,99 @@
+"""
+Keyset (a.k.a. "seek") pagination for Relay-style connections.
+
+graphene's own ConnectionField slices the resolved list with OFFSET/LIMIT,
+which means the database still walks every row before the requested page.
+Instead, the cursor here carries the (created, id) of the row it points at,
+and the next page is fetched with a WHERE clause on those values. Given an
+index on (created, id), fetching page 1 or page 10,000 costs the same.
+
+https://relay.dev/graphql/connections.htm
+"""
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from graphene.relay import PageInfo
+from graphene_django.settings import graphene_settings
+
+
+def to_cursor(snippet):
+    """
+Encodes the sort key of a snippet into an opaque cursor.
+    """
+    raw = "{}|{}".format(snippet.created.isoformat(), snippet.id)
+    return base64.b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def from_cursor(cursor):
+    """
+Decodes a cursor back into its (created, id) sort key.
+Raises an Exception if the client sent something we did not hand out.
+    """
+    try:
+        created, pk = base64.b64decode(cursor).decode('utf-8').rsplit('|', 1)
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        created = None
+
+    if created is None:
+        raise Exception("Invalid cursor [{}]".format(cursor))
+
+    return created, pk
+
+
+def keyset_connection(queryset, connection_type, first=None, after=None, last=None, before=None, **kwargs):
+    """
+Returns one page of the queryset as an instance of connection_type.
+
+The queryset should already be filtered for visibility; this only adds the
+keyset WHERE clause, the ordering and the LIMIT. The page size is capped at
+RELAY_CONNECTION_MAX_LIMIT from the GRAPHENE settings, which is also the
+default when neither first nor last is given.
+    """
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+
+    for name, value in (('first', first), ('last', last)):
+        if value is not None and value < 0:
+            raise Exception("Argument [{}] must be a non-negative integer".format(name))
+
+    if after:
+        created, pk = from_cursor(after)
+        queryset = queryset.filter(Q(created__gt=created) | Q(created=created, id__gt=pk))
+    if before:
+        created, pk = from_cursor(before)
+        queryset = queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=pk))
+
+    has_previous_page = False
+    has_next_page = False
+
+    if first is None and last is not None:
+        # Paging backwards: read from the end, then flip back into order.
+        limit = min(last, max_limit)
+        rows = list(queryset.order_by('-created', '-id')[:limit + 1])
+        has_previous_page = len(rows) > limit
+        rows = rows[:limit][::-1]
+    else:
+        # Paging forwards. Fetch one extra row to learn if there's a next page.
+        limit = min(first if first is not None else max_limit, max_limit)
+        rows = list(queryset.order_by('created', 'id')[:limit + 1])
+        has_next_page = len(rows) > limit
+        rows = rows[:limit]
+
+        # Both first and last: the spec says to apply last to the result of first.
+        if last is not None and len(rows) > last:
+            rows = rows[len(rows) - last:]
+            has_previous_page = True
+
+    edges = [connection_type.Edge(node=row, cursor=to_cursor(row)) for row in rows]
+
+    page_info = PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=has_previous_page,
+        has_next_page=has_next_page,
+    )
+
+    return connection_type(edges=edges, page_info=page_info)
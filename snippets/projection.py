@@ -0,0 +1,125 @@
+"""
+Column projection driven by the GraphQL selection set.
+
+A client asking for { allSnippets { edges { node { id title } } } } has no use
+for the body column, which is an unbounded TextField. The list and lookup
+resolvers pass their queryset through only_selected(), which reads the
+selection set off info and narrows the SELECT with .only().
+
+https://docs.djangoproject.com/en/3.2/ref/models/querysets/#only
+"""
+from graphene.utils.str_converters import to_camel_case
+from graphql.language import ast
+
+from .models import Snippet
+
+# GraphQL fields on SnippetType that are not columns, and the columns they read.
+# Anything selected that is neither a column nor listed here switches
+# projection off for that query, so a new field can't trigger a deferred
+# load per row just because nobody updated this table.
+DERIVED_FIELDS = {
+    'bodyPreview': (),  # see ANNOTATED_FIELDS
+    'additionalMagic': (),
+    'ownerUser': ('owner',),
+}
+
+# Derived fields the database computes for us, and the SnippetQuerySet
+# method that adds the annotation.
+ANNOTATED_FIELDS = {
+    'bodyPreview': 'with_body_preview',
+}
+
+# GraphQL (camelCase) name -> model column, for every concrete column.
+COLUMN_FIELDS = {
+    to_camel_case(field.name): field.attname
+    for field in Snippet._meta.concrete_fields
+}
+
+
+def _selections(info, selection_set):
+    """Flattens fragments so that only Field nodes come back."""
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.Field):
+            yield selection
+        elif isinstance(selection, ast.FragmentSpread):
+            yield from _selections(info, info.fragments[selection.name.value].selection_set)
+        elif isinstance(selection, ast.InlineFragment):
+            yield from _selections(info, selection.selection_set)
+
+
+def root_fields(info, name):
+    """
+Returns every field called name at the top of the operation, e.g. all of
+the (aliased) snippetById fields in one query.
+    """
+    return [
+        field for field in _selections(info, info.operation.selection_set)
+        if field.name.value == name
+    ]
+
+
+def selected_fields(info, path=(), field_asts=None):
+    """
+Returns the set of field names selected below the field being resolved,
+following path first; e.g. path=('edges', 'node') for a connection.
+field_asts overrides the field(s) to look below.
+Returns None if info doesn't carry a selection set.
+    """
+    nodes = field_asts if field_asts is not None else getattr(info, 'field_asts', None)
+    if not nodes:
+        return None
+
+    for name in path:
+        nodes = [
+            field for node in nodes if node.selection_set
+            for field in _selections(info, node.selection_set)
+            if field.name.value == name
+        ]
+
+    return {
+        field.name.value for node in nodes if node.selection_set
+        for field in _selections(info, node.selection_set)
+    }
+
+
+def selected_columns(info, path=(), extra=(), field_asts=None):
+    """
+Returns the set of columns the selection set needs, always including the
+primary key and anything in extra, or None if that can't be worked out.
+    """
+    fields = selected_fields(info, path, field_asts=field_asts)
+    if fields is None:
+        return None
+
+    columns = {'id', *extra}
+    for name in fields:
+        if name.startswith('__'):
+            continue  # __typename and friends
+        elif name in COLUMN_FIELDS:
+            columns.add(COLUMN_FIELDS[name])
+        elif name in DERIVED_FIELDS:
+            columns.update(DERIVED_FIELDS[name])
+        else:
+            return None
+
+    return columns
+
+
+def only_selected(queryset, info, path=(), extra=(), field_asts=None):
+    """
+Narrows queryset to the columns the selection set needs.
+The primary key and anything in extra (e.g. the pagination sort key) are
+always loaded.
+    """
+    fields = selected_fields(info, path, field_asts=field_asts)
+    if fields is None:
+        return queryset
+
+    for name in fields & ANNOTATED_FIELDS.keys():
+        queryset = getattr(queryset, ANNOTATED_FIELDS[name])()
+
+    columns = selected_columns(info, path, extra, field_asts=field_asts)
+    if columns is None:
+        return queryset
+
+    return queryset.only(*columns)
@@ -1,17 +1,29 @@
 import graphene
+from graphene.types.generic import GenericScalar
 
-from django.db.models import Q
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
-from . import whoami
-from .models import Snippet
-from .types import SnippetType, UserType
+from . import metrics
+from .cache import limited_snippets_cache
+from .loaders import prime_owners, prime_snippets_by_id
+from .models import Snippet, IS_PRIVATE
+from .pagination import keyset_connection
+from .projection import only_selected, selected_fields
+from .search import search_connection
+from .types import SnippetType, SnippetConnection, UserType
+from .visibility import visibility_of, snippets_visible_to, visible_snippets
+
+
+# Where SnippetType sits inside a SnippetConnection's selection set.
+EDGE_NODE = ('edges', 'node')
 
 
 # https://docs.graphene-python.org/projects/django/en/latest/queries/
 class Query(graphene.ObjectType):
-    all_snippets = graphene.List(SnippetType)
+    # Both lists are Relay connections (first/after/last/before) so a client
+    # only ever gets one page at a time. See pagination.py.
+    all_snippets = graphene.relay.ConnectionField(SnippetConnection)
 
     def resolve_all_snippets(self, info, **kwargs):
         """
@@ -20,46 +32,58 @@ This is OK for an administrator but not for a regular user or AnonymousUser.
 But while I am still testing and debugging, I want to be able to see a raw
 list regardless of who I am at the moment.
         """
-        return Snippet.objects.all()
+        queryset = only_selected(Snippet.objects.all(), info, path=EDGE_NODE, extra=('created',))
+        connection = keyset_connection(queryset, SnippetConnection, **kwargs)
+        prime_owners(info, [edge.node for edge in connection.edges], path=EDGE_NODE)
+        return connection
 
     # ---
 
-    limited_snippets = graphene.List(SnippetType)
+    limited_snippets = graphene.relay.ConnectionField(SnippetConnection)
 
     def resolve_limited_snippets(self, info, **kwargs):
         """
 Resolver to show snippets that the specified user can see.
-Rules:
-1. All users (including Anonymous) can see Public snippets.
-2. All users can see their own snippets regardless of Public/Private.
-        """
-
-        # See who I am based upon the web token
-        jwt_username = str(whoami(info))
-        username = str(info.context.user)
-        if jwt_username != username:
-            # Different usernames? Shouldn't be.
-            print(f"LIMITED: whoami [{jwt_username}] != [{username}]")
-            return Snippet.objects.filter(private=False)
-        elif jwt_username == 'AnonymousUser':
-            # Same, but anonymous
-            print(f"LIMITED: Confirmed to be AnonymousUser")
-            return Snippet.objects.filter(private=False)
+See visibility.py for the rules.
 
-        if settings.DEBUG:
-            print(f"LIMITED: Authenticated and acknowledged to be [{username}]")
+Everyone in the same visibility class gets the same page for the same
+arguments, so pages are cached; see cache.py.
+        """
+        visibility = visibility_of(info)
+        fields = selected_fields(info, EDGE_NODE)
+        key = (
+            visibility,
+            tuple(sorted(kwargs.items())),
+            frozenset(fields) if fields is not None else None,
+        )
+
+        def compute():
+            queryset = only_selected(snippets_visible_to(visibility), info, path=EDGE_NODE, extra=('created',))
+            return keyset_connection(queryset, SnippetConnection, **kwargs)
+
+        connection = limited_snippets_cache.get_or_set(key, compute)
+        prime_owners(info, [edge.node for edge in connection.edges], path=EDGE_NODE)
+        return connection
 
-        if info.context.user.is_authenticated:
-            # It's good to be the king
-            if info.context.user.is_superuser:
-                print("Super user sees all")
-                return Snippet.objects.all()
+    # ---
 
-            # Otherwise, the user gets to see Public and their own records
-            return Snippet.objects.filter(Q(private=False) | Q(owner=username))
-        else:
-            print("AnonymousUser sees less")
-            return Snippet.objects.filter(private=False)
+    # Only forward paging here; results are ordered by relevance. See search.py.
+    search_snippets = graphene.Field(
+        SnippetConnection,
+        query=graphene.String(required=True),
+        first=graphene.Int(),
+        after=graphene.String(),
+    )
+
+    def resolve_search_snippets(self, info, query, first=None, after=None):
+        """
+Full-text search over title and body, best match first.
+Only searches the snippets the user can see; see visibility.py.
+        """
+        queryset = only_selected(visible_snippets(info), info, path=EDGE_NODE)
+        connection = search_connection(queryset, query, SnippetConnection, first=first, after=after)
+        prime_owners(info, [edge.node for edge in connection.edges], path=EDGE_NODE)
+        return connection
 
     # ---
 
@@ -67,8 +91,11 @@ Rules:
     snippet_by_id = graphene.Field(SnippetType, id=graphene.String())
 
     def resolve_snippet_by_id(self, info, id):
-        """Resolver to get a record by a particular ID"""
-        return Snippet.objects.get(pk=id)
+        """
+Resolver to get a record by a particular ID.
+Every snippetById in the same operation is fetched in one query; see loaders.py.
+        """
+        return prime_snippets_by_id(info).load(Snippet._meta.pk.to_python(id))
 
     # ---
     snippets_by_owner = graphene.List(SnippetType)
@@ -85,7 +112,7 @@ Rules:
             return Snippet.objects.none()
         else:
             # Authenticated users get set of the records they own
-            return Snippet.objects.filter(owner=info.context.user)
+            return prime_owners(info, list(only_selected(Snippet.objects.filter(owner=info.context.user), info)))
 
     def resolve_snippets_by_private(self, info):
         """
@@ -98,16 +125,32 @@ Resolver for filtering records by private flag
         if info.context.user.is_authenticated:
             if info.context.user.is_superuser:
                 print("Super user sees all")
-                return Snippet.objects.filter(private=True)
+                return prime_owners(info, list(only_selected(Snippet.objects.filter(IS_PRIVATE), info)))
             else:
                 # Authenticated users sees their own
-                return Snippet.objects.filter(private=True, owner=info.context.user)
+                return prime_owners(info, list(
+                    only_selected(Snippet.objects.filter(IS_PRIVATE, owner=info.context.user), info)
+                ))
         else:
             # AnonymousUser gets nothing
             return Snippet.objects.none()
 
     # ---
 
+    metrics = GenericScalar()
+
+    def resolve_metrics(self, info):
+        """
+Returns the counters registered in metrics.py. SuperUser only.
+        """
+        user = info.context.user
+        if not user.is_authenticated or not user.is_superuser:
+            raise Exception('Not authorized!')
+
+        return metrics.collect()
+
+    # ---
+
     # These go with JWT
     # https: // www.howtographql.com / graphql - python / 4 - authentication /
     me = graphene.Field(UserType)
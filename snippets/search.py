@@ -0,0 +1,98 @@
+"""
+Full-text search over snippet titles and bodies, backed by SQLite FTS5.
+
+The snippets_snippet_fts virtual table is an external-content FTS5 index of
+snippets_snippet: it stores only the index, not a second copy of the text,
+and triggers on snippets_snippet keep it in step with inserts, updates and
+deletes. See migrations/0004_snippet_fts.py.
+
+Results come back best match first (FTS5's bm25 rank) and are paged with a
+cursor holding the (rank, id) of the last row seen.
+
+https://www.sqlite.org/fts5.html
+"""
+import base64
+import binascii
+
+from graphene.relay import PageInfo
+from graphene_django.settings import graphene_settings
+
+FTS_TABLE = 'snippets_snippet_fts'
+
+
+def fts_query(text):
+    """
+Turns whatever the user typed into a safe FTS5 MATCH expression.
+Every word is quoted, so FTS5 operators and stray punctuation are taken
+literally rather than raising a syntax error, and all words must match.
+    """
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in text.split()]
+    return ' '.join(terms)
+
+
+def to_cursor(snippet):
+    raw = "{!r}|{}".format(snippet.search_rank, snippet.id)
+    return base64.b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def from_cursor(cursor):
+    try:
+        rank, pk = base64.b64decode(cursor).decode('utf-8').rsplit('|', 1)
+        return float(rank), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise Exception("Invalid cursor [{}]".format(cursor))
+
+
+def search(queryset, text):
+    """
+Restricts queryset to snippets matching text, annotated with search_rank
+and ordered best match first. Returns queryset.none() for an empty search.
+    """
+    match = fts_query(text)
+    if not match:
+        return queryset.none()
+
+    # FTS5's rank column only exists in a query that does a MATCH against the
+    # virtual table, so it is joined in rather than used as a subquery.
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[
+            '{0}.rowid = snippets_snippet.id'.format(FTS_TABLE),
+            '{0} MATCH %s'.format(FTS_TABLE),
+        ],
+        params=[match],
+        select={'search_rank': '{0}.rank'.format(FTS_TABLE)},
+        order_by=['search_rank', 'id'],
+    )
+
+
+def search_connection(queryset, text, connection_type, first=None, after=None):
+    """
+Returns one page of search results as an instance of connection_type.
+The queryset should already be filtered for visibility.
+    """
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+
+    if first is not None and first < 0:
+        raise Exception("Argument [first] must be a non-negative integer")
+    limit = min(first if first is not None else max_limit, max_limit)
+
+    queryset = search(queryset, text)
+    if after:
+        rank, pk = from_cursor(after)
+        queryset = queryset.extra(
+            where=['({0}.rank > %s OR ({0}.rank = %s AND snippets_snippet.id > %s))'.format(FTS_TABLE)],
+            params=[rank, rank, pk],
+        )
+
+    rows = list(queryset[:limit + 1])
+    edges = [connection_type.Edge(node=row, cursor=to_cursor(row)) for row in rows[:limit]]
+
+    page_info = PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=False,
+        has_next_page=len(rows) > limit,
+    )
+
+    return connection_type(edges=edges, page_info=page_info)
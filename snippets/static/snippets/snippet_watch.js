@@ -0,0 +1,99 @@
+// Live updates for the snippet on a detail page, through onSnippetChanged.
+// Only the changes come over (delta: true); if we've missed one, reload.
+
+const oWatch = {};
+
+oWatch.webSocket = null;
+oWatch.snippetId = document.querySelector('#snippet').dataset.id;
+oWatch.version = Number(document.querySelector('#snippet').dataset.version);
+
+oWatch.subscriptionQuery = String.raw`
+subscription subChanged($id: ID!) {
+  onSnippetChanged(id: $id, delta: true) {
+    transType
+    snippet {
+      title
+      owner
+      private
+      bodyPreview
+      version
+    }
+    delta {
+      version
+      baseVersion
+      title
+      bodyPreview
+    }
+  }
+}
+    `;
+
+oWatch.connectWS = function () {
+  const ws_scheme = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+  this.webSocket = new WebSocket(ws_scheme + window.location.host + '/graphql/', 'graphql-ws');
+  this.webSocket.onopen = oWatch.onopen;
+  this.webSocket.onmessage = oWatch.onmessage;
+  this.webSocket.onclose = oWatch.onclose;
+};
+
+oWatch.onopen = function () {
+  oWatch.webSocket.send(JSON.stringify({
+    id: 1,
+    type: 'start',
+    payload: {query: oWatch.subscriptionQuery, variables: {id: oWatch.snippetId}},
+  }));
+};
+
+oWatch.show = function (name, value) {
+  if (value === null || value === undefined) {
+    return;
+  }
+  for (const element of document.querySelectorAll('[data-field="' + name + '"]')) {
+    element.textContent = value;
+  }
+};
+
+oWatch.onmessage = function (e) {
+  const data = JSON.parse(e.data);
+  if (data.type !== 'data' || !data.payload.data || !data.payload.data.onSnippetChanged) {
+    return;
+  }
+  const payload = data.payload.data.onSnippetChanged;
+
+  if (payload.transType === 'DELETE') {
+    document.querySelector('#snippet-status').textContent = 'This snippet has been deleted.';
+    return;
+  }
+
+  // Just what changed, on top of the version we have; anything else, start over.
+  const delta = payload.delta;
+  if (delta) {
+    if (delta.baseVersion !== oWatch.version) {
+      window.location.reload();
+      return;
+    }
+    oWatch.version = delta.version;
+    oWatch.show('title', delta.title);
+    oWatch.show('body-preview', delta.bodyPreview);
+    return;
+  }
+
+  const snippet = payload.snippet;
+  oWatch.version = snippet.version;
+  oWatch.show('title', snippet.title);
+  oWatch.show('owner', snippet.owner);
+  oWatch.show('private', snippet.private ? 'True' : 'False');
+  oWatch.show('body-preview', snippet.bodyPreview);
+};
+
+oWatch.onclose = function (closeEvent) {
+  if (closeEvent.code === 4013) {
+    // The server is busy; give it a while. See snippets/admission.py.
+    setTimeout(() => window.location.reload(), 5000 + Math.random() * 10000);
+  } else if (!closeEvent.wasClean) {
+    // What changed meanwhile isn't replayed here; reload to catch up.
+    setTimeout(() => window.location.reload(), 1000);
+  }
+};
+
+oWatch.connectWS();
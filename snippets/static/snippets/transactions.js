@@ -3,6 +3,11 @@
 const oTran = {};
 
 oTran.webSocket = null;
+
+// Where we are in the server's event stream, so that a reconnect can pick up
+// where we left off. See snippets/eventlog.py.
+oTran.lastSeq = null;
+oTran.stream = null;
 //oTran.roomName = JSON.parse(document.getElementById('room-name').textContent);
 
 // Perform the WS connection
@@ -38,12 +43,21 @@ oTran.onmessage = function (e) {
   console.log('op_id: ' + data.id);
 
   switch (data.type) {
+    // The answer to connection_init, and the server's keepalives.
+    case 'connection_ack':
+    case 'ka':
+      break;
     // YYZ - ANTHONY - Who set the data type to data? Did I?
     case 'data':
       // If there are errors, let me know right away
       if (data.payload.errors) {
         for (const error of data.payload.errors) {
           console.log(error.message);
+
+          // The server didn't know our hash; send the query text this time.
+          if (error.message === 'PersistedQueryNotFound') {
+            oTran.sendStart(true);
+          }
         }
         return;
       }
@@ -60,6 +74,15 @@ oTran.onmessage = function (e) {
         console.log('sender: ' + payload.sender);
         console.log('ok?: ' + payload.ok);
 
+        oTran.lastSeq = payload.seq;
+        oTran.stream = payload.stream;
+
+        // The server couldn't replay what we missed; start over from here.
+        if (payload.resync) {
+          document.querySelector('#json').value = 'Missed too much while disconnected; reload to catch up.';
+          return;
+        }
+
         // Access the database object
         /** @namespace payload.snippet */
         document.querySelector('#json').value = '' +
@@ -77,22 +100,15 @@ oTran.onmessage = function (e) {
   }
 };
 
-// onOpen event
-oTran.onopen = function open() {
-  console.log('Chat socket opened');
-
-  // See channels_graphql_ws/graphql_ws_consumer.py for what is wanted
-  // to start a subscription. Can also look at the unit test.
-  let content = {};
-  content.id = 1; // A unique sequence? See channels_graphql_ws/graphql_ws_consumer.py:315
-  content.type = 'start';
-  let payload = {};
-  payload.query = String.raw`
-subscription subNoGroup {
-  onSnippetNoGroup {
+oTran.subscriptionQuery = String.raw`
+subscription subNoGroup($sinceSeq: Int, $stream: String) {
+  onSnippetNoGroup(sinceSeq: $sinceSeq, stream: $stream) {
     sender
     transType
     ok
+    seq
+    stream
+    resync
     snippet {
       id
       title
@@ -103,7 +119,40 @@ subscription subNoGroup {
   }
 }
     `;
+
+// Automatic persisted queries: the server keeps queries by their sha256, so
+// after the first time only the hash needs to go over the wire.
+// See mysite/persisted_queries.py.
+// crypto.subtle is only there on https:// and localhost; elsewhere, just send the text.
+oTran.sha256 = async function (text) {
+  if (!window.crypto || !window.crypto.subtle) {
+    return null;
+  }
+  const digest = await window.crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
+// Send the 'start' message for the subscription, with or without the query text.
+oTran.sendStart = async function (withQuery) {
+  // See channels_graphql_ws/graphql_ws_consumer.py for what is wanted
+  // to start a subscription. Can also look at the unit test.
+  let content = {};
+  content.id = 1; // A unique sequence? See channels_graphql_ws/graphql_ws_consumer.py:315
+  content.type = 'start';
+  let payload = {};
   payload.operationName = 'subNoGroup';
+  // After a reconnect, replay what we missed first.
+  if (oTran.lastSeq !== null) {
+    payload.variables = {sinceSeq: oTran.lastSeq, stream: oTran.stream};
+  }
+
+  const hash = await oTran.sha256(oTran.subscriptionQuery);
+  if (hash) {
+    payload.extensions = {persistedQuery: {version: 1, sha256Hash: hash}};
+  }
+  if (withQuery || !hash) {
+    payload.query = oTran.subscriptionQuery;
+  }
   content.payload = payload;
 
   let contentJSON = JSON.stringify(content, null, 2);
@@ -117,16 +166,58 @@ subscription subNoGroup {
   oTran.webSocket.send(contentJSON);
 };
 
+// onOpen event
+oTran.onopen = function open() {
+  console.log('Chat socket opened');
+
+  // Also gets us keepalives from the server.
+  oTran.webSocket.send(JSON.stringify({type: 'connection_init', payload: {}}));
+
+  // Try the hash alone first.
+  oTran.sendStart(false);
+};
+
 // onClose event
 oTran.onclose = function (closeEvent) {
   // console.log(closeEvent);
-  if (closeEvent.wasClean) {
+  if (closeEvent.code === 4013) {
+    // The server has too many connections (or we weren't keeping up); back
+    // off before reconnecting. See snippets/admission.py.
+    console.log('Chat socket closed, server busy. Code [' + closeEvent.code + ']');
+    setTimeout(() => oTran.connectWS(), 5000 + Math.random() * 10000);
+  } else if (closeEvent.wasClean) {
     console.log('Chat socket closed, clean close. Code [' + closeEvent.code + ']');
   } else {
     console.error('Chat socket closed, unclean close', closeEvent);
+    // Reconnect; sendStart() resumes from oTran.lastSeq.
+    setTimeout(() => oTran.connectWS(), 1000);
   }
 };
 
+// Let go of the connection while the tab has been hidden for a while, and
+// reconnect, resuming from oTran.lastSeq, once it is shown again, so that a
+// forgotten tab doesn't hold a connection open on the server.
+oTran.hiddenTimeout = 5 * 60 * 1000;
+oTran.hiddenTimer = null;
+oTran.closedWhileHidden = false;
+
+document.addEventListener('visibilitychange', () => {
+  if (document.hidden) {
+    oTran.hiddenTimer = setTimeout(() => {
+      if (oTran.webSocket.readyState === WebSocket.OPEN) {
+        oTran.closedWhileHidden = true;
+        oTran.webSocket.close(1000, 'Hidden');
+      }
+    }, oTran.hiddenTimeout);
+  } else {
+    clearTimeout(oTran.hiddenTimer);
+    if (oTran.closedWhileHidden) {
+      oTran.closedWhileHidden = false;
+      oTran.connectWS();
+    }
+  }
+});
+
 // onError event
 oTran.onerror = function (event) {
   console.error('Websocket error observed: ', event);
@@ -1,9 +1,133 @@
 import graphene
 import channels_graphql_ws
 
-from .types import SnippetType
+from .coalesce import coalescer
+from .eventlog import event_log, resume_from
+from .models import Snippet
+from .groups import event_groups, matches, route, single_snippet_routes, subscriber_groups
+from .types import SnippetDelta, SnippetNotificationType
+from .visibility import PUBLIC, visibility_of_user
 
 from django.conf import settings
+from django.db import transaction
+
+# The columns a notification carries. Mutations read back just these (and the
+# bodyPreview annotation) when they write, so the body column, which can be
+# any size, is never loaded just to tell subscribers about a change.
+NOTIFY_FIELDS = ('id', 'title', 'owner', 'private', 'created', 'version')
+
+
+def notification_data(snippet, changed=None):
+    """
+The snippet as it travels to subscribers: a plain dict of the NOTIFY_FIELDS
+and the body preview, built once per event. Plain values pack small and fast
+through the channel layer, where a model goes through Django's serializers
+and back on every hop.
+
+For an UPDATE, changed is the SnippetInput fields it wrote, which lets
+subscribers that ask for it get just those; see notification_delta().
+    """
+    data = {name: getattr(snippet, name) for name in NOTIFY_FIELDS}
+    data['preview'] = snippet.body_preview
+    if changed:
+        data['changed'] = sorted(changed)
+        data['base_version'] = snippet.version - 1
+    return data
+
+
+def notification_snippet(data):
+    """
+Turns notification_data() back into an (unsaved) Snippet for
+SnippetNotificationType to resolve. The body was never sent, so it is None;
+subscribers get bodyPreview, or fetch the snippet for the rest.
+    """
+    fields = {name: data[name] for name in NOTIFY_FIELDS}
+    snippet = Snippet(body=None, **fields)
+    snippet.preview = data['preview']
+    return snippet
+
+
+def notification_delta(data):
+    """
+The SnippetDelta for an UPDATE's notification_data(), or None if the event
+has to go out whole: it isn't an UPDATE, or it changed private, which can
+show the snippet to subscribers that have never seen it.
+    """
+    changed = data.get('changed')
+    if changed is None or 'private' in changed:
+        return None
+    fields = {name: data[name] for name in ('title', 'created') if name in changed}
+    if 'body' in changed:
+        fields['body_preview'] = data['preview']
+    return SnippetDelta(id=data['id'], version=data['version'], base_version=data['base_version'],
+                        changed=changed, **fields)
+
+
+def deltas(snippet, snippets):
+    """
+(delta, deltas) standing for a payload's snippet or snippets, or None if any
+of them has to go out whole.
+    """
+    if snippet is not None:
+        delta = notification_delta(snippet)
+        return None if delta is None else (delta, None)
+    snippets = [notification_delta(data) for data in snippets]
+    return None if any(delta is None for delta in snippets) else (None, snippets)
+
+
+def coalesce_on_commit(subscription, trans_type, sender, data):
+    """
+Hands an event about one snippet (notification_data()) to the coalescer
+(see coalesce.py) once the current transaction commits, so that subscribers
+never hear about a write that was rolled back. Outside a transaction it
+happens straight away. It reaches subscribers through
+subscription.event_routes().
+    """
+    def emit(trans_type, sender, data):
+        subscription.broadcast_routed(subscription.event_routes(trans_type, sender, data))
+
+    transaction.on_commit(lambda: coalescer.add((subscription, data['id']), trans_type, sender, data, emit))
+
+
+def passthrough_on_commit(subscription, datas, routes):
+    """
+Broadcasts routes (group -> payload, see groups.py) for an event about many
+snippets once the current transaction commits, after anything the coalescer
+holds for those snippets.
+    """
+    keys = [(subscription, data['id']) for data in datas]
+    transaction.on_commit(lambda: coalescer.passthrough(keys, lambda: subscription.broadcast_routed(routes)))
+
+
+def snippet_routes(payload, snippet):
+    """Routes for a payload about one snippet (notification_data())."""
+    return {group: payload for group in event_groups(snippet)}
+
+
+def snippets_routes(payload, snippets):
+    """
+Routes for a payload about many snippets, each group getting a copy of it
+with just the snippets that belong there.
+    """
+    return {group: {**payload, "snippets": routed} for group, routed in route(snippets).items()}
+
+
+def subscriber_visibility(info):
+    # There won't be a user during pytest unit tests.
+    if not hasattr(info.context, "user"):
+        return PUBLIC
+    return visibility_of_user(info.context.user)
+
+
+def narrowed(snippet, snippets, owner, snippet_id):
+    """
+Applies a subscription's owner and snippetId arguments to a payload's
+snippet or snippets. Returns them, or None if nothing is left.
+    """
+    if snippet is not None:
+        return (snippet, None) if matches(snippet, owner, snippet_id) else None
+    snippets = [data for data in snippets if matches(data, owner, snippet_id)]
+    return (None, snippets) if snippets else None
 
 
 # ------------------------------------------------------------------------ SUBSCRIPTIONS
@@ -17,24 +141,43 @@ the updates. In this case, the broadcast_group is CREATE, UPDATE, or DELETE.
     # These are what can be returned to the subscription.
     broadcast_group = graphene.String()  # e.g. CREATE, UPDATE, DELETE
     sender = graphene.String()
-    snippet = graphene.Field(lambda: SnippetType)
+    snippet = graphene.Field(lambda: SnippetNotificationType)
+    # Set instead of snippet when one event covers many, e.g. createSnippets.
+    snippets = graphene.List(lambda: SnippetNotificationType)
+    # Set instead of those for an UPDATE when subscribed with delta.
+    delta = graphene.Field(lambda: SnippetDelta)
+    deltas = graphene.List(lambda: SnippetDelta)
     ok = graphene.Boolean()
+    # Where this event is in the stream, for resuming with sinceSeq; see eventlog.py.
+    seq = graphene.Int()
+    stream = graphene.String()
+    resync = graphene.Boolean()  # the missed events can't be replayed; refetch
 
     # Input arguments sent via GraphQL from the client.
     # Currently keyed-on by the API, e.g. from a mutation.
     class Arguments:
         broadcast_group = graphene.String(required=False,
                                           default_value=None)  # This is the type of event the client wants
+        # Narrow the events down; see groups.py.
+        owner = graphene.String()
+        snippet_id = graphene.ID()
+        include_private = graphene.Boolean(default_value=True)  # the private ones you're allowed to see
+        # Replay what was missed after this seq of this stream first.
+        since_seq = graphene.Int()
+        stream = graphene.String()
+        # Just what an UPDATE changed, where that can be sent; see SnippetDelta.
+        delta = graphene.Boolean(default_value=False)
 
     # Client subscription handler
-    def subscribe(self, info, broadcast_group=None, *args, **kwds):
-        # print("Context [{}]".format(info.context))
-        del info
-
+    def subscribe(self, info, broadcast_group=None, owner=None, snippet_id=None, include_private=True,
+                  since_seq=None, stream=None, delta=False):
         # Returns the list or tuple of subscription group names
         # to which this client has subscribed.
-        # (I dunno who called this, though.)
-        return [broadcast_group] if broadcast_group is not None else None
+        groups = subscriber_groups(subscriber_visibility(info), owner, snippet_id, include_private)
+        if broadcast_group is not None:
+            groups = [f"{broadcast_group}.{group}" for group in groups]
+        resume_from(OnSnippetTransaction, groups, since_seq, stream)
+        return groups
 
     def unsubscribe(self, info, broadcast_group=None, *args, **kwds):
         print("unsubscribe arg was [{}]".format(broadcast_group))
@@ -45,16 +188,23 @@ the updates. In this case, the broadcast_group is CREATE, UPDATE, or DELETE.
     # ANTHONY - For some reason, this only fires if an argument is supplied,
     # even though the argument is not required.
     # Note: the first argument receives the payload/root.
-    def publish(self, info, broadcast_group, *args, **kwds):
+    def publish(self, info, broadcast_group=None, owner=None, snippet_id=None, include_private=True,
+                since_seq=None, stream=None, delta=False):
         """
 The publish method is invoked each time data is triggered to the subscription.
 The data passed through here. Fields set for the class can be set on the return().
         """
 
+        # Missed events couldn't be replayed; see eventlog.py.
+        if self.get("resync"):
+            return OnSnippetTransaction(broadcast_group=broadcast_group, resync=True, ok=True,
+                                        **event_log.position(self))
+
         # The `self` object contains payload delivered from the `broadcast()`.
         # Writing it out as variables to remind of that fact.
         new_msg_sender = self["sender"]
-        new_msg_snippet = self["snippet"]
+        new_msg_snippet = self.get("snippet")
+        new_msg_snippets = self.get("snippets")
 
         # Avoid self-notifications.
         if (
@@ -63,25 +213,76 @@ The data passed through here. Fields set for the class can be set on the return(
         ):
             return OnSnippetTransaction.SKIP
 
+        # The groups already kept out what this subscriber may not see, but
+        # following a snippet and an owner at once needs the owner checked.
+        wanted = narrowed(new_msg_snippet, new_msg_snippets, owner, snippet_id)
+        if wanted is None:
+            return OnSnippetTransaction.SKIP
+        new_msg_snippet, new_msg_snippets = wanted
+
+        # Just what changed, to subscribers that asked and where it will do.
+        changes = deltas(new_msg_snippet, new_msg_snippets) if delta else None
+        if changes is not None:
+            return OnSnippetTransaction(
+                broadcast_group=broadcast_group, sender=new_msg_sender, delta=changes[0], deltas=changes[1],
+                ok=True, **event_log.position(self)
+            )
+
+        # The payload carries notification_data() dicts; the snippet fields want Snippets.
+        if new_msg_snippet is not None:
+            new_msg_snippet = notification_snippet(new_msg_snippet)
+        if new_msg_snippets is not None:
+            new_msg_snippets = [notification_snippet(data) for data in new_msg_snippets]
+
         if settings.DEBUG:
             print("publish returning [{},{},{}]".format(broadcast_group, new_msg_sender, new_msg_snippet))
         return OnSnippetTransaction(
-            broadcast_group=broadcast_group, sender=new_msg_sender, snippet=new_msg_snippet, ok=True
+            broadcast_group=broadcast_group, sender=new_msg_sender, snippet=new_msg_snippet,
+            snippets=new_msg_snippets, ok=True, **event_log.position(self)
         )
 
     # Auxiliary function to send subscription notifications.
     # Might be called from a mutation, e.g.
+    # For an UPDATE, changed is the fields written; see notification_data().
     @classmethod
-    def snippet_event(cls, broadcast_group, sender, snippet):
+    def snippet_event(cls, broadcast_group, sender, snippet, changed=None):
         if settings.DEBUG:
             print("snippet_event [{},{},{}]".format(broadcast_group, sender, snippet))
 
-        # Call broadcast to notify all subscriptions in the group.
-        # Sending to group = None means all the subscriptions of type will be triggered.
-        cls.broadcast(
-            group=broadcast_group,
-            payload={"sender": sender, "snippet": snippet},
-        )
+        # Events for one snippet within the coalescing window go out as one.
+        coalesce_on_commit(cls, broadcast_group, sender, notification_data(snippet, changed))
+
+    # The same for many snippets at once.
+    @classmethod
+    def snippets_event(cls, broadcast_group, sender, snippets, changed=None):
+        if settings.DEBUG:
+            print("snippets_event [{},{},{} snippets]".format(broadcast_group, sender, len(snippets)))
+
+        datas = [notification_data(s, changed) for s in snippets]
+        routes = snippets_routes({"sender": sender}, datas)
+        passthrough_on_commit(cls, datas, cls.with_broadcast_group(broadcast_group, routes))
+
+    @classmethod
+    def event_routes(cls, broadcast_group, sender, data):
+        """
+Notify the subscriptions in the groups this snippet belongs to, with and
+without the broadcast_group.
+        """
+        routes = snippet_routes({"sender": sender, "snippet": data}, data)
+        return cls.with_broadcast_group(broadcast_group, routes)
+
+    @staticmethod
+    def with_broadcast_group(broadcast_group, routes):
+        return {**routes, **{f"{broadcast_group}.{group}": payload for group, payload in routes.items()}}
+
+    @classmethod
+    def broadcast_routed(cls, routes):
+        """
+One broadcast per group; see groups.py. Call from synchronous code. Every
+process's event log gets the whole event first; see eventlog.py.
+        """
+        for group, payload in event_log.announce(cls, routes).items():
+            cls.broadcast(group=group, payload=payload)
 
 
 class OnSnippetNoGroup(channels_graphql_ws.Subscription):
@@ -98,23 +299,39 @@ CREATE, UPDATE, or DELETE.
     # In this case, I specifically don't have a broadcast_group as the type.
     trans_type = graphene.String()  # e.g. CREATE, UPDATE, DELETE
     sender = graphene.String()
-    snippet = graphene.Field(lambda: SnippetType)
+    snippet = graphene.Field(lambda: SnippetNotificationType)
+    # Set instead of snippet when one event covers many, e.g. createSnippets.
+    snippets = graphene.List(lambda: SnippetNotificationType)
+    # Set instead of those for an UPDATE when subscribed with delta.
+    delta = graphene.Field(lambda: SnippetDelta)
+    deltas = graphene.List(lambda: SnippetDelta)
     ok = graphene.Boolean()
+    # Where this event is in the stream, for resuming with sinceSeq; see eventlog.py.
+    seq = graphene.Int()
+    stream = graphene.String()
+    resync = graphene.Boolean()  # the missed events can't be replayed; refetch
 
     # Input arguments sent via GraphQL from the client.
     # Currently keyed-on by the API, e.g. from a mutation.
     class Arguments:
         # trans_type = graphene.String()
-        pass
-
-    def subscribe(self, info, *args, **kwds):
-        # print("Context [{}]".format(info.context))
-        del info
-
+        # Narrow the events down; see groups.py.
+        owner = graphene.String()
+        snippet_id = graphene.ID()
+        include_private = graphene.Boolean(default_value=True)  # the private ones you're allowed to see
+        # Replay what was missed after this seq of this stream first.
+        since_seq = graphene.Int()
+        stream = graphene.String()
+        # Just what an UPDATE changed, where that can be sent; see SnippetDelta.
+        delta = graphene.Boolean(default_value=False)
+
+    def subscribe(self, info, owner=None, snippet_id=None, include_private=True, since_seq=None, stream=None,
+                  delta=False):
         # Returns the list or tuple of subscription group names
         # to which this client has subscribed.
-        # (I dunno who called this, though.)
-        return None
+        groups = subscriber_groups(subscriber_visibility(info), owner, snippet_id, include_private)
+        resume_from(OnSnippetNoGroup, groups, since_seq, stream)
+        return groups
 
     def unsubscribe(self, info, *args, **kwds):
         print("You are unsubscribed")
@@ -123,16 +340,22 @@ CREATE, UPDATE, or DELETE.
     # even though the argument is not required.
     #
     # Note: the first argument, self, receives the payload/root.
-    def publish(self, info, *args, **kwds):
+    def publish(self, info, owner=None, snippet_id=None, include_private=True, since_seq=None, stream=None,
+                delta=False):
         """
 The publish method is invoked each time data is triggered to the subscription.
 The data passed through here. Fields set for the class can be set on the return().
         """
 
+        # As in OnSnippetTransaction.
+        if self.get("resync"):
+            return OnSnippetNoGroup(resync=True, ok=True, **event_log.position(self))
+
         # The `self` object contains payload delivered from the `broadcast()`.
         # Writing it out as variables to remind of that fact.
         new_msg_sender = self["sender"]
-        new_msg_snippet = self["snippet"]
+        new_msg_snippet = self.get("snippet")
+        new_msg_snippets = self.get("snippets")
         new_msg_trans_type = self["trans_type"]
 
         # Avoid self-notifications
@@ -145,24 +368,143 @@ The data passed through here. Fields set for the class can be set on the return(
             print("Avoiding self-notification")
             return OnSnippetNoGroup.SKIP
 
+        # As in OnSnippetTransaction.
+        wanted = narrowed(new_msg_snippet, new_msg_snippets, owner, snippet_id)
+        if wanted is None:
+            return OnSnippetNoGroup.SKIP
+        new_msg_snippet, new_msg_snippets = wanted
+
+        # As in OnSnippetTransaction.
+        changes = deltas(new_msg_snippet, new_msg_snippets) if delta else None
+        if changes is not None:
+            return OnSnippetNoGroup(
+                sender=new_msg_sender, delta=changes[0], deltas=changes[1], ok=True,
+                trans_type=new_msg_trans_type, **event_log.position(self)
+            )
+
+        # The payload carries notification_data() dicts; the snippet fields want Snippets.
+        if new_msg_snippet is not None:
+            new_msg_snippet = notification_snippet(new_msg_snippet)
+        if new_msg_snippets is not None:
+            new_msg_snippets = [notification_snippet(data) for data in new_msg_snippets]
+
         if settings.DEBUG:
             print("publish returning [{},{}]".format(new_msg_sender, new_msg_snippet))
         return OnSnippetNoGroup(
-            sender=new_msg_sender, snippet=new_msg_snippet, ok=True, trans_type=new_msg_trans_type
+            sender=new_msg_sender, snippet=new_msg_snippet, snippets=new_msg_snippets, ok=True,
+            trans_type=new_msg_trans_type, **event_log.position(self)
         )
 
     # Auxiliary function to send subscription notifications.
     # Might be called from a mutation, e.g.
+    # For an UPDATE, changed is the fields written; see notification_data().
     @classmethod
-    def snippet_event(cls, trans_type, sender, snippet):
+    def snippet_event(cls, trans_type, sender, snippet, changed=None):
         if settings.DEBUG:
             print("snippet_event [{},{},{}]".format(trans_type, sender, snippet))
 
-        # Call broadcast to notify all subscriptions in the group.
-        # Sending to group = None means all the subscriptions of type will be triggered.
-        cls.broadcast(
-            payload={"sender": sender, "snippet": snippet, "trans_type": trans_type},
-        )
+        # Events for one snippet within the coalescing window go out as one.
+        coalesce_on_commit(cls, trans_type, sender, notification_data(snippet, changed))
+
+    # The same for many snippets at once.
+    @classmethod
+    def snippets_event(cls, trans_type, sender, snippets, changed=None):
+        if settings.DEBUG:
+            print("snippets_event [{},{},{} snippets]".format(trans_type, sender, len(snippets)))
+
+        datas = [notification_data(s, changed) for s in snippets]
+        passthrough_on_commit(cls, datas, snippets_routes({"sender": sender, "trans_type": trans_type}, datas))
+
+    @classmethod
+    def event_routes(cls, trans_type, sender, data):
+        """Notify the subscriptions in the groups this snippet belongs to."""
+        return snippet_routes({"sender": sender, "snippet": data, "trans_type": trans_type}, data)
+
+    @classmethod
+    def broadcast_routed(cls, routes):
+        """
+One broadcast per group; see groups.py. Call from synchronous code. Every
+process's event log gets the whole event first; see eventlog.py.
+        """
+        for group, payload in event_log.announce(cls, routes).items():
+            cls.broadcast(group=group, payload=payload)
+
+
+class OnSnippetChanged(channels_graphql_ws.Subscription):
+    """
+Everything that happens to one snippet, e.g. for its detail page. It joins
+only that snippet's groups (snippet.<id>...; see groups.py), and events are
+sent only to those, so an event costs as much as the number of connections
+watching its snippet, and nothing for snippets nobody watches.
+    """
+
+    trans_type = graphene.String()  # e.g. CREATE, UPDATE, DELETE
+    sender = graphene.String()
+    snippet = graphene.Field(lambda: SnippetNotificationType)
+    # Set instead of snippet for an UPDATE when subscribed with delta.
+    delta = graphene.Field(lambda: SnippetDelta)
+    ok = graphene.Boolean()
+    # Where this event is in the stream, for resuming with sinceSeq; see eventlog.py.
+    seq = graphene.Int()
+    stream = graphene.String()
+    resync = graphene.Boolean()  # the missed events can't be replayed; refetch
+
+    class Arguments:
+        id = graphene.ID(required=True)
+        # As for onSnippetNoGroup.
+        since_seq = graphene.Int()
+        stream = graphene.String()
+        delta = graphene.Boolean(default_value=False)
+
+    def subscribe(self, info, id, since_seq=None, stream=None, delta=False):
+        groups = subscriber_groups(subscriber_visibility(info), snippet_id=id)
+        resume_from(OnSnippetChanged, groups, since_seq, stream)
+        return groups
+
+    def publish(self, info, id, since_seq=None, stream=None, delta=False):
+        # As in OnSnippetNoGroup.
+        if self.get("resync"):
+            return OnSnippetChanged(resync=True, ok=True, **event_log.position(self))
+
+        sender = self["sender"]
+        if (
+                hasattr(info.context, "user") and
+                info.context.user.is_authenticated
+                and sender == info.context.user.username
+        ):
+            return OnSnippetChanged.SKIP
+
+        # Events about many snippets reach this snippet's groups with just it.
+        snippet = self.get("snippet") or self["snippets"][0]
+        changes = deltas(snippet, None) if delta else None
+        if changes is not None:
+            return OnSnippetChanged(sender=sender, trans_type=self["trans_type"], delta=changes[0], ok=True,
+                                    **event_log.position(self))
+        return OnSnippetChanged(sender=sender, trans_type=self["trans_type"], snippet=notification_snippet(snippet),
+                                ok=True, **event_log.position(self))
+
+    # As in OnSnippetNoGroup.
+    @classmethod
+    def snippet_event(cls, trans_type, sender, snippet, changed=None):
+        coalesce_on_commit(cls, trans_type, sender, notification_data(snippet, changed))
+
+    @classmethod
+    def snippets_event(cls, trans_type, sender, snippets, changed=None):
+        datas = [notification_data(s, changed) for s in snippets]
+        routes = snippets_routes({"sender": sender, "trans_type": trans_type}, datas)
+        passthrough_on_commit(cls, datas, single_snippet_routes(routes))
+
+    @classmethod
+    def event_routes(cls, trans_type, sender, data):
+        """Notify the subscriptions watching this snippet."""
+        routes = snippet_routes({"sender": sender, "snippet": data, "trans_type": trans_type}, data)
+        return single_snippet_routes(routes)
+
+    @classmethod
+    def broadcast_routed(cls, routes):
+        """As OnSnippetNoGroup.broadcast_routed()."""
+        for group, payload in event_log.announce(cls, routes).items():
+            cls.broadcast(group=group, payload=payload)
 
 
 # GraphQL subscription
@@ -171,3 +513,4 @@ class Subscription(graphene.ObjectType):
     # Remember to use CamelCase, though.
     on_snippet_event = OnSnippetTransaction.Field()
     on_snippet_no_group = OnSnippetNoGroup.Field()
+    on_snippet_changed = OnSnippetChanged.Field()
@@ -0,0 +1,166 @@
+import asyncio
+from unittest import mock
+
+import channels
+import channels.testing
+import django
+from channels_graphql_ws.client import GraphqlWsResponseError
+from django.test import SimpleTestCase, TestCase
+
+from snippets.admission import CLOSE_IDLE, CLOSE_TRY_AGAIN_LATER, Admission, admission
+from snippets.tests.test_subscriptions import my_consumer_client
+from snippets.wire import GRAPHQL_WS
+
+"""
+Tests for websocket connection limits and idle connections (snippets/admission.py).
+"""
+
+
+class Connection:
+    """Stands in for a MyGraphqlWsConsumer; connections are held weakly."""
+
+
+class AdmissionTestCase(SimpleTestCase):
+
+    def test_limits(self):
+        limits = Admission(max_connections=3, max_connections_per_user=2, max_subscriptions=2)
+        first, second, third, anonymous = Connection(), Connection(), Connection(), Connection()
+        self.assertTrue(limits.admit(first, 1))
+        self.assertTrue(limits.admit(second, 1))
+        self.assertFalse(limits.admit(third, 1), "Too many for user 1")
+        self.assertTrue(limits.admit(third, 2))
+        self.assertFalse(limits.admit(anonymous), "Too many in all")
+
+        limits.release(first, 1)
+        self.assertTrue(limits.admit(anonymous))
+        self.assertFalse(limits.admit_subscription(2))
+        self.assertTrue(limits.admit_subscription(1))
+        limits.subscribed()
+        limits.subscribed()
+        limits.subscribed(-1)
+
+        stats = limits.stats()
+        self.assertEquals((3, 3, 2, 1, 1, 1, 1), (
+            stats['connections'], stats['peak_connections'], stats['users'], stats['subscriptions'],
+            stats['rejected_connections'], stats['rejected_user_connections'], stats['rejected_subscriptions'],
+        ))
+
+    def test_unlimited(self):
+        limits = Admission(max_connections=0, max_connections_per_user=0, max_subscriptions=0)
+        connections = [Connection() for _ in range(100)]
+        self.assertTrue(all(limits.admit(connection, 1) for connection in connections))
+        self.assertTrue(limits.admit_subscription(1000))
+
+    def test_forgotten_connection(self):
+        """A connection that is never released stops counting once it's gone."""
+        limits = Admission(max_connections=1)
+        connection = Connection()
+        self.assertTrue(limits.admit(connection, 1))
+        del connection
+        self.assertEquals(0, len(limits))
+        self.assertTrue(limits.admit(Connection(), 1))
+
+
+class AdmissionConsumerTestCase(TestCase):
+
+    def setUp(self):
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        self.addCleanup(lambda: asyncio.set_event_loop(asyncio.new_event_loop()))
+        self.addCleanup(event_loop.close)
+
+    def communicator(self):
+        from snippets.consumer import MyGraphqlWsConsumer
+
+        class Consumer(MyGraphqlWsConsumer):
+            send_keepalive_every = None
+
+        application = channels.routing.URLRouter([
+            django.urls.path("graphql/", channels.auth.AuthMiddlewareStack(Consumer.as_asgi())),
+        ])
+        return channels.testing.WebsocketCommunicator(application, "graphql/", subprotocols=[GRAPHQL_WS])
+
+    def test_too_many_connections(self):
+        """Past the limit, a connection is accepted and closed, for the client to try again later."""
+        async def run_test():
+            first, second = self.communicator(), self.communicator()
+            self.assertTrue((await first.connect())[0])
+            self.assertTrue((await second.connect())[0])
+            self.assertEquals({"type": "websocket.close", "code": CLOSE_TRY_AGAIN_LATER},
+                              await second.receive_output(timeout=5))
+            await second.disconnect()
+
+            # Room again once the first has gone.
+            await first.disconnect()
+            third = self.communicator()
+            self.assertTrue((await third.connect())[0])
+            self.assertTrue(await third.receive_nothing())
+            await third.disconnect()
+
+        rejected = admission.rejected_connections
+        with mock.patch.object(admission, 'max_connections', 1):
+            asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEquals(rejected + 1, admission.rejected_connections)
+        self.assertEquals(0, len(admission))
+
+    def test_idle(self):
+        """A connection with no subscriptions is closed once it has been quiet for the idle timeout."""
+        async def run_test():
+            comm = self.communicator()
+            await comm.connect()
+            await comm.send_json_to({"type": "connection_init", "payload": {}})
+            self.assertEquals("connection_ack", (await comm.receive_json_from())["type"])
+            self.assertEquals({"type": "websocket.close", "code": CLOSE_IDLE}, await comm.receive_output(timeout=5))
+            await comm.disconnect()
+
+        reaped = admission.reaped
+        with mock.patch.object(admission, 'idle_timeout', 0.2):
+            asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEquals(reaped + 1, admission.reaped)
+
+    def test_too_many_subscriptions(self):
+        """A subscription past the limit gets an error; the ones before it keep going."""
+        subscription = "subscription { onSnippetNoGroup { snippet { id } } }"
+
+        async def run_test():
+            client = my_consumer_client()
+            await client.connect_and_init()
+            await client.subscribe(subscription)
+            with self.assertRaisesRegex(GraphqlWsResponseError, "Too many subscriptions"):
+                await client.subscribe(subscription)
+            self.assertEquals(1, admission.stats()['subscriptions'])
+            await client.finalize()
+
+        with mock.patch.object(admission, 'max_subscriptions', 1):
+            asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEquals(0, admission.stats()['subscriptions'], "Disconnecting ends them")
+
+    def test_subscriptions_counted(self):
+        """
+Subscriptions count from START to STOP. A START reusing the operation id of
+a running one is turned down as such, not counted against the limit.
+        """
+        subscription = "subscription { onSnippetNoGroup { snippet { id } } }"
+
+        async def run_test():
+            client = my_consumer_client()
+            await client.connect_and_init()
+            op_id = await client.subscribe(subscription)
+            self.assertEquals(1, admission.stats()['subscriptions'])
+
+            await client.send(msg_id=op_id, msg_type="start", payload={"query": subscription})
+            with self.assertRaisesRegex(GraphqlWsResponseError, "already exists"):
+                await client.receive(wait_id=op_id)
+            self.assertEquals((1, rejected), (admission.stats()['subscriptions'], admission.rejected_subscriptions))
+
+            await client.send(msg_id=op_id, msg_type="stop")
+            await client.receive(assert_id=op_id, assert_type="complete")
+            self.assertEquals(0, admission.stats()['subscriptions'])
+            await client.subscribe(subscription)
+            self.assertEquals(1, admission.stats()['subscriptions'])
+            await client.finalize()
+
+        rejected = admission.rejected_subscriptions
+        with mock.patch.object(admission, 'max_subscriptions', 1):
+            asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEquals(0, admission.stats()['subscriptions'])
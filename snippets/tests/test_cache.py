@@ -0,0 +1,72 @@
+import tempfile
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from mysite.channel_layer import UnixSocketChannelLayer
+from snippets.cache import VisibilityCache
+from snippets.visibility import PUBLIC, SUPERUSER, owner_class
+
+"""
+Tests for the limitedSnippets cache across processes (snippets/cache.py).
+
+Two caches with layers given the same path behave like two worker processes.
+"""
+
+
+class VisibilityCacheTestCase(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.layers = [UnixSocketChannelLayer(path=tmp.name) for _ in range(2)]
+        for layer in self.layers:
+            self.addCleanup(layer._stop)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_invalidate_other_processes(self):
+        here, there = (VisibilityCache(channel_layer=layer) for layer in self.layers)
+        for cache in (here, there):
+            cache._listener.wait()
+            for visibility in (PUBLIC, owner_class('admin'), owner_class('john.smith'), SUPERUSER):
+                cache.get_or_set((visibility, 'page'), lambda: [visibility])
+
+        # A private snippet of john.smith's: his pages and SuperUser's go.
+        with self.captureOnCommitCallbacks(execute=True):
+            here.invalidate('john.smith', public=False)
+            self.assertEqual(2, len(here), "Dropped here straight away")
+            self.assertEqual(4, len(there), "Told there only once committed")
+        self.assertTrue(self.wait_for(lambda: len(there) == 2))
+        self.assertEqual([PUBLIC, owner_class('admin')], [key[0] for key in there._entries])
+        self.assertEqual((1, 0), (there.stats()['remote_invalidations'], here.stats()['remote_invalidations']))
+
+        # A public one: everything goes.
+        with self.captureOnCommitCallbacks(execute=True):
+            there.invalidate('admin', public=True)
+        self.assertTrue(self.wait_for(lambda: len(here) == 0))
+
+    def test_not_listening_yet(self):
+        """Reads don't wait for the listener, and aren't kept until it has joined."""
+        cache = VisibilityCache(channel_layer=self.layers[0])
+        joined = cache._listener.start()
+        with mock.patch.object(joined, 'done', return_value=False):
+            self.assertEqual("first", cache.get_or_set((PUBLIC, 'page'), lambda: "first"))
+        self.assertEqual(0, len(cache))
+        cache._listener.wait()
+        cache.get_or_set((PUBLIC, 'page'), lambda: "second")
+        self.assertEqual("second", cache.get_or_set((PUBLIC, 'page'), lambda: "third"))
+
+    def test_ttl(self):
+        cache = VisibilityCache(ttl=0.1, channel_layer=self.layers[0])
+        cache._listener.wait()
+        self.assertEqual("first", cache.get_or_set((PUBLIC, 'page'), lambda: "first"))
+        self.assertEqual("first", cache.get_or_set((PUBLIC, 'page'), lambda: "second"))
+        time.sleep(0.2)
+        self.assertEqual("second", cache.get_or_set((PUBLIC, 'page'), lambda: "second"))
+        self.assertEqual((2, 1), (cache.misses, cache.hits))
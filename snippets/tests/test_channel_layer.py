@@ -0,0 +1,186 @@
+from django.test import SimpleTestCase
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from channels.exceptions import ChannelFull
+
+from mysite.channel_layer import UnixSocketChannelLayer
+
+"""
+Tests for the Unix socket channel layer (mysite/channel_layer.py).
+
+Two layers given the same path behave like two worker processes, so most of
+these run in this process. One starts a real second process.
+"""
+
+# Run by a second interpreter: joins "snippets", prints its channel name,
+# then prints the payload of each message it receives.
+CHILD = '''
+import asyncio, sys
+from mysite.channel_layer import UnixSocketChannelLayer
+
+async def main(path, count):
+    layer = UnixSocketChannelLayer(path=path)
+    channel = await layer.new_channel()
+    await layer.group_add("snippets", channel)
+    print(channel, flush=True)
+    for _ in range(count):
+        message = await layer.receive(channel)
+        print(message["payload"].decode(), flush=True)
+    await layer.close()
+
+asyncio.run(main(sys.argv[1], int(sys.argv[2])))
+'''
+
+
+class ChannelLayerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def layer(self, **kwargs):
+        return UnixSocketChannelLayer(path=self.path, **kwargs)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=5)
+
+    async def test_group_send_across_processes(self):
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        child = subprocess.Popen(
+            [sys.executable, "-c", CHILD, self.path, "2"],
+            stdout=subprocess.PIPE, env=env, universal_newlines=True,
+        )
+        try:
+            channel = child.stdout.readline().strip()
+            self.assertIn("!", channel)
+
+            layer = self.layer()
+            mine = await layer.new_channel()
+            await layer.group_add("snippets", mine)
+
+            # Bytes, as channels_graphql_ws broadcasts them.
+            await layer.group_send("snippets", {"type": "broadcast", "payload": b"first"})
+            await layer.group_send("snippets", {"type": "broadcast", "payload": b"second"})
+
+            self.assertEqual((await self.receive(layer, mine))["payload"], b"first")
+            self.assertEqual((await self.receive(layer, mine))["payload"], b"second")
+            output, _ = child.communicate(timeout=10)
+            self.assertEqual(output.split(), ["first", "second"])
+            self.assertEqual(layer.stats()['sent'], 2)
+            await layer.close()
+        finally:
+            child.kill()
+            child.wait()
+
+    async def test_one_datagram_per_process(self):
+        sender, other = self.layer(), self.layer()
+        channels = [await other.new_channel() for _ in range(3)]
+        for channel in channels:
+            await sender.group_add("snippets", channel)
+
+        await sender.group_send("snippets", {"type": "event", "n": 1})
+        for channel in channels:
+            self.assertEqual(await self.receive(other, channel), {"type": "event", "n": 1})
+        self.assertEqual(sender.stats()['sent'], 1)
+        self.assertEqual(other.stats()['received'], 3)
+
+        await sender.group_discard("snippets", channels[0])
+        await sender.group_send("snippets", {"type": "event", "n": 2})
+        self.assertEqual(await self.receive(other, channels[1]), {"type": "event", "n": 2})
+        self.assertNotIn(channels[0], other._channels)
+
+        await sender.close()
+        await other.close()
+
+    async def test_capacity(self):
+        sender, other = self.layer(), self.layer(capacity=2)
+        channel = await other.new_channel()
+        await sender.group_add("snippets", channel)
+
+        for n in range(3):
+            await sender.group_send("snippets", {"type": "event", "n": n})
+        # All three have to arrive before anything is received, or there is
+        # room for the third after all.
+        for _ in range(100):
+            if other.stats()['dropped_full']:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual((await self.receive(other, channel))["n"], 0)
+        self.assertEqual((await self.receive(other, channel))["n"], 1)
+        self.assertEqual(other.stats()['dropped_full'], 1)
+
+        # Locally, send() can tell the channel is full.
+        await other.send(channel, {"type": "event"})
+        await other.send(channel, {"type": "event"})
+        with self.assertRaises(ChannelFull):
+            await other.send(channel, {"type": "event"})
+
+        await sender.close()
+        await other.close()
+
+    async def test_large_message(self):
+        """A message bigger than a datagram can be, e.g. a bulk event, goes through a file."""
+        sender, other = self.layer(expiry=0.1), self.layer()
+        channels = [await other.new_channel() for _ in range(2)]
+        for channel in channels:
+            await sender.group_add("snippets", channel)
+
+        payload = os.urandom(300 * 1024)
+        await sender.group_send("snippets", {"type": "broadcast", "payload": payload})
+        for channel in channels:
+            self.assertEqual((await self.receive(other, channel))["payload"], payload)
+        self.assertEqual((sender.stats()['spilled'], sender.stats()['sent']), (1, 1))
+
+        # Removed once expired.
+        messages = os.path.join(self.path, "messages")
+        self.assertEqual(len(os.listdir(messages)), 1)
+        time.sleep(0.2)
+        sender._last_clean = 0.0  # Not waiting out CLEAN_INTERVAL.
+        await sender.group_send("snippets", {"type": "event"})
+        self.assertEqual(os.listdir(messages), [])
+        self.assertEqual(sender.stats()['spilled'], 1, "Small messages still go inline")
+
+        await sender.close()
+        await other.close()
+
+    async def test_expiry(self):
+        layer = self.layer(expiry=0.1)
+        channel = await layer.new_channel()
+        await layer.send(channel, {"type": "old"})
+        time.sleep(0.2)
+        layer.expiry = 60
+        await layer.send(channel, {"type": "new"})
+
+        self.assertEqual(await self.receive(layer, channel), {"type": "new"})
+        self.assertEqual(layer.stats()['dropped_expired'], 1)
+        await layer.close()
+
+    async def test_process_gone(self):
+        sender, gone = self.layer(), self.layer()
+        channel = await gone.new_channel()
+        await sender.group_add("snippets", channel)
+        await gone.close()
+
+        await sender.group_send("snippets", {"type": "event"})
+        self.assertEqual(sender.stats()['dropped_unreachable'], 1)
+        self.assertEqual(sender._group_members("snippets"), [])
+        await sender.close()
+
+    async def test_closed(self):
+        """A closed layer doesn't bind its socket again, e.g. for a listener thread still receiving."""
+        layer = self.layer()
+        await layer.new_channel()
+        socket_path = layer._socket_path(layer.process_name)
+        self.assertTrue(os.path.exists(socket_path))
+        await layer.close()
+        await layer.new_channel()
+        self.assertFalse(os.path.exists(socket_path))
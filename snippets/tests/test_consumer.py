@@ -0,0 +1,52 @@
+import dataclasses
+import hashlib
+import inspect
+
+from channels_graphql_ws import GraphqlWsConsumer
+from django.test import SimpleTestCase
+
+from snippets.consumer import MyGraphqlWsConsumer
+
+"""
+Tests that MyGraphqlWsConsumer (snippets/consumer.py) still fits the private
+parts of channels_graphql_ws's GraphqlWsConsumer it overrides and calls.
+requirements.txt pins the version these were checked against. When one of
+these fails after an upgrade, go through consumer.py against the new
+version before updating them.
+"""
+
+# Private methods consumer.py overrides or calls, with their parameters.
+PRIVATE_METHODS = {
+    '_on_gql_start': ['self', 'operation_id', 'payload'],
+    '_on_gql_stop': ['self', 'operation_id'],
+    '_register_subscription': ['self', 'operation_id', 'groups', 'publish_callback', 'unsubscribed_callback'],
+    '_send_gql_data': ['self', 'operation_id', 'data', 'errors'],
+    '_send_gql_complete': ['self', 'operation_id'],
+    '_run_in_worker': ['self', 'func'],
+    '_spawn_background_task': ['self', 'awaitable'],
+    '_assert_thread': ['self'],
+    '_format_error': ['error'],
+}
+
+# MyGraphqlWsConsumer._add_subscription() mirrors the body of this one.
+REGISTER_SUBSCRIPTION_SHA256 = 'df94a439641f525ec4ed17f8f75aff08ee6675e8d4382f18c61fb65333334aa3'
+
+
+class UpstreamConsumerTestCase(SimpleTestCase):
+
+    def test_private_methods(self):
+        for name, parameters in PRIVATE_METHODS.items():
+            with self.subTest(name):
+                self.assertEquals(parameters, list(inspect.signature(getattr(GraphqlWsConsumer, name)).parameters))
+                # Overridden with the same parameters.
+                self.assertEquals(parameters, list(inspect.signature(getattr(MyGraphqlWsConsumer, name)).parameters))
+
+    def test_subscription_registry(self):
+        """What _add_subscription() keeps for each subscription, as _on_gql_stop() and broadcast() expect it."""
+        self.assertEquals(['sid', 'groups', 'notification_queue', 'notifier_task', 'unsubscribed_callback'],
+                          [field.name for field in dataclasses.fields(GraphqlWsConsumer._SubInf)])
+
+    def test_register_subscription_unchanged(self):
+        source = inspect.getsource(GraphqlWsConsumer._register_subscription)
+        self.assertEquals(REGISTER_SUBSCRIPTION_SHA256, hashlib.sha256(source.encode()).hexdigest(),
+                          "GraphqlWsConsumer._register_subscription() changed; update _add_subscription() to match")
@@ -0,0 +1,80 @@
+import tempfile
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+
+from mysite.channel_layer import UnixSocketChannelLayer
+from snippets.eventlog import RESYNC, EventLog
+
+"""
+Tests for numbering subscription events across processes (snippets/eventlog.py).
+
+Two event logs with layers given the same path behave like two worker processes.
+"""
+
+
+class OnSnippet:
+    """Stands in for a subscription class; only its name is kept."""
+
+
+def routes(id, private=False):
+    snippet = {"id": id, "owner": "admin", "private": private}
+    groups = ["snippets.private.admin"] if private else ["snippets.public", "snippets.private.admin"]
+    return {group: {"sender": "admin", "snippet": snippet} for group in groups}
+
+
+class EventLogTestCase(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.layers = [UnixSocketChannelLayer(path=tmp.name) for _ in range(2)]
+        for layer in self.layers:
+            self.addCleanup(layer._stop)
+        self.logs = [EventLog(channel_layer=layer) for layer in self.layers]
+        for log in self.logs:
+            async_to_sync(log.listen)()
+            # Listening by now, so not binding a socket after cleanup.
+            async_to_sync(log.caught_up)()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_numbered_where_delivered(self):
+        here, there = self.logs
+        self.assertNotEqual(here.stream, there.stream)
+        sent = [here.announce(OnSnippet, routes(1)),
+                there.announce(OnSnippet, routes(2, private=True)),
+                here.announce(OnSnippet, routes(3))]
+        self.assertTrue(self.wait_for(lambda: here.stats()['seq'] == there.stats()['seq'] == 3))
+
+        # Each process numbers every event, in its own stream, wherever it came from.
+        for log in self.logs:
+            positions = [log.position(route["snippets.private.admin"]) for route in sent]
+            self.assertEqual({log.stream}, {position["stream"] for position in positions})
+            self.assertEqual([1, 2, 3], sorted(position["seq"] for position in positions))
+            # Seeing an event again, e.g. in another group, doesn't renumber it.
+            self.assertEqual(positions[0], log.position(sent[0]["snippets.public"]))
+
+        # There replays its own numbering of events sent from here.
+        first = there.position(sent[0]["snippets.public"])["seq"]
+        payloads, last = there.since(OnSnippet, ["snippets.public"], first, there.stream)
+        self.assertEqual(3, last)
+        self.assertEqual([(3, there.stream)], [(p["snippet"]["id"], p["stream"]) for p in payloads])
+        self.assertEqual(there.position(sent[2]["snippets.public"]), there.position(payloads[0]))
+
+        # A seq of here's stream means nothing there.
+        self.assertIs(RESYNC, there.since(OnSnippet, ["snippets.public"], first, here.stream)[0])
+
+    def test_seen_before_logged(self):
+        """An event a subscriber got before the listener did is left for it to get live."""
+        log = self.logs[0]
+        log.announce(OnSnippet, routes(1))
+        self.assertTrue(self.wait_for(lambda: log.stats()['seq'] == 1))
+        log.number("not logged yet")
+        payloads, last = log.since(OnSnippet, ["snippets.public"], 0, log.stream)
+        self.assertEqual(([1], 1), ([p["snippet"]["id"] for p in payloads], last))
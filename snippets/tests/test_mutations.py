@@ -2,6 +2,8 @@ from graphene_django.utils.testing import GraphQLTestCase  # This has some docum
 import json
 from django.conf import settings
 from . import authenticate_jwt, login_tokenless
+from snippets.cache import limited_snippets_cache
+from snippets.coalesce import coalescer
 
 
 # ./runtests.sh test_mutations
@@ -28,6 +30,14 @@ class SnippetsTestCase(GraphQLTestCase):
 
     # Run before each test
     def setUp(self):
+        # The database is rolled back between tests, but cached pages aren't.
+        limited_snippets_cache.clear()
+
+        # These tests look at each broadcast as the mutation commits;
+        # test_coalesced_events holds them back.
+        window, coalescer.window = coalescer.window, 0
+        self.addCleanup(setattr, coalescer, 'window', window)
+
         print()
         print()
 
@@ -212,6 +222,68 @@ mutation mutCreateSnippet($input: SnippetInput!) {
             "Variables should have passed through"
         )
 
+    # ./runtests.sh test_mutations test_snippets_bulk_create_mutation
+    def test_snippets_bulk_create_mutation(self):
+        """
+createSnippets writes every input with one INSERT and broadcasts once per
+subscription type. One bad input means nothing is written.
+        """
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetTransaction, OnSnippetNoGroup
+
+        mutation = '''
+mutation mutCreateSnippets($inputs: [SnippetInput!]!) {
+  createSnippets(inputs: $inputs) {
+    snippets {
+      id
+      title
+      private
+    }
+    ok
+  }
+}
+        '''
+        inputs = [{'title': f'bulk {i}', 'body': f'BODY {i}', 'private': i % 2 == 0} for i in range(5)]
+
+        with mock.patch.object(OnSnippetTransaction, 'broadcast_routed') as transaction_broadcast, \
+                mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as no_group_broadcast, \
+                CaptureQueriesContext(connection) as ctx, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.query(mutation, op_name='mutCreateSnippets', variables={"inputs": inputs})
+
+        content = json.loads(response.content)
+        if settings.DEBUG:
+            print(json.dumps(content, indent=4))
+        self.assertResponseNoErrors(response)
+        self.assertTrue(content['data']['createSnippets']['ok'], "Records should have been created")
+
+        inserts = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('INSERT INTO "snippets_snippet"')]
+        self.assertEquals(1, len(inserts), "Should be a single INSERT")
+
+        # The ids handed back are the rows' real ids.
+        created = content['data']['createSnippets']['snippets']
+        for input, snippet in zip(inputs, created):
+            row = Snippet.objects.get(pk=snippet['id'])
+            self.assertEquals((input['title'], input['private']), (row.title, row.private))
+
+        self.assertEquals(1, transaction_broadcast.call_count, "One event for OnSnippetTransaction")
+        self.assertEquals(1, no_group_broadcast.call_count, "One event for OnSnippetNoGroup")
+        # Everyone who may see them all gets them all, split by visibility.
+        routes = no_group_broadcast.call_args.args[0]
+        self.assertEquals(2, len(routes['all.public']['snippets']))
+        self.assertEquals(3, len(routes['all.private']['snippets']))
+
+        # The third input has no body.
+        count = Snippet.objects.count()
+        bad = inputs[:2] + [{'title': 'no body'}] + inputs[3:]
+        response = self.query(mutation, op_name='mutCreateSnippets', variables={"inputs": bad})
+        self.assertResponseHasErrors(response)
+        self.assertIn('inputs[2]', json.loads(response.content)['errors'][0]['message'])
+        self.assertEquals(count, Snippet.objects.count(), "Nothing should have been created")
+
     # For update, let's change row 2's body to lorem ipsum.
     # ./runtests.sh test_mutations test_snippet_update_mutation
     def test_snippet_update_mutation(self):
@@ -305,6 +377,259 @@ mutation deleteSnippet($id: ID!) {
             "Record should have been deleted"
         )
 
+    # ./runtests.sh test_mutations test_snippets_bulk_update_delete_mutations
+    def test_snippets_bulk_update_delete_mutations(self):
+        """
+updateSnippets and deleteSnippets each touch all of their rows with one
+statement, skip ids that don't exist, and broadcast once per subscription type.
+        """
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetTransaction, OnSnippetNoGroup
+
+        def run(mutation, op_name, variables):
+            with mock.patch.object(OnSnippetTransaction, 'broadcast_routed') as transaction_broadcast, \
+                    mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as no_group_broadcast, \
+                    CaptureQueriesContext(connection) as ctx, \
+                self.captureOnCommitCallbacks(execute=True):
+                response = self.query(mutation, op_name=op_name, variables=variables)
+
+            content = json.loads(response.content)
+            if settings.DEBUG:
+                print(json.dumps(content, indent=4))
+            self.assertResponseNoErrors(response)
+
+            self.assertEquals(1, transaction_broadcast.call_count, "One event for OnSnippetTransaction")
+            self.assertEquals(1, no_group_broadcast.call_count, "One event for OnSnippetNoGroup")
+            return content['data'], [q['sql'] for q in ctx.captured_queries if '"snippets_snippet"' in q['sql']]
+
+        created = {id: Snippet.objects.get(pk=id).created for id in (1, 3, 4)}
+
+        data, statements = run(
+            '''
+mutation mutUpdateSnippets($ids: [ID!]!, $input: SnippetInput!) {
+  updateSnippets(ids: $ids, input: $input) {
+    ids
+    ok
+  }
+}
+            ''',
+            'mutUpdateSnippets',
+            {"ids": ["1", "3", "4", "999"], "input": {"title": "Cleaned up"}}
+        )
+        self.assertEquals(["1", "3", "4"], data['updateSnippets']['ids'], "999 doesn't exist")
+        self.assertEquals(1, len([sql for sql in statements if sql.startswith('UPDATE')]), "Should be a single UPDATE")
+        for id in (1, 3, 4):
+            snippet = Snippet.objects.get(pk=id)
+            self.assertEquals("Cleaned up", snippet.title)
+            self.assertEquals(created[id], snippet.created, "Only the title should have changed")
+
+        data, statements = run(
+            '''
+mutation mutDeleteSnippets($ids: [ID!]!) {
+  deleteSnippets(ids: $ids) {
+    ids
+    ok
+  }
+}
+            ''',
+            'mutDeleteSnippets',
+            {"ids": ["1", "3", "999"]}
+        )
+        self.assertEquals(["1", "3"], data['deleteSnippets']['ids'])
+        self.assertEquals(1, len([sql for sql in statements if sql.startswith('DELETE')]), "Should be a single DELETE")
+        self.assertFalse(Snippet.objects.filter(pk__in=[1, 3]).exists(), "Rows should be gone")
+        self.assertTrue(Snippet.objects.filter(pk=4).exists(), "Row 4 should be untouched")
+
+    # ./runtests.sh test_mutations test_snippet_update_delete_statements
+    def test_snippet_update_delete_statements(self):
+        """
+updateSnippet writes only the fields it was given, and it and deleteSnippet
+each run one statement, reading back what subscribers are sent but not body.
+        """
+        import sqlite3
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetTransaction
+
+        if sqlite3.sqlite_version_info < (3, 35):
+            self.skipTest("UPDATE/DELETE ... RETURNING needs SQLite 3.35")
+
+        before = Snippet.objects.get(pk=3)
+
+        with mock.patch.object(OnSnippetTransaction, 'broadcast_routed') as broadcast, \
+                CaptureQueriesContext(connection) as ctx, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.query(
+                '''
+mutation updateSnippet($id: ID!, $input: SnippetInput!) {
+  updateSnippet(id: $id, input: $input) {
+    snippet {
+      id
+      title
+    }
+    ok
+  }
+}
+                ''',
+                op_name='updateSnippet',
+                variables={"id": "3", "input": {"title": "Retitled"}}
+            )
+        self.assertResponseNoErrors(response)
+        self.assertEquals("Retitled", json.loads(response.content)['data']['updateSnippet']['snippet']['title'])
+
+        statements = [q['sql'] for q in ctx.captured_queries if '"snippets_snippet"' in q['sql']]
+        self.assertEquals(1, len(statements), statements)
+        set_clause, returning = statements[0].split(' WHERE ')[0], statements[0].split(' RETURNING ')[1]
+        self.assertTrue(statements[0].startswith('UPDATE'), statements[0])
+        self.assertIn('"title"', set_clause)
+        self.assertNotIn('"body"', set_clause, "Only the given fields are written")
+        self.assertNotIn('"created"', set_clause, "Only the given fields are written")
+        self.assertNotRegex(returning, r'(^|, )"snippets_snippet"\."body"(,|$)', "Only the preview of body is read back")
+
+        after = Snippet.objects.get(pk=3)
+        self.assertEquals((before.body, before.created), (after.body, after.created))
+
+        # Subscribers still get everything in NOTIFY_FIELDS, and the preview,
+        # and what changed since which version.
+        sent = broadcast.call_args.args[0]['all.public']['snippet']
+        self.assertEquals(
+            {'id': 3, 'title': "Retitled", 'owner': before.owner, 'private': before.private,
+             'created': before.created, 'version': before.version + 1, 'preview': before.body_preview,
+             'changed': ['title'], 'base_version': before.version},
+            sent
+        )
+        self.assertEquals(before.version + 1, after.version)
+
+        with mock.patch.object(OnSnippetTransaction, 'broadcast_routed') as broadcast, \
+                CaptureQueriesContext(connection) as ctx, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.query(
+                '''
+mutation deleteSnippet($id: ID!) {
+  deleteSnippet(id: $id) {
+    ok
+  }
+}
+                ''',
+                op_name='deleteSnippet',
+                variables={"id": "3"}
+            )
+        self.assertResponseNoErrors(response)
+
+        statements = [q['sql'] for q in ctx.captured_queries if '"snippets_snippet"' in q['sql']]
+        self.assertEquals(1, len(statements), statements)
+        self.assertTrue(statements[0].startswith('DELETE'), statements[0])
+        self.assertEquals("Retitled", broadcast.call_args.args[0]['all.public']['snippet']['title'])
+        self.assertFalse(Snippet.objects.filter(pk=3).exists())
+
+        # A missing id is still an error.
+        response = self.query(
+            '''
+mutation deleteSnippet($id: ID!) {
+  deleteSnippet(id: $id) {
+    ok
+  }
+}
+            ''',
+            op_name='deleteSnippet',
+            variables={"id": "3"}
+        )
+        self.assertResponseHasErrors(response)
+
+    # ./runtests.sh test_mutations test_broadcast_on_commit
+    def test_broadcast_on_commit(self):
+        """
+Notifications go out when the transaction commits, as plain dicts, and not
+at all when it rolls back.
+        """
+        from unittest import mock
+        from django.db import transaction
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_snippet
+
+        snippet = Snippet.objects.get(pk=4)
+
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as broadcast, \
+                self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=snippet)
+                    raise RuntimeError("roll back")
+            except RuntimeError:
+                pass
+        self.assertFalse(broadcast.called, "A rolled back write notifies nobody")
+
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as broadcast, \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=snippet)
+            self.assertFalse(broadcast.called, "Nothing is sent before the commit")
+        self.assertEquals(1, len(callbacks))
+        self.assertEquals(1, broadcast.call_count)
+
+        data = broadcast.call_args.args[0]['all.public']['snippet']
+        self.assertIsInstance(data, dict)
+        self.assertNotIn('body', data)
+        rebuilt = notification_snippet(data)
+        self.assertEquals((snippet.pk, snippet.title, snippet.body_preview),
+                          (rebuilt.pk, rebuilt.title, rebuilt.body_preview))
+
+    # ./runtests.sh test_mutations test_coalesced_events
+    def test_coalesced_events(self):
+        """
+Events for one snippet inside the coalescing window reach subscribers as
+one, with the latest state, and a CREATE then DELETE not at all.
+        """
+        from unittest import mock
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup
+
+        # Long enough that nothing goes out until flush().
+        coalescer.window = 60
+        coalescer.clear()
+        updated, created = Snippet.objects.get(pk=4), Snippet.objects.get(pk=2)
+
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as broadcast, \
+                self.captureOnCommitCallbacks(execute=True):
+            for title in ("First", "Second", "Third"):
+                updated.title = title
+                OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=updated)
+            OnSnippetNoGroup.snippet_event(trans_type="CREATE", sender="SENDER", snippet=created)
+            OnSnippetNoGroup.snippet_event(trans_type="DELETE", sender="SENDER", snippet=created)
+        self.assertFalse(broadcast.called, "Held back until the window closes")
+
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as broadcast:
+            coalescer.flush()
+        self.assertEquals(1, broadcast.call_count)
+        payload = broadcast.call_args.args[0]['all.public']
+        self.assertEquals(("UPDATE", 4, "Third"), (payload['trans_type'], payload['snippet']['id'], payload['snippet']['title']))
+
+        stats = coalescer.stats()
+        self.assertEquals((5, 1, 4), (stats['events'], stats['emitted'], stats['saved']))
+
+        # Merged UPDATEs name everything changed since the first one's base version.
+        with self.captureOnCommitCallbacks(execute=True):
+            for version, changed in ((2, ["title"]), (3, ["body"]), (4, ["title"])):
+                updated.version = version
+                OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=updated, changed=changed)
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed') as broadcast:
+            coalescer.flush()
+        payload = broadcast.call_args.args[0]['all.public']
+        self.assertEquals((["body", "title"], 1, 4), (payload['snippet']['changed'],
+                                                     payload['snippet']['base_version'], payload['snippet']['version']))
+
+        # An UPDATE then a bulk DELETE of the same snippet keeps its order.
+        calls = []
+        with mock.patch.object(OnSnippetNoGroup, 'broadcast_routed', side_effect=calls.append), \
+                self.captureOnCommitCallbacks(execute=True):
+            OnSnippetNoGroup.snippet_event(trans_type="UPDATE", sender="SENDER", snippet=updated)
+            OnSnippetNoGroup.snippets_event(trans_type="DELETE", sender="SENDER", snippets=[updated])
+        self.assertEquals(["UPDATE", "DELETE"], [routes['all.public']['trans_type'] for routes in calls])
+
     # ./runtests.sh test_mutations test_verify_token
     def test_verify_token(self):
 
@@ -4,6 +4,7 @@ from graphene_django.utils.testing import GraphQLTestCase
 import json
 from django.conf import settings
 from . import authenticate_jwt, login_tokenless
+from snippets.cache import limited_snippets_cache
 
 # These two to trap stderr
 import sys
@@ -40,6 +41,11 @@ class SnippetsTestCase(GraphQLTestCase):
 
     # Run before each test
     def setUp(self):
+        # The database is rolled back between tests, but cached pages aren't.
+        limited_snippets_cache.clear()
+        # Pages are only kept once it hears about writes in other processes.
+        limited_snippets_cache._listener.wait()
+
         print()
         print()
 
@@ -53,12 +59,16 @@ Test to returns all snippet records in the fixtures DB.
             '''
 query qryAllSnippets {
   allSnippets {
-    id
-    body
-    created
-    private
-    owner
-    __typename
+    edges {
+      node {
+        id
+        body
+        created
+        private
+        owner
+        __typename
+      }
+    }
   }
   __typename
 }
@@ -76,7 +86,7 @@ query qryAllSnippets {
         self.assertResponseNoErrors(response)
 
         # How many rows returned?
-        rowcount = len(content['data']['allSnippets'])
+        rowcount = len(content['data']['allSnippets']['edges'])
         self.assertEquals(8, rowcount, "Should have found 8 rows")
 
     # ./runtests.sh test_queries test_snippets_limited
@@ -100,13 +110,17 @@ the logged in user.
             '''
 query qryLimitedSnippets {
   limitedSnippets {
-    id
-    title
-    body
-    created
-    private
-    owner
-    __typename
+    edges {
+      node {
+        id
+        title
+        body
+        created
+        private
+        owner
+        __typename
+      }
+    }
   }
   __typename
 }
@@ -124,9 +138,145 @@ query qryLimitedSnippets {
         self.assertResponseNoErrors(response)
 
         # How many rows returned?
-        rowcount = len(content['data']['limitedSnippets'])
+        rowcount = len(content['data']['limitedSnippets']['edges'])
         self.assertEquals(6, rowcount, "Should have found 6 rows")
 
+    # ./runtests.sh test_queries test_snippets_all_paginated
+    def test_snippets_all_paginated(self):
+        """
+Walks allSnippets forwards a page at a time using the endCursor, then
+back again using startCursor. Every row should be seen exactly once.
+        """
+
+        query = '''
+query qryAllSnippetsPage($first: Int, $after: String, $last: Int, $before: String) {
+  allSnippets(first: $first, after: $after, last: $last, before: $before) {
+    edges {
+      cursor
+      node {
+        id
+      }
+    }
+    pageInfo {
+      startCursor
+      endCursor
+      hasNextPage
+      hasPreviousPage
+    }
+  }
+}
+        '''
+
+        forward_ids = []
+        variables = {"first": 3}
+        while True:
+            response = self.query(query, op_name='qryAllSnippetsPage', variables=variables)
+            self.assertResponseNoErrors(response)
+            content = json.loads(response.content)
+            if settings.DEBUG:
+                print(json.dumps(content, indent=4))
+
+            page = content['data']['allSnippets']
+            self.assertTrue(len(page['edges']) <= 3, "Page should not exceed the requested size")
+            forward_ids += [edge['node']['id'] for edge in page['edges']]
+
+            if not page['pageInfo']['hasNextPage']:
+                break
+            variables = {"first": 3, "after": page['pageInfo']['endCursor']}
+
+        self.assertEquals(8, len(forward_ids), "Should have paged through 8 rows")
+        self.assertEquals(8, len(set(forward_ids)), "Pages should not overlap")
+
+        backward_ids = []
+        variables = {"last": 3}
+        while True:
+            response = self.query(query, op_name='qryAllSnippetsPage', variables=variables)
+            self.assertResponseNoErrors(response)
+            content = json.loads(response.content)
+
+            page = content['data']['allSnippets']
+            backward_ids = [edge['node']['id'] for edge in page['edges']] + backward_ids
+
+            if not page['pageInfo']['hasPreviousPage']:
+                break
+            variables = {"last": 3, "before": page['pageInfo']['startCursor']}
+
+        self.assertEquals(forward_ids, backward_ids, "Both directions should agree on the order")
+
+    # ./runtests.sh test_queries test_snippets_column_projection
+    def test_snippets_column_projection(self):
+        """
+The body column should only be read when body itself is selected;
+bodyPreview is computed in SQL.
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        import re
+
+        def without_substr(sql):
+            return re.sub(r'SUBSTR\([^)]*\)', '', sql)
+
+        def snippet_selects(node_fields):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.query(
+                    '''
+query qryAllSnippets {
+  allSnippets {
+    edges {
+      node {
+        ...nodeFields
+      }
+    }
+  }
+}
+fragment nodeFields on SnippetType {
+  %s
+}
+                    ''' % node_fields,
+                    op_name='qryAllSnippets'
+                )
+            self.assertResponseNoErrors(response)
+            return [q['sql'] for q in ctx.captured_queries if 'FROM "snippets_snippet"' in q['sql']]
+
+        selects = snippet_selects("id title")
+        self.assertEquals(1, len(selects), "Should be a single SELECT")
+        self.assertNotIn('"body"', selects[0], "Body should not have been loaded")
+        self.assertNotIn('"owner"', selects[0], "Owner should not have been loaded")
+
+        # bodyPreview is cut by the database, so the body itself stays put.
+        selects = snippet_selects("id bodyPreview")
+        self.assertEquals(1, len(selects), "bodyPreview should not cause a deferred load per row")
+        self.assertIn('SUBSTR(', selects[0], "bodyPreview should come from the database")
+        self.assertNotIn('"body"', without_substr(selects[0]), "Body should not have been loaded")
+
+        # And it should still agree with the body.
+        response = self.query(
+            '''
+query qryAllSnippets {
+  allSnippets {
+    edges {
+      node {
+        body
+        bodyPreview
+      }
+    }
+  }
+}
+            ''',
+            op_name='qryAllSnippets'
+        )
+        self.assertResponseNoErrors(response)
+        for edge in json.loads(response.content)['data']['allSnippets']['edges']:
+            self.assertEquals(edge['node']['body'][:50], edge['node']['bodyPreview'], "Preview should match")
+
+        # Same for the plain Django list page.
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/snippets/')
+        self.assertEquals(200, response.status_code)
+        selects = [q['sql'] for q in ctx.captured_queries if 'FROM "snippets_snippet"' in q['sql']]
+        self.assertEquals(1, len(selects), "Should be a single SELECT")
+        self.assertNotIn('"body"', without_substr(selects[0]), "Body should not have been loaded")
+
     # ./runtests.sh test_queries test_snippets_by_id
     def test_snippets_by_id(self):
         """Gets a snippet for a desired ID. Assumes the record exists or dumps a stack trace."""
@@ -203,6 +353,103 @@ query snippetById($id: String!) {
         # import pudb;pu.db
         self.assertIsNone(id, "Should have gotten null id")
 
+    # ./runtests.sh test_queries test_snippets_batched
+    def test_snippets_batched(self):
+        """
+Several snippetById fields in one operation, and ownerUser on every node of
+a list, should each cost a single query.
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def count_queries(query, op_name, table):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.query(query, op_name=op_name)
+            self.assertResponseNoErrors(response)
+            selects = [q['sql'] for q in ctx.captured_queries if 'FROM "{}"'.format(table) in q['sql']]
+            return json.loads(response.content)['data'], len(selects)
+
+        data, selects = count_queries(
+            '''
+query snippetsById {
+  a: snippetById(id: "1") { ...snippetFields }
+  b: snippetById(id: "3") { ...snippetFields }
+  c: snippetById(id: "4") { ...snippetFields }
+  d: snippetById(id: "1") { ...snippetFields }
+}
+fragment snippetFields on SnippetType {
+  id
+  title
+  ownerUser {
+    username
+  }
+}
+            ''',
+            'snippetsById',
+            'snippets_snippet'
+        )
+        self.assertEquals(["1", "3", "4", "1"], [data[alias]['id'] for alias in 'abcd'])
+        self.assertEquals('john.smith', data['a']['ownerUser']['username'])
+        self.assertEquals('admin', data['b']['ownerUser']['username'])
+        self.assertEquals(1, selects, "All snippetById fields should share one query")
+
+        data, selects = count_queries(
+            '''
+query qryAllSnippets {
+  allSnippets {
+    edges {
+      node {
+        owner
+        ownerUser {
+          username
+        }
+      }
+    }
+  }
+}
+            ''',
+            'qryAllSnippets',
+            'auth_user'
+        )
+        nodes = [edge['node'] for edge in data['allSnippets']['edges']]
+        self.assertGreater(len({node['owner'] for node in nodes}), 1, "Fixture should have several owners")
+        self.assertEquals(1, selects, "Owners should be fetched in one query")
+        for node in nodes:
+            if node['ownerUser'] is not None:
+                self.assertEquals(node['owner'], node['ownerUser']['username'])
+
+    # ./runtests.sh test_queries test_owner_user_public
+    def test_owner_user_public(self):
+        """ownerUser is who owns a snippet, not their account."""
+        from graphql import parse, validate
+        from mysite.schema import schema
+
+        owner_user = schema.get_type('SnippetType').fields['ownerUser'].type
+        self.assertEquals(['id', 'username'], sorted(owner_user.fields))
+        self.assertIn('email', schema.get_type('UserType').fields, "me still has the whole account")
+
+        # Turned away by validation, before anything is resolved.
+        errors = validate(schema, parse('{ snippetById(id: "1") { ownerUser { password } } }'))
+        self.assertEquals(['Cannot query field "password" on type "PublicUserType".'],
+                          [error.message for error in errors])
+
+        response = self.query(
+            '''
+query snippetOwner {
+  snippetById(id: "1") {
+    ownerUser {
+      password
+      email
+    }
+  }
+}
+            ''',
+            op_name='snippetOwner'
+        )
+        errors = json.loads(response.content)['errors']
+        self.assertEquals(2, len(errors))
+        self.assertIn('password', errors[0]['message'])
+
     # ./runtests.sh test_queries test_snippets_by_owner
     def test_snippets_by_owner(self):
         """Tests that records are returned for an authenticated user name that matches owner field in the DB."""
@@ -340,12 +587,16 @@ query qryIdentifyUser{
             '''
 query qryLimitedSnippets {
   limitedSnippets {
-    id
-    title
-    bodyPreview
-    owner
-    isPrivate: private
-    __typename
+    edges {
+      node {
+        id
+        title
+        bodyPreview
+        owner
+        isPrivate: private
+        __typename
+      }
+    }
   }
   __typename
 }
@@ -367,6 +618,288 @@ query qryLimitedSnippets {
         EXPECTED_LIMITED_ROWCOUNT = 6
         self.assertEquals(
             EXPECTED_LIMITED_ROWCOUNT,
-            len(content['data']['limitedSnippets']),
+            len(content['data']['limitedSnippets']['edges']),
             "User should have access to [{}] records".format(EXPECTED_LIMITED_ROWCOUNT)
         )
+
+    # ./runtests.sh test_queries test_token_verification_cached
+    def test_token_verification_cached(self):
+        """
+The same token on two requests should only be verified once, and an
+entry must not be served once the token itself has expired.
+        """
+        from snippets.tokens import token_cache, TokenCache
+
+        payload = {
+            "username": "john.smith",
+            "password": "withscores4!"
+        }
+
+        token = authenticate_jwt(self, payload)
+        token_cache.clear()
+
+        for _ in range(2):
+            response = self.query(
+                '''
+query qryLimitedSnippets {
+  limitedSnippets {
+    edges {
+      node {
+        id
+      }
+    }
+  }
+}
+                ''',
+                op_name='qryLimitedSnippets',
+                variables={},
+                headers={"HTTP_AUTHORIZATION": f"JWT {token}"}
+            )
+            self.assertResponseNoErrors(response)
+
+        self.assertEquals(1, token_cache.misses, "Token should have been verified once")
+        self.assertEquals(1, token_cache.hits, "Second request should have used the cache")
+
+        # A payload whose exp has passed is never handed back.
+        cache = TokenCache(maxsize=2, ttl=300)
+        cache.set("stale", {"username": "john.smith", "exp": 0})
+        self.assertIsNone(cache.get("stale"), "Expired token should not come from the cache")
+
+        # And the cache stays bounded.
+        for i in range(3):
+            cache.set(f"token{i}", {"username": "john.smith"})
+        self.assertEquals(2, len(cache), "Cache should evict beyond maxsize")
+
+    # ./runtests.sh test_queries test_search_snippets
+    def test_search_snippets(self):
+        """
+Full-text search should only find what the user can see, page with
+cursors, and keep up with updates and deletes.
+        """
+
+        query = '''
+query qrySearchSnippets($query: String!, $first: Int, $after: String) {
+  searchSnippets(query: $query, first: $first, after: $after) {
+    edges {
+      node {
+        id
+        title
+      }
+    }
+    pageInfo {
+      endCursor
+      hasNextPage
+    }
+  }
+}
+        '''
+
+        def search_ids(variables):
+            response = self.query(query, op_name='qrySearchSnippets', variables=variables)
+            self.assertResponseNoErrors(response)
+            content = json.loads(response.content)
+            if settings.DEBUG:
+                print(json.dumps(content, indent=4))
+            page = content['data']['searchSnippets']
+            return [edge['node']['id'] for edge in page['edges']], page['pageInfo']
+
+        # AnonymousUser only finds the public one of the four "Item" snippets.
+        ids, _ = search_ids({"query": "item"})
+        self.assertEquals(["4"], ids, "AnonymousUser should only find public snippets")
+
+        # FTS5 syntax is taken literally rather than blowing up.
+        ids, _ = search_ids({"query": 'item" OR NEAR('})
+        self.assertEquals([], ids, "Stray FTS5 operators should be harmless")
+
+        payload = {
+            "input": {
+                "username": "john.smith",
+                "password": "withscores4!"
+            }
+        }
+        is_valid = login_tokenless(self, payload)
+        self.assertTrue(is_valid, "User [{}] did not authenticate".format(payload['input']['username']))
+
+        # john.smith also finds his own private one, one page at a time.
+        found = []
+        variables = {"query": "item", "first": 1}
+        while True:
+            ids, page_info = search_ids(variables)
+            self.assertTrue(len(ids) <= 1, "Page should not exceed the requested size")
+            found += ids
+            if not page_info['hasNextPage']:
+                break
+            variables = {"query": "item", "first": 1, "after": page_info['endCursor']}
+        self.assertEquals(["1", "4"], sorted(found), "Should find public and own snippets")
+
+        # The index follows updates and deletes.
+        from snippets.models import Snippet
+        Snippet.objects.filter(pk=4).update(title="Musical Snippet #4")
+        Snippet.objects.filter(pk=1).delete()
+        ids, _ = search_ids({"query": "item"})
+        self.assertEquals([], ids, "Updated and deleted snippets should drop out of the index")
+        ids, _ = search_ids({"query": "musical snippet"})
+        self.assertEquals(["4"], ids, "Updated title should be searchable")
+
+    # ./runtests.sh test_queries test_limited_snippets_cache
+    def test_limited_snippets_cache(self):
+        """
+Cached limitedSnippets pages are shared per visibility class and dropped
+only when a write could change them.
+        """
+
+        def limited_ids():
+            response = self.query(
+                '''
+query qryLimitedSnippets {
+  limitedSnippets {
+    edges {
+      node {
+        id
+        title
+      }
+    }
+  }
+}
+                ''',
+                op_name='qryLimitedSnippets'
+            )
+            self.assertResponseNoErrors(response)
+            content = json.loads(response.content)
+            return sorted(int(edge['node']['id']) for edge in content['data']['limitedSnippets']['edges'])
+
+        def update_snippet(id, input):
+            response = self.query(
+                '''
+mutation updateSnippet($id: ID!, $input: SnippetInput!) {
+  updateSnippet(id: $id, input: $input) {
+    ok
+  }
+}
+                ''',
+                op_name='updateSnippet',
+                variables={"id": id, "input": input}
+            )
+            self.assertResponseNoErrors(response)
+
+        def login(username):
+            payload = {"input": {"username": username, "password": "withscores4!"}}
+            self.assertTrue(login_tokenless(self, payload), f"User [{username}] did not authenticate")
+
+        public_ids = limited_ids()  # AnonymousUser: miss
+        self.assertEquals(public_ids, limited_ids(), "Second call should match the first")
+        self.assertEquals((1, 1), (limited_snippets_cache.misses, limited_snippets_cache.hits))
+
+        login('john.smith')
+        john_ids = limited_ids()  # john.smith: miss
+        self.assertEquals(2, limited_snippets_cache.misses, "john.smith has his own entry")
+        self.client.logout()
+
+        # Snippet 1 is john.smith's and private, so AnonymousUser's page survives.
+        update_snippet("1", {"title": "Still private", "private": True})
+        self.assertEquals(public_ids, limited_ids())
+        self.assertEquals(2, limited_snippets_cache.hits, "Public page should not have been invalidated")
+
+        login('john.smith')
+        self.assertEquals(john_ids, limited_ids())
+        self.assertEquals(3, limited_snippets_cache.misses, "john.smith's page should have been invalidated")
+        self.client.logout()
+
+        # Making snippet 4 private changes what everyone sees.
+        update_snippet("4", {"private": True})
+        self.assertEquals([i for i in public_ids if i != 4], limited_ids(), "Snippet 4 should be gone")
+        self.assertEquals(4, limited_snippets_cache.misses, "Public page should have been invalidated")
+
+        # The counters are available to SuperUser through the metrics query.
+        login('admin')
+        response = self.query('query qryMetrics { metrics }', op_name='qryMetrics')
+        self.assertResponseNoErrors(response)
+        stats = json.loads(response.content)['data']['metrics']['limited_snippets_cache']
+        self.assertEquals(4, stats['misses'], "Metrics should report the cache counters")
+
+    # ./runtests.sh test_queries test_document_cache
+    def test_document_cache(self):
+        """
+The /graphql/ view should parse and validate a query string only once.
+        """
+        from mysite.backend import graphql_backend
+        graphql_backend.clear()
+
+        query = '''
+query qryAllSnippets {
+  allSnippets {
+    edges {
+      node {
+        id
+      }
+    }
+  }
+}
+        '''
+        first = self.query(query, op_name='qryAllSnippets')
+        second = self.query(query, op_name='qryAllSnippets')
+        self.assertResponseNoErrors(second)
+        self.assertEquals(json.loads(first.content), json.loads(second.content), "Cached document should run the same")
+        self.assertEquals((1, 1), (graphql_backend.misses, graphql_backend.hits))
+
+        # A document that doesn't validate is cached along with its errors.
+        for _ in range(2):
+            response = self.query('query qryBad { allSnippets { nope } }', op_name='qryBad')
+            self.assertResponseHasErrors(response)
+            self.assertIn('nope', response.content.decode())
+        self.assertEquals((2, 2), (graphql_backend.misses, graphql_backend.hits))
+
+    # ./runtests.sh test_queries test_persisted_queries
+    def test_persisted_queries(self):
+        """
+Automatic persisted queries: an unknown hash is refused until the client
+sends the text along, after which the hash alone will do.
+        """
+        import hashlib
+        from mysite.persisted_queries import persisted_queries
+        persisted_queries.clear()
+
+        query = '''
+query qryAllSnippets {
+  allSnippets {
+    edges {
+      node {
+        id
+      }
+    }
+  }
+}
+        '''
+        sha256_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": sha256_hash}}
+
+        def post(body):
+            return self.client.post('/graphql/', json.dumps(body), content_type='application/json')
+
+        # Hash only, not yet known
+        response = post({"extensions": extensions, "operationName": "qryAllSnippets"})
+        self.assertEquals(200, response.status_code, "The client should be told to retry, not rejected")
+        content = json.loads(response.content)
+        self.assertEquals('PERSISTED_QUERY_NOT_FOUND', content['errors'][0]['extensions']['code'])
+
+        # Hash and text registers it
+        response = post({"query": query, "extensions": extensions, "operationName": "qryAllSnippets"})
+        self.assertResponseNoErrors(response)
+        expected = json.loads(response.content)
+
+        # Now the hash is enough, over POST or GET
+        response = post({"extensions": extensions, "operationName": "qryAllSnippets"})
+        self.assertResponseNoErrors(response)
+        self.assertEquals(expected, json.loads(response.content))
+
+        response = self.client.get('/graphql/', {"extensions": json.dumps(extensions)}, HTTP_ACCEPT='application/json')
+        self.assertResponseNoErrors(response)
+        self.assertEquals(expected, json.loads(response.content))
+
+        # A hash that doesn't match the text is refused
+        wrong = {"persistedQuery": {"version": 1, "sha256Hash": "0" * 64}}
+        response = post({"query": query, "extensions": wrong, "operationName": "qryAllSnippets"})
+        self.assertEquals(400, response.status_code, "Mismatched hash should be rejected")
+
+        stats = persisted_queries.stats()
+        self.assertEquals((1, 1, 2), (stats['registrations'], stats['misses'], stats['hits']))
@@ -0,0 +1,151 @@
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+
+from types import SimpleNamespace
+import re
+
+from snippets.queries import Query
+from snippets.views import SnippetListView, SnippetAuthenticatedListView
+from snippets.pagination import to_cursor
+from snippets.models import Snippet
+from snippets.cache import limited_snippets_cache
+
+"""
+Query plan regression tests.
+
+Each resolver and view queryset is run for real, the SQL it sends to the
+database is captured, and then handed back to SQLite as EXPLAIN QUERY PLAN.
+If a plan walks the whole snippets table instead of seeking through one of
+the indexes defined on the model, the test fails.
+
+Only meaningful against SQLite, which is what settings.py uses.
+"""
+
+# "SCAN snippets_snippet" (or "SCAN TABLE snippets_snippet" on older SQLite)
+# with no index behind it is a full table scan.
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?snippets_snippet( AS \w+)?$')
+
+# "SCAN snippets_snippet USING INDEX ..." reads the whole index in order. That's
+# the best an unfiltered query can do, but a filtered one should SEARCH.
+INDEX_SCAN = re.compile(r'^SCAN (TABLE )?snippets_snippet\b')
+
+
+# ./runtests.sh test_query_plans
+class SnippetsTestCase(TestCase):
+    fixtures = ['fixtures.json', ]
+
+    # Run before each test
+    def setUp(self):
+        print()
+        print()
+        self.factory = RequestFactory()
+
+    def info_for(self, user):
+        """Just enough of a graphene ResolveInfo for the resolvers to run."""
+        request = self.factory.get('/graphql/')
+        request.user = user
+        return SimpleNamespace(context=request)
+
+    def request_for(self, user):
+        request = self.factory.get('/snippets/')
+        request.user = user
+        return request
+
+    def captured_plans(self, func):
+        """
+Runs func (evaluating the queryset if that's what it returns) and
+returns [(sql, [plan details])] for every query that hit the snippets table.
+        """
+        # A cached page would never reach the database.
+        limited_snippets_cache.clear()
+
+        with CaptureQueriesContext(connection) as ctx:
+            result = func()
+            if hasattr(result, 'query'):
+                list(result)
+
+        plans = []
+        for captured in ctx.captured_queries:
+            sql = captured['sql']
+            if 'snippets_snippet' not in sql:
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plans.append((sql, [row[3] for row in cursor.fetchall()]))
+
+        self.assertTrue(plans, "Expected at least one query against snippets_snippet")
+        return plans
+
+    def assertNoTableScan(self, label, func, filtered=True):
+        for sql, details in self.captured_plans(func):
+            if settings.DEBUG:
+                print(f"{label}: {sql}")
+                for detail in details:
+                    print(f"    {detail}")
+
+            scan = TABLE_SCAN if not filtered else INDEX_SCAN
+            offenders = [detail for detail in details if scan.match(detail)]
+            self.assertFalse(offenders, f"{label} scans the table: {details}\n{sql}")
+
+    # ./runtests.sh test_query_plans test_resolver_plans
+    def test_resolver_plans(self):
+        """The GraphQL resolvers, for each kind of user."""
+        user_model = get_user_model()
+        admin = user_model.objects.get(username='admin')
+        john = user_model.objects.get(username='john.smith')
+        anonymous = AnonymousUser()
+
+        first = Snippet.objects.order_by('created', 'id').first()
+        after = to_cursor(first)
+
+        # Unfiltered; the best it can do is walk the (created, id) index.
+        self.assertNoTableScan("allSnippets", lambda: Query.resolve_all_snippets(
+            None, self.info_for(anonymous), first=3), filtered=False)
+        self.assertNoTableScan("allSnippets(after)", lambda: Query.resolve_all_snippets(
+            None, self.info_for(anonymous), first=3, after=after), filtered=False)
+        self.assertNoTableScan("limitedSnippets [SuperUser]", lambda: Query.resolve_limited_snippets(
+            None, self.info_for(admin), first=3), filtered=False)
+
+        for user in (anonymous, john):
+            self.assertNoTableScan(f"limitedSnippets [{user}]", lambda: Query.resolve_limited_snippets(
+                None, self.info_for(user), first=3))
+            self.assertNoTableScan(f"limitedSnippets(after) [{user}]", lambda: Query.resolve_limited_snippets(
+                None, self.info_for(user), first=3, after=after))
+            self.assertNoTableScan(f"searchSnippets [{user}]", lambda: Query.resolve_search_snippets(
+                None, self.info_for(user), query="item", first=3))
+
+        for user in (admin, john):
+            self.assertNoTableScan(f"snippetsByOwner [{user}]", lambda: Query.resolve_snippets_by_owner(
+                None, self.info_for(user)))
+            self.assertNoTableScan(f"snippetsByPrivate [{user}]", lambda: Query.resolve_snippets_by_private(
+                None, self.info_for(user)))
+
+    # ./runtests.sh test_query_plans test_view_plans
+    def test_view_plans(self):
+        """The non-GraphQL Django list views."""
+        user_model = get_user_model()
+        admin = user_model.objects.get(username='admin')
+        john = user_model.objects.get(username='john.smith')
+        anonymous = AnonymousUser()
+
+        def view_queryset(view_class, title, user):
+            view = view_class(title=title)
+            view.setup(self.request_for(user))
+            return view.get_queryset
+
+        self.assertNoTableScan("Public Snippets", view_queryset(SnippetListView, 'Public Snippets', anonymous))
+
+        # SuperUser's "All Snippets" is Snippet.objects.all(); reading every row
+        # is the point of that page, so there's nothing for an index to do.
+        for user in (anonymous, john):
+            self.assertNoTableScan(f"All Snippets [{user}]", view_queryset(SnippetListView, 'All Snippets', user))
+
+        for user in (admin, john):
+            self.assertNoTableScan(f"Private Snippets [{user}]",
+                                   view_queryset(SnippetAuthenticatedListView, 'Private Snippets', user))
+            self.assertNoTableScan(f"Owner Snippets [{user}]",
+                                   view_queryset(SnippetAuthenticatedListView, 'Owner Snippets', user))
@@ -0,0 +1,62 @@
+from django.test import SimpleTestCase
+
+from snippets import outbound
+from snippets.outbound import COALESCE, DISCONNECT, DROP_OLDEST, SendQueue
+
+"""
+Tests for the per-connection send queues (snippets/outbound.py).
+"""
+
+
+def frame(text):
+    return (text, None, False)
+
+
+class SendQueueTestCase(SimpleTestCase):
+
+    async def drain(self, queue):
+        return [(await queue.get())[0] for _ in range(len(queue))]
+
+    async def test_drop_oldest(self):
+        queue = SendQueue("drop", limit=2, policy=DROP_OLDEST)
+        queue.put(frame("ack"))
+        for n in range(4):
+            self.assertTrue(queue.put(frame(f"n{n}"), notification=True, key=("op", n)))
+
+        # The ack isn't a notification, so it is never dropped.
+        self.assertEquals(["ack", "n2", "n3"], await self.drain(queue))
+        self.assertEquals({'depth': 0, 'max_depth': 3, 'sent': 3, 'dropped': 2, 'coalesced': 0}, queue.stats())
+        queue.close()
+
+    async def test_coalesce(self):
+        queue = SendQueue("coalesce", limit=2, policy=COALESCE)
+        queue.put(frame("snippet 1, first"), notification=True, key=("op", 1))
+        queue.put(frame("snippet 2"), notification=True, key=("op", 2))
+        queue.put(frame("snippet 1, latest"), notification=True, key=("op", 1))
+        # Nothing to coalesce with: drop the oldest.
+        queue.put(frame("snippet 3"), notification=True, key=("op", 3))
+
+        self.assertEquals(["snippet 2", "snippet 3"], await self.drain(queue))
+        self.assertEquals((1, 1), (queue.coalesced, queue.dropped))
+
+        # A notification about many snippets is never coalesced.
+        queue.put(frame("snippets 1"), notification=True)
+        queue.put(frame("snippets 2"), notification=True)
+        queue.put(frame("snippets 3"), notification=True)
+        self.assertEquals(["snippets 2", "snippets 3"], await self.drain(queue))
+        queue.close()
+
+    async def test_disconnect(self):
+        queue = SendQueue("disconnect", limit=1, policy=DISCONNECT)
+        self.assertTrue(queue.put(frame("n0"), notification=True, key=("op", 0)))
+        self.assertFalse(queue.put(frame("n1"), notification=True, key=("op", 1)))
+        self.assertTrue(queue.overflowed)
+
+        disconnects = outbound.stats()['disconnects']
+        queue.close()
+        self.assertEquals(disconnects + 1, outbound.stats()['disconnects'])
+        self.assertNotIn("disconnect", outbound.stats()['deepest'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SendQueue("bad", policy="block")
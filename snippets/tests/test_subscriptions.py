@@ -12,6 +12,7 @@ import graphene
 from django.conf import settings
 
 from mysite.schema import Mutation, Subscription
+from snippets.coalesce import coalescer
 
 import asyncio
 
@@ -55,6 +56,9 @@ class SnippetsTestCase(GraphQLTestCase):
 
     # Run before each test
     def setUp(self):
+        # Don't let an event held back from the last test arrive in this one.
+        coalescer.clear()
+
         print()
         print()
 
@@ -468,6 +472,565 @@ mutation mutUpdateSnippet {
 
         await client.finalize()
 
+    # ./runtests.sh test_subscriptions test_persisted_query_over_websocket
+    def test_persisted_query_over_websocket(self):
+        """
+MyGraphqlWsConsumer accepts automatic persisted queries, from the same
+store as the /graphql/ view.
+        """
+        import hashlib
+        from channels.auth import AuthMiddlewareStack
+        from mysite.persisted_queries import persisted_queries
+        from snippets.consumer import MyGraphqlWsConsumer
+
+        persisted_queries.clear()
+
+        query = '''
+mutation mutUpdateSnippet {
+  updateSnippet(id: "3", input: {title: "Persisted Title"}) {
+    snippet {
+      title
+    }
+    ok
+  }
+}
+        '''
+        extensions = {
+            "persistedQuery": {"version": 1, "sha256Hash": hashlib.sha256(query.encode('utf-8')).hexdigest()}
+        }
+
+        # The alternate test above closes the default loop.
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        application = channels.routing.URLRouter(
+            [django.urls.path("graphql/", AuthMiddlewareStack(MyGraphqlWsConsumer.as_asgi()))]
+        )
+        transport = channels_graphql_ws.testing.GraphqlWsTransport(application=application, path="graphql/")
+        client = channels_graphql_ws.testing.GraphqlWsClient(transport)
+
+        async def run_test():
+            await client.connect_and_init()
+
+            print("Hash only, not yet known")
+            op_id = await client.send(msg_type="start", payload={"extensions": extensions})
+            try:
+                await client.receive(assert_id=op_id, assert_type="data")
+                assert False, "Unknown hash should have been refused"
+            except channels_graphql_ws.GraphqlWsResponseError as error:
+                errors = error.response['payload']['errors']
+                assert errors[0]['message'] == 'PersistedQueryNotFound', errors
+            await client.receive(assert_id=op_id, assert_type="complete")
+
+            print("Hash and text")
+            op_id = await client.send(msg_type="start", payload={"query": query, "extensions": extensions})
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            assert resp["data"]["updateSnippet"]["ok"] is True
+            await client.receive(assert_id=op_id, assert_type="complete")
+
+            print("Hash only, now known")
+            op_id = await client.send(msg_type="start", payload={"extensions": extensions})
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            assert resp["data"]["updateSnippet"]["snippet"]["title"] == "Persisted Title"
+            await client.receive(assert_id=op_id, assert_type="complete")
+
+            await client.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        # Leave a usable default loop for the tests that follow.
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        stats = persisted_queries.stats()
+        assert (stats['registrations'], stats['misses'], stats['hits']) == (1, 1, 1), stats
+
+    # ./runtests.sh test_subscriptions test_publish_once_per_group
+    def test_publish_once_per_group(self):
+        """
+Subscribers with the same document and visibility class share one run of
+publish() per event and get the same bytes; the sender still hears nothing.
+        """
+        from unittest import mock
+        from django.contrib.auth import get_user_model
+        from django.utils import timezone
+        from snippets.fanout import publish_cache
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data
+
+        publish_cache.clear()
+
+        subscription = '''
+subscription subNoGroup {
+  onSnippetNoGroup {
+    sender
+    transType
+    snippet {
+      id
+      title
+      bodyPreview
+    }
+  }
+}
+        '''
+        snippet = Snippet(id=1, title="Shared", owner="john.smith", private=False,
+                          created=timezone.now(), body="Rendered once")
+
+        def event(sender):
+            return {"sender": sender, "snippet": notification_data(snippet), "trans_type": "UPDATE"}
+
+        # The alternate test above closes the default loop.
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        john = get_user_model().objects.get(username="john.smith")
+        anonymous = [my_consumer_client(), my_consumer_client()]
+        owner = my_consumer_client(john)
+        clients = anonymous + [owner]
+
+        publish = mock.Mock(wraps=OnSnippetNoGroup._meta.publish)
+
+        async def run_test():
+            op_ids = []
+            for client in clients:
+                await client.connect_and_init()
+                op_id = await client.send(msg_type="start", payload={"query": subscription})
+                await client.receive(assert_id=op_id, assert_type="data")
+                op_ids.append(op_id)
+
+            print("john.smith's own change reaches only the anonymous subscribers")
+            await OnSnippetNoGroup.broadcast_async(payload=event("john.smith"))
+            frames = [await client.transport.receive() for client in anonymous]
+            assert frames[0]["payload"] == frames[1]["payload"]
+            assert frames[0]["payload"]["data"]["onSnippetNoGroup"]["snippet"]["bodyPreview"] == \
+                "Rendered once"
+            assert publish.call_count == 2, "Once for the anonymous class, once for john.smith"
+
+            print("Someone else's change reaches john.smith too")
+            await OnSnippetNoGroup.broadcast_async(payload=event("SENDER"))
+            for client, op_id in zip(clients, op_ids):
+                resp = await client.receive(assert_id=op_id, assert_type="data")
+                assert resp["data"]["onSnippetNoGroup"]["sender"] == "SENDER"
+            assert publish.call_count == 4
+
+            for client in clients:
+                await client.finalize()
+
+        # Options are frozen against setattr, but not against this.
+        with mock.patch.dict(OnSnippetNoGroup._meta.__dict__, {'publish': publish}):
+            event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        # A render is counted just after it's sent, which can race finalize().
+        stats = publish_cache.stats()
+        assert (stats['hits'], stats['skips']) == (2, 1), stats
+
+
+    # ./runtests.sh test_subscriptions test_subscription_filters
+    def test_subscription_filters(self):
+        """
+owner, snippetId and includePrivate narrow what a subscription hears, and
+no one hears of a private snippet limitedSnippets wouldn't show them.
+        """
+        from asgiref.sync import sync_to_async
+        from django.contrib.auth import get_user_model
+        from django.utils import timezone
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data, snippet_routes
+
+        def event(id, owner, private):
+            snippet = Snippet(id=id, title=f"{owner} {id}", owner=owner, private=private,
+                              created=timezone.now(), body="")
+            data = notification_data(snippet)
+            return snippet_routes({"sender": "SENDER", "snippet": data, "trans_type": "UPDATE"}, data)
+
+        subscription = '''
+subscription subNoGroup($owner: String, $snippetId: ID, $includePrivate: Boolean) {
+  onSnippetNoGroup(owner: $owner, snippetId: $snippetId, includePrivate: $includePrivate) {
+    snippet {
+      id
+    }
+  }
+}
+        '''
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        users = get_user_model().objects
+        john, admin = users.get(username="john.smith"), users.get(username="admin")
+        subscribers = {
+            "anonymous": (my_consumer_client(), {}),
+            "john": (my_consumer_client(john), {}),
+            "john, public only": (my_consumer_client(john), {"includePrivate": False}),
+            "john, admin's": (my_consumer_client(john), {"owner": "admin"}),
+            "john, snippet 7": (my_consumer_client(john), {"snippetId": "7"}),
+            "admin, snippet 8": (my_consumer_client(admin), {"snippetId": "8"}),
+        }
+        expected = {
+            "anonymous": ["1", "2"],
+            "john": ["1", "2", "3", "7"],
+            "john, public only": ["1", "2"],
+            "john, admin's": ["2"],
+            "john, snippet 7": ["7"],
+            "admin, snippet 8": ["8"],
+        }
+
+        async def run_test():
+            op_ids = {}
+            for name, (client, variables) in subscribers.items():
+                await client.connect_and_init()
+                op_ids[name] = await client.send(
+                    msg_type="start", payload={"query": subscription, "variables": variables}
+                )
+                await client.receive(assert_id=op_ids[name], assert_type="data")
+
+            broadcast = sync_to_async(OnSnippetNoGroup.broadcast_routed)
+            await broadcast(event(1, "john.smith", False))
+            await broadcast(event(2, "admin", False))
+            await broadcast(event(3, "john.smith", True))
+            await broadcast(event(4, "admin", True))
+            await broadcast(event(7, "john.smith", True))
+            await broadcast(event(8, "admin", True))
+            for name, (client, variables) in subscribers.items():
+                received = []
+                for _ in expected[name]:
+                    resp = await client.receive(assert_id=op_ids[name], assert_type="data")
+                    received.append(resp["data"]["onSnippetNoGroup"]["snippet"]["id"])
+                assert received == expected[name], (name, received)
+                await client.assert_no_messages(name, attempts=3)
+
+            for client, variables in subscribers.values():
+                await client.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    # ./runtests.sh test_subscriptions test_resume_since_seq
+    def test_resume_since_seq(self):
+        """
+A subscription with sinceSeq first gets the events it missed, numbered, and
+then live ones. If they can't all be replayed it is told to resync.
+        """
+        from asgiref.sync import sync_to_async
+        from django.utils import timezone
+        from snippets.eventlog import event_log
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data, snippet_routes
+
+        def event(id, private=False):
+            snippet = Snippet(id=id, title=f"title {id}", owner="admin", private=private,
+                              created=timezone.now(), body="")
+            data = notification_data(snippet)
+            return snippet_routes({"sender": "SENDER", "snippet": data, "trans_type": "UPDATE"}, data)
+
+        subscription = '''
+subscription subNoGroup($sinceSeq: Int, $stream: String) {
+  onSnippetNoGroup(sinceSeq: $sinceSeq, stream: $stream) {
+    snippet {
+      id
+    }
+    seq
+    stream
+    resync
+  }
+}
+        '''
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        async def subscribe(client, variables):
+            await client.connect_and_init()
+            op_id = await client.send(msg_type="start", payload={"query": subscription, "variables": variables})
+            await client.receive(assert_id=op_id, assert_type="data")
+            return op_id
+
+        async def notification(client, op_id):
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            return resp["data"]["onSnippetNoGroup"]
+
+        async def run_test():
+            broadcast = sync_to_async(OnSnippetNoGroup.broadcast_routed)
+            # The client sees one event live, with where it is.
+            watcher = my_consumer_client()
+            watcher_op_id = await subscribe(watcher, {})
+            await broadcast(event(1))
+            first = await notification(watcher, watcher_op_id)
+            seen, stream = first["seq"], first["stream"]
+            self.assertEqual(event_log.stream, stream, "Numbered in the subscriber's process")
+            await watcher.finalize()
+
+            # Missed: one public, one private that the client may not see.
+            await broadcast(event(2))
+            await broadcast(event(3, private=True))
+
+            resumed = my_consumer_client()
+            op_id = await subscribe(resumed, {"sinceSeq": seen, "stream": stream})
+            replayed = await notification(resumed, op_id)
+            self.assertEquals(("2", seen + 1, stream),
+                              (replayed["snippet"]["id"], replayed["seq"], replayed["stream"]))
+            await resumed.assert_no_messages("The private event is not replayed", attempts=3)
+
+            await broadcast(event(4))
+            live = await notification(resumed, op_id)
+            self.assertEquals(("4", seen + 3), (live["snippet"]["id"], live["seq"]))
+
+            # Another stream (e.g. before a restart), or further back than the buffer.
+            for variables in ({"sinceSeq": seen, "stream": "elsewhere"}, {"sinceSeq": -10}):
+                client = my_consumer_client()
+                op_id = await subscribe(client, variables)
+                resync = await notification(client, op_id)
+                self.assertEquals((True, None, seen + 3), (resync["resync"], resync["snippet"], resync["seq"]))
+                await client.finalize()
+
+            await resumed.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    # ./runtests.sh test_subscriptions test_delta_updates
+    def test_delta_updates(self):
+        """
+Subscribed with delta, an UPDATE brings just the fields it changed and the
+versions; without it, or when private changed, the whole snippet.
+        """
+        from asgiref.sync import sync_to_async
+        from django.utils import timezone
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data, snippet_routes
+
+        def update(changed, version=3):
+            snippet = Snippet(id=7, title="new title", owner="admin", private=False,
+                              created=timezone.now(), body="new body", version=version)
+            data = notification_data(snippet, changed)
+            return snippet_routes({"sender": "SENDER", "snippet": data, "trans_type": "UPDATE"}, data)
+
+        subscription = '''
+subscription subDelta($delta: Boolean) {
+  onSnippetNoGroup(delta: $delta) {
+    snippet {
+      id
+      title
+      version
+    }
+    delta {
+      id
+      version
+      baseVersion
+      changed
+      title
+      bodyPreview
+    }
+  }
+}
+        '''
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        async def subscribe(variables):
+            client = my_consumer_client()
+            await client.connect_and_init()
+            op_id = await client.send(msg_type="start", payload={"query": subscription, "variables": variables})
+            await client.receive(assert_id=op_id, assert_type="data")
+            return client, op_id
+
+        async def notification(client, op_id):
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            return resp["data"]["onSnippetNoGroup"]
+
+        async def run_test():
+            broadcast = sync_to_async(OnSnippetNoGroup.broadcast_routed)
+            deltas, deltas_id = await subscribe({"delta": True})
+            full, full_id = await subscribe({})
+
+            await broadcast(update(["title"]))
+            self.assertEquals(
+                {"snippet": None, "delta": {"id": "7", "version": 3, "baseVersion": 2, "changed": ["title"],
+                                            "title": "new title", "bodyPreview": None}},
+                await notification(deltas, deltas_id))
+            self.assertEquals({"snippet": {"id": "7", "title": "new title", "version": 3}, "delta": None},
+                              await notification(full, full_id))
+
+            # It may now be seen by subscribers that never saw it.
+            await broadcast(update(["private", "body"], version=4))
+            self.assertEquals({"snippet": {"id": "7", "title": "new title", "version": 4}, "delta": None},
+                              await notification(deltas, deltas_id))
+
+            await deltas.finalize()
+            await full.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    # ./runtests.sh test_subscriptions test_snippet_changed
+    def test_snippet_changed(self):
+        """
+onSnippetChanged hears about its snippet, alone or as part of a bulk event,
+and nothing else; events go only to the groups watching a snippet.
+        """
+        from asgiref.sync import sync_to_async
+        from django.utils import timezone
+        from snippets.models import Snippet
+        from snippets.groups import single_snippet_routes
+        from snippets.subscriptions import OnSnippetChanged, notification_data, snippets_routes
+
+        def data(id, title):
+            return notification_data(Snippet(id=id, title=title, owner="admin", private=False,
+                                             created=timezone.now(), body="", version=1))
+
+        routes = OnSnippetChanged.event_routes("UPDATE", "SENDER", data(7, "seven"))
+        self.assertEquals(["snippet.7.public"], list(routes))
+
+        subscription = '''
+subscription subChanged($id: ID!) {
+  onSnippetChanged(id: $id) {
+    transType
+    snippet {
+      id
+      title
+    }
+  }
+}
+        '''
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        async def watch(id):
+            client = my_consumer_client()
+            await client.connect_and_init()
+            op_id = await client.send(msg_type="start", payload={"query": subscription, "variables": {"id": id}})
+            await client.receive(assert_id=op_id, assert_type="data")
+            return client, op_id
+
+        async def notification(client, op_id):
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            return resp["data"]["onSnippetChanged"]
+
+        async def run_test():
+            broadcast = sync_to_async(OnSnippetChanged.broadcast_routed)
+            seven, seven_id = await watch("7")
+            eight, eight_id = await watch("8")
+
+            await broadcast(routes)
+            self.assertEquals({"transType": "UPDATE", "snippet": {"id": "7", "title": "seven"}},
+                              await notification(seven, seven_id))
+            await eight.assert_no_messages("Not watching 7", attempts=3)
+
+            bulk = snippets_routes({"sender": "SENDER", "trans_type": "DELETE"}, [data(7, "seven"), data(8, "eight")])
+            await broadcast(single_snippet_routes(bulk))
+            self.assertEquals("7", (await notification(seven, seven_id))["snippet"]["id"])
+            self.assertEquals({"transType": "DELETE", "snippet": {"id": "8", "title": "eight"}},
+                              await notification(eight, eight_id))
+
+            await seven.finalize()
+            await eight.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    # ./runtests.sh test_subscriptions test_body_not_sent
+    def test_body_not_sent(self):
+        """
+Notifications carry only the body preview, so body is null rather than the
+preview passing for it, for one snippet or many. Queries still always get
+the body.
+        """
+        from asgiref.sync import sync_to_async
+        from django.utils import timezone
+        from mysite.schema import schema
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data, snippets_routes
+
+        self.assertEquals("String!", str(schema.get_type("SnippetType").fields["body"].type))
+        self.assertEquals("SnippetNotificationType",
+                          str(schema.get_type("OnSnippetNoGroup").fields["snippet"].type))
+
+        body = "x" * 200
+
+        def data(id):
+            return notification_data(Snippet(id=id, title=f"title {id}", owner="admin", private=False,
+                                             created=timezone.now(), body=body, version=1))
+
+        subscription = '''
+subscription subNoGroup {
+  onSnippetNoGroup {
+    snippet {
+      body
+      bodyPreview
+    }
+    snippets {
+      body
+      bodyPreview
+    }
+  }
+}
+        '''
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        async def run_test():
+            broadcast = sync_to_async(OnSnippetNoGroup.broadcast_routed)
+            client = my_consumer_client()
+            await client.connect_and_init()
+            op_id = await client.send(msg_type="start", payload={"query": subscription, "variables": {}})
+            await client.receive(assert_id=op_id, assert_type="data")
+
+            preview = {"body": None, "bodyPreview": body[:50]}
+            await broadcast(OnSnippetNoGroup.event_routes("UPDATE", "SENDER", data(7)))
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            self.assertEquals({"snippet": preview, "snippets": None}, resp["data"]["onSnippetNoGroup"])
+
+            await broadcast(snippets_routes({"sender": "SENDER", "trans_type": "CREATE"}, [data(7), data(8)]))
+            resp = await client.receive(assert_id=op_id, assert_type="data")
+            self.assertEquals({"snippet": None, "snippets": [preview, preview]}, resp["data"]["onSnippetNoGroup"])
+
+            await client.finalize()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def my_consumer_client(user=None):
+    """
+A GraphqlWsClient talking to MyGraphqlWsConsumer, logged in as user if
+given, or else anonymous.
+    """
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from snippets.consumer import MyGraphqlWsConsumer
+
+    class Consumer(MyGraphqlWsConsumer):
+        strict_ordering = True
+        confirm_subscriptions = True
+
+    app = Consumer.as_asgi()
+    if user is None:
+        app = channels.auth.AuthMiddlewareStack(app)
+    else:
+        # What SessionMiddleware would put in the scope for user. (Sessions
+        # saved by the test itself are out of reach of the consumer's thread.)
+        session = {
+            SESSION_KEY: str(user.pk),
+            BACKEND_SESSION_KEY: "django.contrib.auth.backends.ModelBackend",
+            HASH_SESSION_KEY: user.get_session_auth_hash(),
+        }
+        consumer_app = app
+
+        async def app(scope, receive, send):
+            return await consumer_app({**scope, "session": session}, receive, send)
+
+    application = channels.routing.URLRouter([django.urls.path("graphql/", app)])
+    transport = channels_graphql_ws.testing.GraphqlWsTransport(application=application, path="graphql/")
+    return channels_graphql_ws.testing.GraphqlWsClient(transport)
+
 
 # gql originally came from conftest.py, a pytest thing, which contains
 # auxiliary files for use in testing. gql is a generator (because of the
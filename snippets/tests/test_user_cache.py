@@ -0,0 +1,113 @@
+import tempfile
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.auth.signals import user_logged_out
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import TestCase
+
+from mysite.channel_layer import UnixSocketChannelLayer
+from snippets.usercache import UserCache, get_user, get_user_by_natural_key, user_cache
+
+"""
+Tests for the cache of users by session and by username (snippets/usercache.py).
+"""
+
+
+class UserCacheTestCase(TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+        # Users are only kept once it hears about changes in other processes.
+        user_cache._listener.wait()
+        self.user = get_user_model().objects.create_user("cached", password="first password")
+
+    def scope(self):
+        session = SessionStore()
+        session.update({
+            SESSION_KEY: str(self.user.pk),
+            BACKEND_SESSION_KEY: "django.contrib.auth.backends.ModelBackend",
+            HASH_SESSION_KEY: self.user.get_session_auth_hash(),
+        })
+        session.save()
+        return {"session": SessionStore(session.session_key)}
+
+    def test_session(self):
+        scope = self.scope()
+        self.assertEquals("cached", async_to_sync(get_user)(scope).username)
+        user = async_to_sync(get_user)(scope)
+        self.assertEquals(("cached", 1, 1), (user.username, user_cache.stats()['hits'], user_cache.stats()['misses']))
+
+        # No session key, nothing to cache.
+        self.assertTrue(async_to_sync(get_user)({"session": SessionStore()}).is_anonymous)
+        self.assertEquals(1, len(user_cache))
+
+    def test_password_change(self):
+        scope = self.scope()
+        async_to_sync(get_user)(scope)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password("second password")
+            self.user.save()
+        self.assertEquals(0, len(user_cache))
+        self.assertTrue(async_to_sync(get_user)(scope).is_anonymous, "The session is no longer valid")
+
+    def test_deactivation(self):
+        get_user_by_natural_key("cached")
+        scope = self.scope()
+        async_to_sync(get_user)(scope)
+        self.assertEquals(2, len(user_cache))
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEquals(0, len(user_cache))
+        self.assertTrue(async_to_sync(get_user)(scope).is_anonymous)
+        self.assertFalse(get_user_by_natural_key("cached").is_active)
+
+    def test_logout(self):
+        async_to_sync(get_user)(self.scope())
+        user_logged_out.send(sender=self.user.__class__, request=None, user=self.user)
+        self.assertEquals(0, len(user_cache))
+
+    def test_loaded_before_invalidation(self):
+        """A user loaded before an invalidation isn't cached after it."""
+        generation = user_cache.generation
+        user_cache.invalidate(self.user.pk)
+        user_cache.set(('username', "cached"), self.user, generation)
+        self.assertIsNone(user_cache.get(('username', "cached")))
+
+    def test_other_processes(self):
+        """
+A logout, password change or deactivation in one process empties every
+process's cache of that user. Two caches with layers given the same path
+behave like two worker processes.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        layers = [UnixSocketChannelLayer(path=tmp.name) for _ in range(2)]
+        for layer in layers:
+            self.addCleanup(layer._stop)
+        here, there = (UserCache(channel_layer=layer) for layer in layers)
+        for cache in (here, there):
+            cache._listener.wait()
+            cache.set(('username', "cached"), self.user, cache.generation)
+            cache.set(('session', "key"), self.user, cache.generation)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            here.invalidate(self.user.pk)
+            self.assertEquals((0, 2), (len(here), len(there)), "Told there only once committed")
+        deadline = time.time() + 5
+        while len(there) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(0, len(there))
+        self.assertIsNone(there.get(('session', "key")))
+        self.assertEquals((1, 0), (there.stats()['remote_invalidations'], here.stats()['remote_invalidations']))
+
+    def test_not_listening_yet(self):
+        """Nothing is kept while other processes' invalidations can't be heard."""
+        cache = UserCache()
+        joined = cache._listener.start()
+        with mock.patch.object(joined, 'done', return_value=False):
+            cache.set(('username', "cached"), self.user, cache.generation)
+        self.assertEquals(0, len(cache))
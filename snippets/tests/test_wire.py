@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import channels
+import channels.testing
+import django
+from django.test import SimpleTestCase, TestCase
+
+from snippets.coalesce import coalescer
+from snippets.wire import GRAPHQL_WS, WIRE_FORMATS, negotiate
+
+"""
+Tests for the websocket message encodings (snippets/wire.py).
+"""
+
+PAYLOAD = json.dumps({"data": {"onSnippetNoGroup": {"snippet": {"id": "1", "title": "x" * 300}}}})
+
+
+class WireFormatTestCase(SimpleTestCase):
+
+    def test_negotiate(self):
+        self.assertEquals(GRAPHQL_WS + '+msgpack',
+                          negotiate([b"graphql-ws+zstd", "graphql-ws+msgpack", "graphql-ws"]).subprotocol)
+        self.assertEquals(GRAPHQL_WS, negotiate(["graphql-ws"]).subprotocol)
+        self.assertIsNone(negotiate(["graphql-transport-ws"]))
+
+    def test_round_trip(self):
+        message = {"type": "start", "id": "7", "payload": {"query": "{ me { id } }", "variables": {}}}
+        for wire in WIRE_FORMATS.values():
+            with self.subTest(wire.subprotocol):
+                encoded = wire.encode(message)
+                if wire.binary:
+                    self.assertEquals(message, wire.decode(encoded['bytes_data']))
+                else:
+                    self.assertEquals(message, json.loads(encoded['text_data']))
+
+    def test_data_frame(self):
+        """
+Frames built around the shared payload decode to the whole message, and a
+deflated one is smaller than the JSON.
+        """
+        expected = {"type": "data", "id": "op-1", "payload": json.loads(PAYLOAD)}
+        for wire in WIRE_FORMATS.values():
+            with self.subTest(wire.subprotocol):
+                text_data, bytes_data = wire.data_frame("op-1", PAYLOAD)
+                if wire.binary:
+                    self.assertIsNone(text_data)
+                    self.assertEquals(expected, wire.decode(bytes_data))
+                    if wire.deflate:
+                        self.assertLess(len(bytes_data), len(PAYLOAD) / 2)
+                else:
+                    self.assertIsNone(bytes_data)
+                    self.assertEquals(expected, json.loads(text_data))
+
+
+class WireConsumerTestCase(TestCase):
+
+    def setUp(self):
+        coalescer.clear()
+
+    def test_msgpack_deflate(self):
+        """A client speaking graphql-ws+msgpack+deflate, both ways."""
+        from asgiref.sync import sync_to_async
+        from django.utils import timezone
+        from snippets.consumer import MyGraphqlWsConsumer
+        from snippets.models import Snippet
+        from snippets.subscriptions import OnSnippetNoGroup, notification_data, snippet_routes
+
+        class Consumer(MyGraphqlWsConsumer):
+            strict_ordering = True
+            confirm_subscriptions = True
+            send_keepalive_every = None
+
+        application = channels.routing.URLRouter([
+            django.urls.path("graphql/", channels.auth.AuthMiddlewareStack(Consumer.as_asgi())),
+        ])
+        wire = WIRE_FORMATS[GRAPHQL_WS + '+msgpack+deflate']
+
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+
+        async def run_test():
+            comm = channels.testing.WebsocketCommunicator(
+                application, "graphql/", subprotocols=[wire.subprotocol, GRAPHQL_WS])
+            connected, subprotocol = await comm.connect()
+            self.assertEquals((True, wire.subprotocol), (connected, subprotocol))
+
+            async def receive():
+                return wire.decode((await comm.receive_output(timeout=5))["bytes"])
+
+            await comm.send_to(bytes_data=wire.encode({"type": "connection_init", "payload": {}})["bytes_data"])
+            self.assertEquals("connection_ack", (await receive())["type"])
+
+            # The client may still send JSON text.
+            await comm.send_json_to({"type": "start", "id": "op-1", "payload": {
+                "query": "subscription { onSnippetNoGroup { snippet { id title } } }",
+            }})
+            confirmation = await receive()
+            self.assertEquals(("data", "op-1"), (confirmation["type"], confirmation["id"]))
+
+            snippet = Snippet(id=5, title="t" * 200, owner="admin", private=False, created=timezone.now(), body="")
+            data = notification_data(snippet)
+            await sync_to_async(OnSnippetNoGroup.broadcast_routed)(
+                snippet_routes({"sender": "SENDER", "snippet": data, "trans_type": "UPDATE"}, data))
+            notification = await receive()
+            self.assertEquals(("op-1", {"id": "5", "title": "t" * 200}),
+                              (notification["id"], notification["payload"]["data"]["onSnippetNoGroup"]["snippet"]))
+
+            await comm.disconnect()
+
+        event_loop.run_until_complete(run_test())
+        event_loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
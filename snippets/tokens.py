@@ -0,0 +1,95 @@
+"""
+JWT verification without going back through the GraphQL schema.
+
+whoami() used to run a verifyToken mutation through schema.execute() just to
+read the username out of the token, i.e. a full parse/validate/execute nested
+inside every request. This decodes the token directly with the same
+graphql_jwt machinery that the verifyToken mutation uses, and remembers the
+result in a small bounded cache so a client hammering the API with the same
+token only pays for the signature check once in a while.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.utils import get_payload
+
+# Overridable from settings.py.
+JWT_CACHE_MAXSIZE = getattr(settings, 'SNIPPETS_JWT_CACHE_MAXSIZE', 1024)
+JWT_CACHE_TTL = getattr(settings, 'SNIPPETS_JWT_CACHE_TTL', 300)  # seconds
+
+
+class TokenCache:
+    """
+Bounded, thread-safe LRU cache of verified token payloads.
+
+An entry lives for at most ttl seconds, and never past the token's own
+'exp' claim, so an expired token always gets re-verified (and rejected).
+    """
+
+    def __init__(self, maxsize=JWT_CACHE_MAXSIZE, ttl=JWT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # token -> (expires_at, payload)
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return payload
+                del self._entries[token]
+
+            self.misses += 1
+            return None
+
+    def set(self, token, payload):
+        expires_at = time.time() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        with self._lock:
+            self._entries[token] = (expires_at, payload)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
+
+
+def verify_token(token, context=None):
+    """
+Returns the verified payload for a token.
+Raises graphql_jwt's JSONWebTokenError (or JSONWebTokenExpired) exactly as
+the verifyToken mutation would if the token is no good.
+    """
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = get_payload(token, context)
+        token_cache.set(token, payload)
+
+    return payload
+
+
+def get_username_from_payload(payload):
+    """Pulls the username out of a payload the same way graphql_jwt does."""
+    return jwt_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
@@ -2,6 +2,7 @@ import graphene
 from graphene_django.types import DjangoObjectType
 from django.contrib.auth import get_user_model
 from .models import Snippet  # From this tutorial
+from .loaders import loaders_for
 
 # Define a type to bridge to graphene
 class SnippetType(DjangoObjectType):
@@ -28,7 +29,64 @@ class SnippetType(DjangoObjectType):
     def resolve_body_preview(self, info):
         return self.body_preview
 
+    # owner is just a username; this is the User behind it, if there is one,
+    # as anyone who can see the snippet may see it.
+    owner_user = graphene.Field(lambda: PublicUserType)
+
+    def resolve_owner_user(self, info):
+        # The list resolvers load these in one go; see loaders.py.
+        return loaders_for(info).users.load(self.owner)
+
+
+# A snippet as subscription notifications carry it: everything SnippetType
+# has but the body, which isn't sent, only its preview. See
+# notification_snippet() in subscriptions.py.
+class SnippetNotificationType(SnippetType):
+    class Meta:
+        model = Snippet
+        fields = "__all__"
+        # SnippetType stays the one Snippet maps to.
+        skip_registry = True
+
+    body = graphene.String(description="Always null: notifications carry only bodyPreview. Fetch the snippet for the rest.")
+
+    def resolve_body(self, info):
+        return None
+
+
+# Relay-style connection wrapped around SnippetType, i.e. edges/node/cursor
+# plus pageInfo. The paging itself is done in pagination.py.
+class SnippetConnection(graphene.relay.Connection):
+    class Meta:
+        node = SnippetType
+
+
+# What an UPDATE changed, for subscribers that ask for just that. See
+# notification_delta() in subscriptions.py.
+class SnippetDelta(graphene.ObjectType):
+    id = graphene.ID(required=True)
+    # Applies to the snippet at base_version, and makes it version. A client
+    # holding any other version of it should refetch instead.
+    version = graphene.Int()
+    base_version = graphene.Int()
+    # The SnippetInput fields that were written; the others here are null.
+    # A new body shows up as body_preview.
+    changed = graphene.List(graphene.String)
+    title = graphene.String()
+    body_preview = graphene.String()
+    created = graphene.DateTime()
+
 
 class UserType(DjangoObjectType):
     class Meta:
         model = get_user_model()
+
+
+# The User behind a snippet's owner. Whoever can read the snippet can read
+# this, so it is just who they are, not the rest of the account.
+class PublicUserType(DjangoObjectType):
+    class Meta:
+        model = get_user_model()
+        fields = ("id", "username")
+        # UserType stays the one Django model fields map to.
+        skip_registry = True
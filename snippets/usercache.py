@@ -0,0 +1,234 @@
+"""
+Users as the websocket connect path and the JWT path find them, kept for a
+short while so that a storm of reconnects doesn't become a storm of queries.
+
+channels.auth.get_user() reads the session row and then the user row, and
+AuthMiddlewareStack and MyGraphqlWsConsumer.on_connect() each used to call it
+for every connection. get_user() here does that once per session key per
+SNIPPETS_USER_CACHE_TTL seconds; CachedAuthMiddlewareStack uses it in place
+of AuthMiddlewareStack. get_user_by_natural_key(), graphql_jwt's
+JWT_GET_USER_BY_NATURAL_KEY_HANDLER, does the same for the user behind a
+token, by username.
+
+A user's entries are dropped as soon as they log out (the Logout mutation,
+or anything else that sends user_logged_out), or their row is saved or
+deleted, which covers password changes and deactivation. That happens in
+the process that saw it straight away, and in every process once the change
+is committed, over the channel layer (the "snippets.users" group), as for
+the limitedSnippets cache (see cache.py). Nothing is cached in a process
+until it is listening there. Changes that skip signals (e.g.
+QuerySet.update()), and invalidations lost on the way, are only caught up
+with when the TTL runs out.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddleware, get_user as get_session_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from graphql_jwt.utils import get_user_by_natural_key as get_jwt_user
+
+from . import metrics
+from .listener import GroupListener
+
+# Overridable from settings.py.
+USER_CACHE_MAXSIZE = getattr(settings, 'SNIPPETS_USER_CACHE_MAXSIZE', 4096)
+USER_CACHE_TTL = getattr(settings, 'SNIPPETS_USER_CACHE_TTL', 60)  # seconds
+
+INVALIDATION_GROUP = "snippets.users"
+
+
+class UserCache:
+    """
+Bounded, thread-safe LRU cache of users (or AnonymousUser) by key, e.g.
+('session', session_key), each entry living for at most ttl seconds. Hands
+out copies, so no two connections share a user object. Invalidations go to
+the other processes over channel_layer (by default the one in settings.py),
+if there is one.
+    """
+
+    def __init__(self, maxsize=USER_CACHE_MAXSIZE, ttl=USER_CACHE_TTL, channel_layer=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._listener = GroupListener(INVALIDATION_GROUP, self._on_message, channel_layer, name="snippets-users")
+        # Tells this cache's own invalidations apart when they come back.
+        self._origin = uuid.uuid4().hex
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, user)
+        self._keys_by_user = {}  # user pk -> keys
+        # Bumped by every invalidate(), so that a user loaded before one isn't
+        # stored after it.
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The user for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, user = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.copy(user)
+                self._forget(key)
+
+            self.misses += 1
+            return None
+
+    def set(self, key, user, generation):
+        """
+Stores user for key, unless something was invalidated since generation
+(self.generation before the user was loaded), or other processes'
+invalidations can't be heard yet.
+        """
+        listening = self._listener.joined()
+        with self._lock:
+            if not listening or generation != self.generation:
+                return
+            self._forget(key)
+            self._entries[key] = (time.time() + self.ttl, copy.copy(user))
+            if user.pk is not None:
+                self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._forget(next(iter(self._entries)))
+
+    def invalidate(self, user_pk):
+        """
+Drops every entry for a user, here and, once the change is committed, in
+every process.
+        """
+        self._drop(user_pk)
+
+        def on_commit():
+            # In case it was read again before the change was committed.
+            self._drop(user_pk)
+            self._broadcast(user_pk)
+
+        transaction.on_commit(on_commit)
+
+    def _drop(self, user_pk):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in self._keys_by_user.pop(user_pk, ()):
+                self._entries.pop(key, None)
+
+    def _broadcast(self, user_pk):
+        layer = self._listener.layer()
+        if layer is None:
+            return
+        async_to_sync(layer.group_send)(INVALIDATION_GROUP, {
+            "type": "users.invalidate",
+            "origin": self._origin,
+            "user": user_pk,
+        })
+
+    def _on_message(self, message):
+        if message.get("origin") != self._origin:
+            with self._lock:
+                self.remote_invalidations += 1
+            self._drop(message["user"])
+
+    def _forget(self, key):
+        # Called with self._lock held.
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[1].pk is None:
+            return
+        keys = self._keys_by_user.get(entry[1].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[entry[1].pk]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self.generation += 1
+            self.hits = self.misses = self.invalidations = 0
+            self.remote_invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'remote_invalidations': self.remote_invalidations,
+            }
+
+
+user_cache = UserCache()
+metrics.register('user_cache', user_cache.stats)
+
+
+async def get_user(scope):
+    """
+channels.auth.get_user(), from the cache if the scope's session has been
+seen lately. A scope without a session key has no user to look up anyway.
+    """
+    session_key = getattr(scope.get("session"), "session_key", None)
+    if session_key is None:
+        return await get_session_user(scope)
+
+    key = ('session', session_key)
+    user = user_cache.get(key)
+    if user is None:
+        generation = user_cache.generation
+        user = await get_session_user(scope)
+        user_cache.set(key, user, generation)
+    return user
+
+
+def get_user_by_natural_key(username):
+    """graphql_jwt's get_user_by_natural_key(), from the cache if it can be."""
+    key = ('username', username)
+    user = user_cache.get(key)
+    if user is None:
+        generation = user_cache.generation
+        user = get_jwt_user(username)
+        if user is not None:
+            user_cache.set(key, user, generation)
+    return user
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """AuthMiddleware, with the user from get_user() above."""
+
+    async def resolve_scope(self, scope):
+        scope["user"]._wrapped = await get_user(scope)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+def _on_logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        user_cache.invalidate(user.pk)
+
+
+def _on_user_changed(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+user_logged_out.connect(_on_logged_out, dispatch_uid='snippets.usercache')
+post_save.connect(_on_user_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='snippets.usercache')
+post_delete.connect(_on_user_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='snippets.usercache')
@@ -1,4 +1,4 @@
-from .models import Snippet
+from .models import Snippet, IS_PUBLIC, IS_PRIVATE
 from django.views.generic import ListView, DetailView, TemplateView
 
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -8,6 +8,7 @@ from django.shortcuts import render, redirect
 from django.conf import settings
 
 from .forms import SnippetForm
+from .cache import limited_snippets_cache
 
 
 # https://docs.djangoproject.com/en/dev/topics/auth/default/#user-objects
@@ -22,11 +23,15 @@ class SnippetListView(ListView):
     title = 'Default'
 
     def get_queryset(self):
+        # The template only shows body_preview, so leave the bodies in the DB.
+        return self.get_visible_queryset().with_body_preview().defer('body')
+
+    def get_visible_queryset(self):
 
         # The title comes from the urls page
         if self.title == 'Public Snippets':
             # Anyone can view all the Public
-            return Snippet.objects.filter(private=False)
+            return Snippet.objects.filter(IS_PUBLIC)
 
         # "All Snippets" is a bit of a misnomer here. It should be "All Snippets
         # This User Is Allowed To See"
@@ -43,12 +48,12 @@ class SnippetListView(ListView):
                 # Show all public and this owner's records
                 # This is done at the view level on the Django side, and maybe it ought not be.
                 self.title = 'All Snippets Viewable By [{}]'.format(self.request.user.username)
-                return Snippet.objects.filter(Q(private=False) | Q(owner=self.request.user.username))
+                return Snippet.objects.filter(IS_PUBLIC | Q(owner=self.request.user.username))
             else:
                 # AnonymousUser
                 # Can still see Public records . . .
                 self.title = 'All Snippets Viewable By [AnonymousUser]'
-                return Snippet.objects.filter(private=False)
+                return Snippet.objects.filter(IS_PUBLIC)
 
 
 # Note LoginRequiredMixin
@@ -64,11 +69,15 @@ class SnippetAuthenticatedListView(LoginRequiredMixin, ListView):
     title = 'Owner\'s Snippets'
 
     def get_queryset(self):
+        # The template only shows body_preview, so leave the bodies in the DB.
+        return self.get_visible_queryset().with_body_preview().defer('body')
+
+    def get_visible_queryset(self):
         if self.title == 'Private Snippets':
             if self.request.user.is_superuser:
-                return Snippet.objects.filter(private=True)
+                return Snippet.objects.filter(IS_PRIVATE)
             else:
-                return Snippet.objects.filter(owner=self.request.user.username, private=True)
+                return Snippet.objects.filter(IS_PRIVATE, owner=self.request.user.username)
         if self.title == 'Owner Snippets':
             return Snippet.objects.filter(owner=self.request.user.username)
 
@@ -91,7 +100,7 @@ class SnippetDetailView(DetailView):
             return Snippet.objects.filter(pk=self.kwargs['pk'])
         else:
             # Not authenticated, but might be OK to show
-            return Snippet.objects.filter(pk=self.kwargs['pk'], private=False)
+            return Snippet.objects.filter(IS_PUBLIC, pk=self.kwargs['pk'])
 
 
 # This is an example of a class based view based upon a template.
@@ -125,7 +134,10 @@ I might turn this into a class if that's possible for forms.
         form = SnippetForm(post)
 
         if form.is_valid():
-            form.save()  # Persist the data
+            snippet = form.save()  # Persist the data
+
+            # Drop any cached limitedSnippets pages that should now include it.
+            limited_snippets_cache.invalidate(snippet.owner, public=not snippet.private)
 
             # The benefit of a redirect is that a reload doesn't insert another row into the DB.
             # To send a notification message, I'd have to do it in the URL queryString.
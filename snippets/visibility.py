@@ -0,0 +1,93 @@
+"""
+Who gets to see which snippets.
+
+Rules:
+1. All users (including Anonymous) can see Public snippets.
+2. All users can see their own snippets regardless of Public/Private.
+3. SuperUser sees everything.
+
+Every requester falls into one visibility class, and everyone in the same
+class sees exactly the same snippets. That makes the class a handy key for
+anything cached or fanned out per audience.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from . import whoami
+from .models import Snippet, IS_PUBLIC
+
+# Visibility classes, as (kind, username) tuples so they all hash alike.
+PUBLIC = ('public', None)
+SUPERUSER = ('superuser', None)
+
+
+def owner_class(username):
+    return ('owner', username)
+
+
+def visibility_of(info):
+    """
+Works out the visibility class of the user making the request.
+    """
+
+    # See who I am based upon the web token
+    jwt_username = str(whoami(info))
+    username = str(info.context.user)
+    if jwt_username != username:
+        # Different usernames? Shouldn't be.
+        print(f"LIMITED: whoami [{jwt_username}] != [{username}]")
+        return PUBLIC
+    elif jwt_username == 'AnonymousUser':
+        # Same, but anonymous
+        print(f"LIMITED: Confirmed to be AnonymousUser")
+        return PUBLIC
+
+    if settings.DEBUG:
+        print(f"LIMITED: Authenticated and acknowledged to be [{username}]")
+
+    return visibility_of_user(info.context.user)
+
+
+def visibility_of_user(user):
+    """
+The visibility class of a user already known to be who they say, e.g. the
+user of a websocket connection.
+    """
+    if user.is_authenticated:
+        # It's good to be the king
+        if user.is_superuser:
+            if settings.DEBUG:
+                print("Super user sees all")
+            return SUPERUSER
+
+        # Otherwise, the user gets to see Public and their own records
+        return owner_class(user.username)
+    else:
+        if settings.DEBUG:
+            print("AnonymousUser sees less")
+        return PUBLIC
+
+
+def snippets_visible_to(visibility):
+    """Returns the queryset of snippets a visibility class can see."""
+    kind, username = visibility
+    if kind == 'superuser':
+        return Snippet.objects.all()
+    if kind == 'owner':
+        return Snippet.objects.filter(IS_PUBLIC | Q(owner=username))
+    return Snippet.objects.filter(IS_PUBLIC)
+
+
+def visible_snippets(info):
+    """Returns the queryset of snippets that the requesting user can see."""
+    return snippets_visible_to(visibility_of(info))
+
+
+def affected_classes(owner, public):
+    """
+Returns the visibility classes that can see a snippet, or None meaning all
+of them. public should be True if the snippet is, or was, public.
+    """
+    if public:
+        return None
+    return {SUPERUSER, owner_class(owner)}
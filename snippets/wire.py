@@ -0,0 +1,155 @@
+"""
+How graphql-ws messages are encoded on the wire, chosen by subprotocol.
+
+A client that offers just graphql-ws gets what it always did: JSON in text
+frames. A client can also offer, in its order of preference,
+
+    graphql-ws+msgpack          MessagePack, in binary frames
+    graphql-ws+deflate          JSON, raw-deflated (RFC 1951), in binary frames
+    graphql-ws+msgpack+deflate  MessagePack, raw-deflated, in binary frames
+
+and gets the first of those the server knows. The messages themselves are
+the same in every encoding. The client may send its own as JSON text, or as
+binary in the negotiated encoding.
+
+Subscribers with the same document and visibility share one rendering of a
+notification (see fanout.py), and their frames differ only in the operation
+id. So each encoding encodes, and compresses, the shared payload once, and
+builds every subscriber's frame around it. A MessagePack map is just its
+keys and values one after another, and a deflated frame is the envelope in
+stored (uncompressed) deflate blocks on either side of the compressed
+payload; inflating it gives the same bytes as encoding the whole message.
+"""
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import msgpack
+
+from .fanout import data_frame
+
+GRAPHQL_WS = 'graphql-ws'
+
+# Shared payloads kept encoded, per encoding.
+ENCODED_PAYLOADS_MAXSIZE = 256
+
+
+def _stored(data, final):
+    """data as stored deflate blocks, the last one marked final if asked."""
+    blocks = []
+    chunks = [data[i:i + 0xffff] for i in range(0, len(data), 0xffff)] or [b""]
+    for n, chunk in enumerate(chunks):
+        last = final and n == len(chunks) - 1
+        blocks.append(bytes([last]) + struct.pack('<HH', len(chunk), len(chunk) ^ 0xffff) + chunk)
+    return b"".join(blocks)
+
+
+def deflate(data):
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data):
+    return zlib.decompressobj(wbits=-15).decompress(data)
+
+
+class WireFormat:
+    """One encoding: msgpack or JSON, deflated or not."""
+
+    def __init__(self, subprotocol, use_msgpack=False, use_deflate=False):
+        self.subprotocol = subprotocol
+        self.msgpack = use_msgpack
+        self.deflate = use_deflate
+        self.binary = use_msgpack or use_deflate
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+        # The envelope around the id, and after it up to the payload.
+        if use_msgpack:
+            self._head = b"\x83" + msgpack.packb("type") + msgpack.packb("data") + msgpack.packb("id")
+            self._middle = msgpack.packb("payload")
+            self._suffix = b""
+        else:
+            self._head = b'{"type": "data", "id": '
+            self._middle = b', "payload": '
+            self._suffix = b"}"
+        self._stored_suffix = _stored(self._suffix, True)
+
+    def _dumps(self, content):
+        if self.msgpack:
+            return msgpack.packb(content, use_bin_type=True)
+        return json.dumps(content).encode('utf-8')
+
+    def encode(self, content):
+        """A whole message, as the keyword arguments of a websocket send."""
+        if not self.binary:
+            return {'text_data': json.dumps(content)}
+        data = self._dumps(content)
+        return {'bytes_data': deflate(data) if self.deflate else data}
+
+    def decode(self, bytes_data):
+        """A binary message from the client."""
+        data = inflate(bytes_data) if self.deflate else bytes_data
+        if self.msgpack:
+            return msgpack.unpackb(data, raw=False)
+        return json.loads(data)
+
+    def data_frame(self, operation_id, payload_json):
+        """
+A "data" message for one operation, given its payload's JSON as rendered by
+fanout.data_payload(). Returns (text_data, bytes_data).
+        """
+        if not self.binary:
+            return data_frame(operation_id, payload_json), None
+
+        packed_id = msgpack.packb(operation_id) if self.msgpack else json.dumps(operation_id).encode('utf-8')
+        prefix = self._head + packed_id + self._middle
+        payload = self._payload(payload_json)
+        if self.deflate:
+            return None, _stored(prefix, False) + payload + self._stored_suffix
+        return None, prefix + payload + self._suffix
+
+    def _payload(self, payload_json):
+        """The shared payload, encoded (and compressed) once."""
+        with self._lock:
+            payload = self._payloads.get(payload_json)
+            if payload is not None:
+                self._payloads.move_to_end(payload_json)
+                return payload
+
+        payload = msgpack.packb(json.loads(payload_json), use_bin_type=True) if self.msgpack \
+            else payload_json.encode('utf-8')
+        if self.deflate:
+            # Flushed to a byte boundary, but not final: more blocks follow.
+            compressor = zlib.compressobj(wbits=-15)
+            payload = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        with self._lock:
+            self._payloads[payload_json] = payload
+            while len(self._payloads) > ENCODED_PAYLOADS_MAXSIZE:
+                self._payloads.popitem(last=False)
+        return payload
+
+
+WIRE_FORMATS = {
+    wire.subprotocol: wire for wire in (
+        WireFormat(GRAPHQL_WS),
+        WireFormat(GRAPHQL_WS + '+msgpack', use_msgpack=True),
+        WireFormat(GRAPHQL_WS + '+deflate', use_deflate=True),
+        WireFormat(GRAPHQL_WS + '+msgpack+deflate', use_msgpack=True, use_deflate=True),
+    )
+}
+
+
+def negotiate(subprotocols):
+    """
+The WireFormat for the first of the client's subprotocols (str or bytes) that
+is known here, or None.
+    """
+    for subprotocol in subprotocols:
+        if isinstance(subprotocol, bytes):
+            subprotocol = subprotocol.decode()
+        if subprotocol in WIRE_FORMATS:
+            return WIRE_FORMATS[subprotocol]
+    return None